@@ -1,12 +1,15 @@
 import dataclasses
 import io
+import json
 import logging.handlers
 import os
 import pathlib
+import time
 import zipfile
 
 import requests
 import streamlit as st
+import streamlit.components.v1 as components
 
 
 @dataclasses.dataclass
@@ -16,7 +19,11 @@ class PlayerParams:
 
 
 SERVER_URL = os.environ.get("SERVER_URL", "http://localhost:8500")
+# The server as seen from the browser, which loads the clean video from it
+PUBLIC_SERVER_URL = os.environ.get("PUBLIC_SERVER_URL", SERVER_URL)
 REQUEST_TIMEOUT = 60
+JOB_POLL_INTERVAL = 1
+OVERLAY_HEIGHT = 480
 LOG_PATH = pathlib.Path("logs/client.log")
 LOG_PATH.parent.mkdir(exist_ok=True)
 VIDEO_FORMATS = [
@@ -72,6 +79,37 @@ def try_request(method, url, **kwargs):
     return response
 
 
+def run_job(url, text, **kwargs):
+    """
+    Submits a job to the server and waits for it to finish,
+    showing its progress with `text`.
+    Returns the response with the job result, or None if an error occurs.
+    """
+    response = try_request(method="POST", url=url, **kwargs)
+    if response is None:
+        return None
+    job_id = response.json()["job_id"]
+
+    progress_bar = st.progress(0.0, text=text)
+    while True:
+        response = try_request(method="GET", url=f"{SERVER_URL}/jobs/{job_id}")
+        if response is None:
+            return None
+        job = response.json()
+        if job["status"] == "done":
+            break
+        if job["status"] in ("failed", "cancelled"):
+            st.error(f"Server job {job['status']}")
+            logging.error(f"Job {job_id} {job['status']}: {job['error']}")
+            return None
+        stage = f" ({job['stage']})" if job["stage"] else ""
+        progress_bar.progress(job["progress"], text=f"{text}{stage}")
+        time.sleep(JOB_POLL_INTERVAL)
+    progress_bar.empty()
+
+    return try_request(method="GET", url=f"{SERVER_URL}/jobs/{job_id}/result")
+
+
 def get_models():
     """Gets and stores the list of detectors and trackers from the server."""
     st.session_state.models = try_request(
@@ -79,7 +117,7 @@ def get_models():
     ).json()
 
 
-def infer(video_file, detector, tracker):
+def infer(video_file, detector, tracker, output):
     """Infers the model on a new video file and resets the interface."""
 
     # Clear session state except for models lists (these don't change)
@@ -87,15 +125,22 @@ def infer(video_file, detector, tracker):
     st.session_state.clear()
     st.session_state.models = models
 
-    response = try_request(
-        method="POST",
-        url=f"{SERVER_URL}/infer",
-        files={"video_file": video_file},
-        params={"detector": detector, "tracker": tracker},
+    # Streamed, so that the server can start tracking during the upload
+    response = run_job(
+        url=f"{SERVER_URL}/jobs/infer_stream",
+        text="Tracking players...",
+        data=video_file,
+        params={
+            "filename": video_file.name,
+            "detector": detector,
+            "tracker": tracker,
+            "output": output,
+        },
     )
     if response is None:
         return
 
+    st.session_state.session_id = response.headers["session_id"]
     st.session_state.player_ids = [
         int(x) for x in response.headers["player_ids"].split(",")
     ]
@@ -110,7 +155,15 @@ def infer(video_file, detector, tracker):
         st.session_state[f"times{pid}"] = f"{start_secs_vid} - {end_secs_vid}"
 
     with zipfile.ZipFile(io.BytesIO(response.content), "r") as archive:
-        st.session_state.video = archive.read("annotated.mp4")
+        if output == "overlay":
+            # The browser streams the clean video from the server
+            st.session_state.video = (
+                f"{PUBLIC_SERVER_URL}/get_clean_video"
+                f"?session_id={st.session_state.session_id}"
+            )
+            st.session_state.overlay = json.loads(archive.read("overlay.json"))
+        else:
+            st.session_state.video = archive.read("annotated.mp4")
         for pid in st.session_state.player_ids:
             st.session_state[f"image{pid}"] = archive.read(f"images/{pid}.jpg")
 
@@ -121,9 +174,10 @@ def infer(video_file, detector, tracker):
 def regenerate_video(params_dict):
     """Regenerates the annotated video based on the current params."""
     del st.session_state.video
-    response = try_request(
-        method="POST",
-        url=f"{SERVER_URL}/make_video",
+    response = run_job(
+        url=f"{SERVER_URL}/jobs/make_video",
+        text="Generating video...",
+        params={"session_id": st.session_state.session_id},
         json={
             pid: {"label": params.label, "draw": params.draw}
             for pid, params in params_dict.items()
@@ -133,17 +187,115 @@ def regenerate_video(params_dict):
         st.session_state.video = response.content
 
 
+def overlay_player(video_url, overlay, params_dict):
+    """
+    Shows the clean video from `video_url` and draws the boxes from `overlay`
+    on top of it during playback, with labels according to `params_dict`.
+    Changing the params only redraws the boxes, the server isn't called.
+    """
+    labels = {
+        pid: params.label if params.label else f"id{pid}"
+        for pid, params in params_dict.items()
+        if params.draw
+    }
+    components.html(
+        f"""
+        <div style="position: relative; display: inline-block">
+          <video id="video" src="{video_url}" controls
+            style="display: block; max-width: 100%;
+                   max-height: {OVERLAY_HEIGHT - 10}px"></video>
+          <canvas id="canvas"
+            style="position: absolute; left: 0; top: 0;
+                   pointer-events: none"></canvas>
+        </div>
+        <script>
+          const overlay = {json.dumps(overlay)};
+          const labels = {json.dumps(labels)};
+          const video = document.getElementById("video");
+          const canvas = document.getElementById("canvas");
+          const ctx = canvas.getContext("2d");
+
+          // Same colors as the boxes drawn on the server
+          function draw(time) {{
+            canvas.width = video.clientWidth;
+            canvas.height = video.clientHeight;
+            if (!video.videoWidth) return;
+            const scale = video.clientWidth / video.videoWidth;
+            const frame = Math.min(
+              Math.floor(time * overlay.fps + 1e-3), overlay.num_frames - 1
+            );
+            const end = overlay.frame_starts[frame + 1];
+            ctx.font = "14px sans-serif";
+            for (let i = overlay.frame_starts[frame]; i < end; i++) {{
+              const label = labels[overlay.track_ids[i]];
+              if (label === undefined) continue;
+              const [x1, y1, x2, y2] = overlay.boxes[i].map(x => x * scale);
+              ctx.strokeStyle = "white";
+              ctx.lineWidth = 2;
+              ctx.strokeRect(x1, y1, x2 - x1, y2 - y1);
+              ctx.fillStyle = "white";
+              ctx.fillRect(x1, y1 - 18, ctx.measureText(label).width + 8, 18);
+              ctx.fillStyle = "black";
+              ctx.fillText(label, x1 + 4, y1 - 5);
+            }}
+          }}
+
+          if ("requestVideoFrameCallback" in video) {{
+            const onFrame = (_, metadata) => {{
+              draw(metadata.mediaTime);
+              video.requestVideoFrameCallback(onFrame);
+            }};
+            video.requestVideoFrameCallback(onFrame);
+          }} else {{
+            const onTick = () => {{
+              draw(video.currentTime);
+              requestAnimationFrame(onTick);
+            }};
+            requestAnimationFrame(onTick);
+          }}
+          video.addEventListener("loadeddata", () => draw(video.currentTime));
+          video.addEventListener("seeked", () => draw(video.currentTime));
+        </script>
+        """,
+        height=OVERLAY_HEIGHT,
+    )
+
+
 def get_focused_video(player_id):
     """Generates a video focused on a specific player."""
-    response = try_request(
-        method="POST",
-        url=f"{SERVER_URL}/make_focused_video",
-        params={"player_id": player_id},
+    response = run_job(
+        url=f"{SERVER_URL}/jobs/make_focused_video",
+        text="Generating focused video...",
+        params={
+            "session_id": st.session_state.session_id,
+            "player_id": player_id,
+        },
     )
     if response is not None:
         st.session_state[f"focused{player_id}"] = response.content
 
 
+def get_focused_videos(params_dict):
+    """Generates videos focused on all highlighted players at once."""
+    player_ids = [pid for pid, params in params_dict.items() if params.draw]
+    if not player_ids:
+        st.warning("No players are highlighted")
+        return
+    response = run_job(
+        url=f"{SERVER_URL}/jobs/make_focused_videos",
+        text="Generating focused videos...",
+        params={
+            "session_id": st.session_state.session_id,
+            "player_ids": player_ids,
+        },
+    )
+    if response is None:
+        return
+    with zipfile.ZipFile(io.BytesIO(response.content), "r") as archive:
+        for pid in player_ids:
+            st.session_state[f"focused{pid}"] = archive.read(f"{pid}.mp4")
+
+
 def set_all_inputs(value):
     """Sets all text inputs' values to `value`."""
     for pid in st.session_state.player_ids:
@@ -184,41 +336,60 @@ def build_app():
         format_func=lambda slug: trackers[trk_slugs.index(slug)]["ui_name"],
     )
 
+    overlay_mode = st.toggle(
+        "Draw boxes in the browser",
+        help="Labels can be changed without regenerating the video",
+    )
+
     st.columns([3, 2, 3])[1].button(
         "Track!",
         use_container_width=True,
         type="primary",
         on_click=infer,
-        args=(video_file, selected_detector, selected_tracker),
+        args=(
+            video_file,
+            selected_detector,
+            selected_tracker,
+            "overlay" if overlay_mode else "video",
+        ),
     )
 
     if "video" in st.session_state:
-        st.video(st.session_state.video)
-
         params_dict = {}
-        st.columns([3, 2, 3])[1].button(
-            "Regenerate video",
-            use_container_width=True,
-            type="primary",
-            on_click=regenerate_video,
-            args=(params_dict,),
-        )
+        if "overlay" in st.session_state:
+            # Filled after the params are read from the inputs below
+            video_placeholder = st.empty()
+        else:
+            st.video(st.session_state.video)
+            st.columns([3, 2, 3])[1].button(
+                "Regenerate video",
+                use_container_width=True,
+                type="primary",
+                on_click=regenerate_video,
+                args=(params_dict,),
+            )
 
         st.header("Detected players")
 
-        button_columns = st.columns(4)
-        button_columns[1].button(
+        button_columns = st.columns(3)
+        button_columns[0].button(
             "Deselect all",
             use_container_width=True,
             on_click=set_all_checkboxes,
             args=(False,),
         )
-        button_columns[2].button(
+        button_columns[1].button(
             "Select all",
             use_container_width=True,
             on_click=set_all_checkboxes,
             args=(True,),
         )
+        button_columns[2].button(
+            "Focus on selected",
+            use_container_width=True,
+            on_click=get_focused_videos,
+            args=(params_dict,),
+        )
 
         grid = [
             st.columns(3)
@@ -253,6 +424,14 @@ def build_app():
                         key=f"focusbtn{pid}",
                     )
 
+        if "overlay" in st.session_state:
+            with video_placeholder:
+                overlay_player(
+                    st.session_state.video,
+                    st.session_state.overlay,
+                    params_dict,
+                )
+
 
 if __name__ == "__main__":
     log_handler = logging.handlers.TimedRotatingFileHandler(
@@ -0,0 +1,259 @@
+"""
+Tracks players on many clips offline, without the server:
+
+    python batch.py CLIPS --detector SLUG --tracker SLUG --out-dir DIR
+        [--workers N] [--threads T] [--stride K] [--render] [--cache-dir C]
+
+CLIPS is a directory, searched recursively for videos, or a manifest:
+a text file with a video path on each line (relative to the manifest).
+Clips are tracked in parallel by N worker processes, each using T threads
+for torch and OpenCV. For each clip, DIR/{clip path without suffix}/ gets:
+  - the tracks in the MOTChallenge format (tracks.txt),
+  - with --render, a video with boxes and labels (annotated.mp4),
+  - done.json with the settings and statistics, written last.
+Clips whose done.json has the same settings are skipped, so an interrupted
+or partly failed run is resumed by running the same command again.
+Detections and GMC matrices are cached in C (by default, DIR/.cache)
+rather than in the caches of the server, so a batch doesn't evict them.
+
+Run from the server folder, so that the models can be found.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import pathlib
+import time
+import typing as tp
+
+import cv2
+import torch
+
+import cache
+import tracking
+import video
+
+
+VIDEO_SUFFIXES = {
+    ".avi",
+    ".flv",
+    ".m4v",
+    ".mkv",
+    ".mov",
+    ".mp4",
+    ".mpeg",
+    ".mpg",
+    ".ts",
+    ".webm",
+}
+
+
+def find_clips(clips: pathlib.Path) -> dict[pathlib.Path, pathlib.Path]:
+    """
+    Returns the videos of a directory or a manifest (see above), each mapped
+    to its path relative to the directory or the manifest, which names
+    its results. Videos outside the manifest's folder are named by the file
+    name only. Raises ValueError if two videos get the same name.
+    """
+    if clips.is_dir():
+        paths = sorted(
+            path
+            for path in clips.rglob("*")
+            if path.suffix.lower() in VIDEO_SUFFIXES and path.is_file()
+        )
+        root = clips
+    else:
+        root = clips.parent
+        paths = [
+            root / line.strip()
+            for line in clips.read_text().splitlines()
+            if line.strip() and not line.strip().startswith("#")
+        ]
+
+    names = {}
+    taken = set()
+    for path in paths:
+        name = (
+            path.relative_to(root)
+            if path.is_relative_to(root)
+            else pathlib.Path(path.name)
+        ).with_suffix("")
+        if name in taken:
+            raise ValueError(f"more than one clip is named {name}")
+        taken.add(name)
+        names[path] = name
+    return names
+
+
+def is_done(out_dir: pathlib.Path, settings: dict[str, tp.Any]) -> bool:
+    """
+    Returns whether the clip has been processed with `settings`.
+    A missing or unreadable done.json means that it hasn't.
+    """
+    try:
+        done = json.loads((out_dir / "done.json").read_text())
+    except (OSError, ValueError):
+        return False
+    return isinstance(done, dict) and all(
+        done.get(key) == value for key, value in settings.items()
+    )
+
+
+def init_worker(num_threads: int, cache_dir: pathlib.Path) -> None:
+    """
+    Pins the number of threads used by torch and OpenCV in a worker
+    and moves its caches of detections and GMC matrices to `cache_dir`.
+    """
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    tracking.DETECTIONS = cache.DiskCache(
+        cache_dir / "detections", tracking.DETECTIONS.max_bytes
+    )
+    tracking.GMC_MATRICES = cache.DiskCache(
+        cache_dir / "gmc", tracking.GMC_MATRICES.max_bytes
+    )
+    tracking.CACHES.update(
+        detections=tracking.DETECTIONS, gmc=tracking.GMC_MATRICES
+    )
+
+
+def process_clip(
+    video_path: pathlib.Path,
+    out_dir: pathlib.Path,
+    settings: dict[str, tp.Any],
+) -> dict[str, tp.Any]:
+    """
+    Tracks players on the clip at `video_path` with the detector, tracker
+    and stride of `settings` and saves the results to `out_dir`.
+    Files are replaced atomically, and done.json is written last, so a clip
+    interrupted midway is processed again by the next run.
+    Runs in a worker process, where the models stay loaded between clips.
+    Returns the contents of done.json.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    tracks = tracking.track(
+        video_path,
+        tracking.DETECTORS[settings["detector"]],
+        tracking.TRACKERS[settings["tracker"]],
+        stride=settings["stride"],
+    )
+    tmp_path = out_dir / "tracks.tmp.txt"
+    tracks.save_mot(tmp_path)
+    os.replace(tmp_path, out_dir / "tracks.txt")
+
+    if settings["render"]:
+        tmp_path = out_dir / "annotated.tmp.mp4"
+        video.draw_bboxes(
+            video_path,
+            tmp_path,
+            tracks,
+            collections.defaultdict(video.PlayerParams),
+        )
+        os.replace(tmp_path, out_dir / "annotated.mp4")
+
+    done = settings | {
+        "video": str(video_path),
+        "frames": tracks.num_frames,
+        "players": len(tracks.player_ids()),
+        "secs": time.perf_counter() - start,
+    }
+    tmp_path = out_dir / "done.tmp.json"
+    tmp_path.write_text(json.dumps(done))
+    os.replace(tmp_path, out_dir / "done.json")
+    return done
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("clips", type=pathlib.Path)
+    parser.add_argument(
+        "--detector", choices=list(tracking.DETECTORS.keys()), required=True
+    )
+    parser.add_argument(
+        "--tracker", choices=list(tracking.TRACKERS.keys()), required=True
+    )
+    parser.add_argument("--out-dir", type=pathlib.Path, required=True)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--threads",
+        type=int,
+        help="threads per worker, by default the CPUs divided by the workers",
+    )
+    parser.add_argument(
+        "--stride", type=int, help="by default, that of the detector"
+    )
+    parser.add_argument("--render", action="store_true")
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        help="cache of detections and GMC matrices, by default OUT_DIR/.cache",
+    )
+    args = parser.parse_args()
+
+    for slug, model in [
+        (args.detector, tracking.DETECTORS[args.detector]),
+        (args.tracker, tracking.TRACKERS[args.tracker]),
+    ]:
+        if not model.is_available():
+            parser.error(f"model {slug} hasn't been exported, run export.py")
+    if args.workers < 1 or (args.stride is not None and args.stride < 1):
+        parser.error("--workers and --stride must be at least 1")
+    try:
+        clips = find_clips(args.clips)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    settings = {
+        "detector": args.detector,
+        "tracker": args.tracker,
+        "stride": args.stride,
+        "render": args.render,
+    }
+    todo = {
+        path: args.out_dir / name
+        for path, name in clips.items()
+        if not is_done(args.out_dir / name, settings)
+    }
+    print(f"clips: {len(clips)}, already done: {len(clips) - len(todo)}")
+    if not todo:
+        return
+
+    num_threads = args.threads or max(1, os.cpu_count() // args.workers)
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(args.workers, len(todo)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(num_threads, args.cache_dir or args.out_dir / ".cache"),
+    ) as pool:
+        futures = {
+            pool.submit(process_clip, path, out_dir, settings): path
+            for path, out_dir in todo.items()
+        }
+        for num_done, future in enumerate(
+            concurrent.futures.as_completed(futures), start=1
+        ):
+            path = futures[future]
+            try:
+                done = future.result()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                failed.append(path)
+                print(f"[{num_done}/{len(todo)}] {path}: failed: {e!r}")
+                continue
+            print(
+                f"[{num_done}/{len(todo)}] {path}: {done['frames']} frames, "
+                f"{done['players']} players, "
+                f"{done['frames'] / done['secs']:.1f} frames/s"
+            )
+
+    if failed:
+        print(f"failed: {len(failed)} clips, run again to retry them")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,636 @@
+"""
+Benchmarks of the heavy processing stages, run on a local video file:
+
+    python benchmark.py gmc VIDEO [--batch-size K] [--model-size small]
+    python benchmark.py sparse-gmc VIDEO [--downscale D] [--detector SLUG]
+    python benchmark.py adaptive-gmc VIDEO [--tracker SLUG] [--budget-ms MS]
+    python benchmark.py pipeline VIDEO [--detector SLUG] [--tracker SLUG]
+    python benchmark.py detector-backends VIDEO SLUG [SLUG ...]
+    python benchmark.py gmc-backends VIDEO SLUG [SLUG ...]
+    python benchmark.py render VIDEO TRACKS_DIR [--workers N [N ...]]
+        [--check-frames K]
+    python benchmark.py sharded VIDEO --detector SLUG [--shards N [N ...]]
+"""
+
+import argparse
+import collections
+import os
+import pathlib
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+import ultralytics.trackers.utils.gmc
+
+import cache
+import gmc
+import pipeline
+import sharding
+import track_store
+import tracking
+import video
+
+
+def bench_gmc(args: argparse.Namespace) -> None:
+    """Compares `RaftGMC.apply` frame by frame with `BatchedRaftGMC`."""
+    torchvision.models.optical_flow.raft.upsample_flow = gmc.scale_raft_flow
+    gmc_args = {
+        "model_size": args.model_size,
+        "image_size": args.image_size,
+        "num_flow_updates": args.num_flow_updates,
+    }
+
+    sequential = gmc.RaftGMC(**gmc_args)
+    start = time.perf_counter()
+    capture = cv2.VideoCapture(args.video)
+    expected = []
+    with torch.inference_mode():  # As in `tracking.associate`
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            expected.append(sequential.apply(frame))
+    capture.release()
+    sequential_secs = time.perf_counter() - start
+
+    batched = gmc.BatchedRaftGMC(**gmc_args, batch_size=args.batch_size)
+    start = time.perf_counter()
+    matrices = batched.compute_all(args.video)
+    batched_secs = time.perf_counter() - start
+
+    num_frames = len(expected)
+    print(f"frames: {num_frames}, device: {gmc.DEVICE}")
+    print(
+        f"RaftGMC:        {1000 * sequential_secs / num_frames:.2f} ms/frame"
+    )
+    print(
+        f"BatchedRaftGMC: {1000 * batched_secs / num_frames:.2f} ms/frame "
+        f"(batch size {args.batch_size}, "
+        f"speedup {sequential_secs / batched_secs:.2f}x)"
+    )
+    print(
+        "max difference of the matrices: "
+        f"{np.abs(np.array(expected) - matrices).max():.4f}"
+    )
+
+
+def time_gmc(
+    model: gmc.GMC,
+    video: str,
+    detections: list[np.ndarray] | None = None,
+) -> tuple[float, np.ndarray]:
+    """
+    Calls `model.apply` on each frame of `video` with `detections` (xyxy)
+    converted to the format used by BoT-SORT. Returns the total time spent
+    in `apply` and the [N, 2, 3] matrices.
+    """
+    capture = cv2.VideoCapture(video)
+    total_secs = 0.0
+    matrices = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        dets = np.empty((0, 5))
+        if detections is not None:
+            xyxy = detections[len(matrices)][:, :4]
+            dets = np.concatenate(
+                [
+                    (xyxy[:, :2] + xyxy[:, 2:]) / 2,
+                    xyxy[:, 2:] - xyxy[:, :2],
+                    np.arange(len(xyxy))[:, None],
+                ],
+                axis=1,
+            )
+        start = time.perf_counter()
+        matrices.append(model.apply(frame, dets))
+        total_secs += time.perf_counter() - start
+    capture.release()
+    return total_secs, np.array(matrices)
+
+
+def bench_sparse_gmc(args: argparse.Namespace) -> None:
+    """
+    Compares the stock sparse optical flow GMC with `PersistentSparseFlowGMC`.
+    """
+    detections = None
+    if args.detector is not None:
+        detections = tracking.cached_detect(
+            args.video,
+            cache.file_digest(args.video),
+            tracking.DETECTORS[args.detector],
+        )
+
+    results = {
+        "stock sparseOptFlow": time_gmc(
+            ultralytics.trackers.utils.gmc.GMC(
+                method="sparseOptFlow", downscale=args.downscale
+            ),
+            args.video,
+        ),
+        "PersistentSparseFlowGMC": time_gmc(
+            gmc.PersistentSparseFlowGMC(downscale=args.downscale),
+            args.video,
+            detections,
+        ),
+    }
+
+    num_frames = len(results["stock sparseOptFlow"][1])
+    print(
+        f"frames: {num_frames}, downscale: {args.downscale}, "
+        f"detections: {args.detector or 'none'}"
+    )
+    for name, (secs, matrices) in results.items():
+        print(
+            f"{name}: {1000 * secs / num_frames:.2f} ms/frame, "
+            "mean |translation|: "
+            f"{np.abs(matrices[:, :, 2]).mean():.3f} px"
+        )
+
+
+def bench_adaptive_gmc(args: argparse.Namespace) -> None:
+    """Compares the GMC of a tracker with the same GMC in `AdaptiveGMC`."""
+    torchvision.models.optical_flow.raft.upsample_flow = gmc.scale_raft_flow
+    tracker = tracking.TRACKERS[args.tracker]
+    adaptive = gmc.AdaptiveGMC(
+        tracker.gmc_class, tracker.gmc_args, budget_ms=args.budget_ms
+    )
+    with torch.inference_mode():  # As in `tracking.associate`
+        full_secs, expected = time_gmc(
+            tracker.gmc_class(**tracker.gmc_args), args.video
+        )
+        adaptive_secs, matrices = time_gmc(adaptive, args.video)
+
+    num_frames = len(expected)
+    print(f"frames: {num_frames}, tracker: {args.tracker}")
+    print(
+        f"{tracker.gmc_class.__name__}: "
+        f"{1000 * full_secs / num_frames:.2f} ms/frame"
+    )
+    print(
+        f"AdaptiveGMC: {1000 * adaptive_secs / num_frames:.2f} ms/frame "
+        f"(budget: {args.budget_ms} ms), paths: {dict(adaptive.path_counts)}"
+    )
+    print(
+        "mean difference of the translations: "
+        f"{np.abs(expected[:, :, 2] - matrices[:, :, 2]).mean():.3f} px"
+    )
+
+
+def bench_pipeline(args: argparse.Namespace) -> None:
+    """
+    Tracks a video and prints the statistics of the tracking pipeline.
+    Run from the server folder, so that the models can be found.
+    """
+    tracking.DETECTION_BATCH_SIZE = args.batch_size
+    stats = pipeline.PipelineStats()
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if args.no_cache:
+            tracking.DETECTIONS = cache.DiskCache(
+                pathlib.Path(cache_dir) / "detection", 0
+            )
+            tracking.GMC_MATRICES = cache.DiskCache(
+                pathlib.Path(cache_dir) / "gmc", 0
+            )
+        start = time.perf_counter()
+        tracks = tracking.track(
+            args.video,
+            tracking.DETECTORS[args.detector],
+            tracking.TRACKERS[args.tracker],
+            stride=args.stride,
+            stats=stats,
+        )
+        total_secs = time.perf_counter() - start
+
+    print(
+        f"frames: {tracks.num_frames}, "
+        f"{1000 * total_secs / tracks.num_frames:.2f} ms/frame"
+    )
+    for stage, busy in stats.utilisation().items():
+        print(f"{stage}: {100 * busy:.0f}% busy")
+    for name, queue_stats in stats.queues.items():
+        print(
+            f"{name} queue: mean depth {queue_stats.mean:.1f}, "
+            f"max {queue_stats.max}/{queue_stats.capacity}"
+        )
+
+
+def match_detections(
+    reference: np.ndarray, candidate: np.ndarray, min_iou: float = 0.5
+) -> tuple[int, list[float]]:
+    """
+    Greedily matches [N, 6] `candidate` detections to `reference` ones
+    of the same frame by IoU. Returns the number of matches and the
+    differences of their confidences.
+    """
+    if len(reference) == 0 or len(candidate) == 0:
+        return 0, []
+    ious = torchvision.ops.box_iou(
+        torch.from_numpy(reference[:, :4]), torch.from_numpy(candidate[:, :4])
+    ).numpy()
+    conf_diffs = []
+    while ious.size and ious.max() >= min_iou:
+        ref_idx, cand_idx = np.unravel_index(ious.argmax(), ious.shape)
+        conf_diffs.append(abs(reference[ref_idx, 4] - candidate[cand_idx, 4]))
+        ious[ref_idx, :] = 0
+        ious[:, cand_idx] = 0
+    return len(conf_diffs), conf_diffs
+
+
+def bench_detector_backends(args: argparse.Namespace) -> None:
+    """
+    Compares the latency of detectors (e.g. the same model on different
+    backends) and how well their detections agree with the first one.
+    Run from the server folder, so that the models can be found.
+    """
+    results = {}
+    for slug in args.detectors:
+        detector = tracking.DETECTORS[slug]
+        tracking.detect_frames(  # Warm-up
+            detector, [np.zeros((360, 640, 3), dtype=np.uint8)]
+        )
+        start = time.perf_counter()
+        detections = tracking.detect(args.video, detector)
+        secs = time.perf_counter() - start
+        results[slug] = (
+            secs,
+            [boxes[boxes[:, 4] >= args.min_conf] for boxes in detections],
+        )
+
+    reference_secs, reference = results[args.detectors[0]]
+    num_frames = len(reference)
+    num_reference = sum(len(boxes) for boxes in reference)
+    print(f"frames: {num_frames}, reference: {args.detectors[0]}")
+    for slug, (secs, detections) in results.items():
+        num_detections = sum(len(boxes) for boxes in detections)
+        matches = [
+            match_detections(ref_boxes, boxes)
+            for ref_boxes, boxes in zip(reference, detections)
+        ]
+        num_matched = sum(num for num, _ in matches)
+        conf_diffs = [diff for _, diffs in matches for diff in diffs]
+        print(
+            f"{slug}: {1000 * secs / num_frames:.2f} ms/frame "
+            f"(speedup {reference_secs / secs:.2f}x), "
+            f"recall {num_matched / max(num_reference, 1):.3f}, "
+            f"precision {num_matched / max(num_detections, 1):.3f}, "
+            f"mean |conf diff| {np.mean(conf_diffs or [0]):.4f}"
+        )
+
+
+def bench_gmc_backends(args: argparse.Namespace) -> None:
+    """
+    Compares the latency of the GMCs of trackers (e.g. RAFT on different
+    backends) and the difference of their translations from the first one.
+    """
+    torchvision.models.optical_flow.raft.upsample_flow = gmc.scale_raft_flow
+    results = {}
+    with torch.inference_mode():  # As in `tracking.associate`
+        for slug in args.trackers:
+            tracker = tracking.TRACKERS[slug]
+            results[slug] = time_gmc(
+                tracker.gmc_class(**tracker.gmc_args), args.video
+            )
+
+    reference_secs, reference = results[args.trackers[0]]
+    num_frames = len(reference)
+    print(f"frames: {num_frames}, reference: {args.trackers[0]}")
+    for slug, (secs, matrices) in results.items():
+        print(
+            f"{slug}: {1000 * secs / num_frames:.2f} ms/frame "
+            f"(speedup {reference_secs / secs:.2f}x), "
+            "mean difference of the translations: "
+            f"{np.abs(reference[:, :, 2] - matrices[:, :, 2]).mean():.3f} px"
+        )
+
+
+def check_seeks(
+    path: str | pathlib.Path,
+    starts: list[int],
+    num_frames: int,
+    max_offset: int = 3,
+) -> dict[int, int | None]:
+    """
+    Checks that decoding the video at `path` with a seek to each of `starts`
+    (as segments are rendered) gives the same `num_frames` frames as decoding
+    it from the beginning (as tracking does). Returns for each start
+    the offset of the frames after the seek from the sequential ones:
+    0 if they match, the offset up to `max_offset` if they are shifted
+    and None if they don't match at all.
+    """
+    needed = {
+        idx
+        for start in starts
+        for idx in range(start - max_offset, start + num_frames + max_offset)
+    }
+    with video.FrameReader(path) as reader:
+        sequential = {
+            frame_idx: frame
+            for frame_idx, frame in enumerate(reader)
+            if frame_idx in needed
+        }
+
+    offsets = {}
+    for start in starts:
+        with video.FrameReader(
+            path, start=start, stop=start + num_frames
+        ) as reader:
+            seeked = list(reader)
+        offsets[start] = None
+        for offset in sorted(range(-max_offset, max_offset + 1), key=abs):
+            if all(
+                start + offset + k in sequential
+                and np.array_equal(frame, sequential[start + offset + k])
+                for k, frame in enumerate(seeked)
+            ):
+                offsets[start] = offset
+                break
+    return offsets
+
+
+def count_frames(path: str | pathlib.Path) -> int:
+    """Returns the number of frames of a video by decoding all of them."""
+    with video.FrameReader(path) as reader:
+        return sum(1 for _ in reader)
+
+
+def bench_render(args: argparse.Namespace) -> None:
+    """
+    Renders a video with the boxes of a saved track store (e.g. the tracks/
+    folder of a session) with different numbers of segment workers.
+    Also checks that the segments start on the frames they should, so that
+    their boxes aren't offset (see `check_seeks`), including the segments
+    of incremental renders, and that every render has as many frames as
+    the serial one.
+    """
+    tracks = track_store.TrackStore.load(args.tracks_dir)
+    params_dict = collections.defaultdict(video.PlayerParams)
+    keyframes = video.keyframe_indices(args.video, tracks.fps)
+    print(f"frames: {tracks.num_frames}, keyframes: {len(keyframes)}")
+
+    # Same as `video.draw_bboxes_incremental` with the default segments
+    num_incremental = max(1, round(tracks.num_frames / (2 * tracks.fps)))
+    starts = {
+        start
+        for num_segments in [*args.workers, num_incremental]
+        for start, _ in video.segment_bounds(
+            keyframes, tracks.num_frames, num_segments
+        )
+        if start > 0
+    }
+    offsets = check_seeks(args.video, sorted(starts), args.check_frames)
+    wrong = {start: off for start, off in offsets.items() if off != 0}
+    print(
+        f"segment starts checked: {len(offsets)}, "
+        f"offset or mismatched: {wrong if wrong else 'none'}"
+    )
+
+    base_secs = None
+    base_frames = None
+    with tempfile.TemporaryDirectory() as out_dir:
+        for num_workers in args.workers:
+            num_segments = len(
+                video.segment_bounds(keyframes, tracks.num_frames, num_workers)
+            )
+            out_path = pathlib.Path(out_dir) / f"annotated-{num_workers}.mp4"
+            start = time.perf_counter()
+            video.draw_bboxes(
+                args.video,
+                out_path,
+                tracks,
+                params_dict,
+                num_workers=num_workers,
+            )
+            secs = time.perf_counter() - start
+            base_secs = secs if base_secs is None else base_secs
+            num_frames = count_frames(out_path)
+            base_frames = num_frames if base_frames is None else base_frames
+            print(
+                f"{num_workers} workers ({num_segments} segments): "
+                f"{1000 * secs / tracks.num_frames:.2f} ms/frame "
+                f"(speedup {base_secs / secs:.2f}x), {num_frames} frames"
+                f"{'' if num_frames == base_frames else ' (MISMATCH)'}"
+            )
+
+
+def count_id_switches(
+    reference: track_store.TrackStore,
+    candidate: track_store.TrackStore,
+    min_iou: float = 0.5,
+) -> int:
+    """
+    Counts the id switches of `candidate` tracks of a video relative to
+    `reference` tracks of the same video, like in the CLEAR MOT metrics:
+    boxes of each frame are matched greedily by IoU, and a switch is counted
+    whenever a reference track is matched to another candidate id than
+    the last time.
+    """
+    last_match = {}
+    num_switches = 0
+    for (ref_ids, ref_boxes), (cand_ids, cand_boxes) in zip(
+        reference.iter_frames(), candidate.iter_frames()
+    ):
+        if len(ref_ids) == 0 or len(cand_ids) == 0:
+            continue
+        ious = torchvision.ops.box_iou(
+            torch.from_numpy(np.asarray(ref_boxes)),
+            torch.from_numpy(np.asarray(cand_boxes)),
+        ).numpy()
+        while ious.size and ious.max() >= min_iou:
+            ref_idx, cand_idx = np.unravel_index(ious.argmax(), ious.shape)
+            ref_id, cand_id = int(ref_ids[ref_idx]), int(cand_ids[cand_idx])
+            num_switches += last_match.get(ref_id, cand_id) != cand_id
+            last_match[ref_id] = cand_id
+            ious[ref_idx, :] = 0
+            ious[:, cand_idx] = 0
+    return num_switches
+
+
+def bench_sharded(args: argparse.Namespace) -> None:
+    """
+    Tracks a video serially and in different numbers of shards, and compares
+    the speed and the id switches of the stitched tracks with serial ones.
+    Caches are disabled (`max_bytes` 0) in this and the shard processes,
+    so every run detects and computes GMC from scratch.
+    Run from the server folder, so that the models can be found.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # Also seen by the shard processes, which import `tracking` anew
+        for name in ["DETECTION", "GMC"]:
+            os.environ[f"{name}_CACHE_DIR"] = str(
+                pathlib.Path(cache_dir) / name.lower()
+            )
+            os.environ[f"{name}_CACHE_MB"] = "0"
+        tracking.DETECTIONS = cache.DiskCache(
+            pathlib.Path(cache_dir) / "detection", 0
+        )
+        tracking.GMC_MATRICES = cache.DiskCache(
+            pathlib.Path(cache_dir) / "gmc", 0
+        )
+
+        start = time.perf_counter()
+        serial = tracking.track(
+            args.video,
+            tracking.DETECTORS[args.detector],
+            tracking.TRACKERS[args.tracker],
+            stride=args.stride,
+        )
+        serial_secs = time.perf_counter() - start
+        print(
+            f"frames: {serial.num_frames}, serial: "
+            f"{1000 * serial_secs / serial.num_frames:.2f} ms/frame, "
+            f"{len(serial.player_ids())} ids"
+        )
+
+        for num_shards in args.shards:
+            shards = sharding.shard_bounds(
+                serial.num_frames,
+                num_shards,
+                round(args.overlap_secs * serial.fps),
+            )
+            start = time.perf_counter()
+            tracks = sharding.track_sharded(
+                args.video,
+                args.detector,
+                args.tracker,
+                num_shards,
+                stride=args.stride,
+                overlap_secs=args.overlap_secs,
+            )
+            secs = time.perf_counter() - start
+            print(
+                f"{len(shards)} shards: "
+                f"{1000 * secs / tracks.num_frames:.2f} ms/frame "
+                f"(speedup {serial_secs / secs:.2f}x), "
+                f"{len(tracks.player_ids())} ids, "
+                f"{count_id_switches(serial, tracks)} id switches vs serial"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(required=True)
+
+    gmc_parser = subparsers.add_parser(
+        "gmc", help="RAFT GMC: frame by frame vs batched"
+    )
+    gmc_parser.add_argument("video")
+    gmc_parser.add_argument("--batch-size", type=int, default=8)
+    gmc_parser.add_argument(
+        "--model-size", choices=["small", "large"], default="small"
+    )
+    gmc_parser.add_argument("--image-size", type=int, default=128)
+    gmc_parser.add_argument("--num-flow-updates", type=int, default=1)
+    gmc_parser.set_defaults(func=bench_gmc)
+
+    sparse_parser = subparsers.add_parser(
+        "sparse-gmc", help="sparse optical flow GMC: stock vs persistent"
+    )
+    sparse_parser.add_argument("video")
+    sparse_parser.add_argument("--downscale", type=int, default=2)
+    sparse_parser.add_argument(
+        "--detector",
+        choices=list(tracking.DETECTORS.keys()),
+        help="mask detections of this detector (run from the server folder)",
+    )
+    sparse_parser.set_defaults(func=bench_sparse_gmc)
+
+    adaptive_parser = subparsers.add_parser(
+        "adaptive-gmc", help="GMC of a tracker: always run vs motion-gated"
+    )
+    adaptive_parser.add_argument("video")
+    adaptive_parser.add_argument(
+        "--tracker", choices=list(tracking.TRACKERS.keys()), default="spofl-2x"
+    )
+    adaptive_parser.add_argument("--budget-ms", type=float)
+    adaptive_parser.set_defaults(func=bench_adaptive_gmc)
+
+    pipeline_parser = subparsers.add_parser(
+        "pipeline", help="tracking pipeline: stage utilisation, queue depths"
+    )
+    pipeline_parser.add_argument("video")
+    pipeline_parser.add_argument(
+        "--detector", choices=list(tracking.DETECTORS.keys()), required=True
+    )
+    pipeline_parser.add_argument(
+        "--tracker", choices=list(tracking.TRACKERS.keys()), default="spofl-2x"
+    )
+    pipeline_parser.add_argument("--batch-size", type=int, default=8)
+    pipeline_parser.add_argument("--stride", type=int, default=1)
+    pipeline_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always run the detector and the GMC",
+    )
+    pipeline_parser.set_defaults(func=bench_pipeline)
+
+    detectors_parser = subparsers.add_parser(
+        "detector-backends",
+        help="detectors: latency and agreement with the first one",
+    )
+    detectors_parser.add_argument("video")
+    detectors_parser.add_argument(
+        "detectors", nargs="+", choices=list(tracking.DETECTORS.keys())
+    )
+    detectors_parser.add_argument(
+        "--min-conf",
+        type=float,
+        default=0.25,
+        help="ignore detections with lower confidence",
+    )
+    detectors_parser.set_defaults(func=bench_detector_backends)
+
+    gmc_backends_parser = subparsers.add_parser(
+        "gmc-backends",
+        help="GMCs of trackers: latency and difference from the first one",
+    )
+    gmc_backends_parser.add_argument("video")
+    gmc_backends_parser.add_argument(
+        "trackers", nargs="+", choices=list(tracking.TRACKERS.keys())
+    )
+    gmc_backends_parser.set_defaults(func=bench_gmc_backends)
+
+    render_parser = subparsers.add_parser(
+        "render", help="annotated video: scaling with the number of workers"
+    )
+    render_parser.add_argument("video")
+    render_parser.add_argument("tracks_dir")
+    render_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[1, 2, 4, 8]
+    )
+    render_parser.add_argument(
+        "--check-frames",
+        type=int,
+        default=5,
+        help="frames compared after each seek to a segment start",
+    )
+    render_parser.set_defaults(func=bench_render)
+
+    sharded_parser = subparsers.add_parser(
+        "sharded", help="sharded tracking: speedup and id switches vs serial"
+    )
+    sharded_parser.add_argument("video")
+    sharded_parser.add_argument(
+        "--shards", type=int, nargs="+", default=[2, 4, 8]
+    )
+    sharded_parser.add_argument(
+        "--overlap-secs", type=float, default=sharding.OVERLAP_SECS
+    )
+    sharded_parser.add_argument(
+        "--detector", choices=list(tracking.DETECTORS.keys()), required=True
+    )
+    sharded_parser.add_argument(
+        "--tracker", choices=list(tracking.TRACKERS.keys()), default="spofl-2x"
+    )
+    sharded_parser.add_argument("--stride", type=int, default=1)
+    sharded_parser.set_defaults(func=bench_sharded)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
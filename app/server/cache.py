@@ -0,0 +1,99 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import typing as tp
+
+import numpy as np
+
+
+@dataclasses.dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
+def file_digest(path: str | pathlib.Path) -> str:
+    """Returns the SHA-256 hash of the contents of the file at `path`."""
+    with open(path, "rb") as fin:
+        return hashlib.file_digest(fin, "sha256").hexdigest()
+
+
+def make_key(*parts: tp.Any) -> str:
+    """Combines JSON-serializable `parts` into a cache key."""
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+class DiskCache:
+    """
+    Stores dicts of NumPy arrays on disk as .npz files, one file per key.
+
+    The directory can be shared by several processes: files are written
+    atomically and the modification time of a file is its last access time.
+    When the total size of the files exceeds `max_bytes`,
+    the least recently used ones are deleted. With `max_bytes` 0, the cache
+    is disabled: nothing is saved, so every lookup misses.
+    """
+
+    def __init__(self, root: pathlib.Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> pathlib.Path:
+        return self.root / f"{key}.npz"
+
+    def load(self, key: str) -> dict[str, np.ndarray] | None:
+        """Returns the arrays saved under `key`, or None if there are none."""
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = dict(data)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            self.stats.misses += 1
+            return None
+        self.stats.hits += 1
+        return arrays
+
+    def save(self, key: str, arrays: dict[str, np.ndarray]) -> None:
+        """Saves `arrays` under `key` and evicts old entries if needed."""
+        if self.max_bytes == 0:
+            return
+        path = self.path(key)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as fout:
+            np.savez(fout, **arrays)
+        os.replace(tmp_path, path)
+        self._evict(keep=path)
+
+    def size_bytes(self) -> int:
+        """Returns the total size of the cached files."""
+        return sum(path.stat().st_size for path in self.root.glob("*.npz"))
+
+    def _evict(self, keep: pathlib.Path) -> None:
+        """Deletes LRU files until they fit in `max_bytes`, except `keep`."""
+        files = []
+        for path in self.root.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # Evicted by another process
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+            self.stats.evictions += 1
+            logging.info(f"Evicted {path.name} from cache {self.root}")
@@ -0,0 +1,315 @@
+"""
+Exports models for CPU inference with ONNX Runtime or OpenVINO, optionally
+quantized to INT8 using frames of a video for calibration:
+
+    python export.py detector SLUG --backend onnx [--int8 --calibration VIDEO]
+    python export.py raft --backend openvino [--int8 --calibration VIDEO]
+
+Run from the server folder: the models are saved to models/, where the
+exported entries of `tracking.DETECTORS` and `tracking.TRACKERS` expect them.
+"""
+
+import argparse
+import pathlib
+import shutil
+
+import cv2
+import nncf
+import numpy as np
+import onnxruntime.quantization
+import openvino
+import torch
+import torchvision
+import ultralytics.data.augment
+
+import gmc
+import tracking
+
+
+def calibration_clips(
+    video_path: str, num_clips: int, clip_length: int = 1
+) -> list[list[np.ndarray]]:
+    """
+    Returns `num_clips` clips of `clip_length` consecutive BGR frames
+    evenly spread over the video at `video_path`.
+    """
+    capture = cv2.VideoCapture(video_path)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    starts = set(
+        np.linspace(0, max(num_frames - clip_length, 0), num_clips)
+        .round()
+        .astype(int)
+        .tolist()
+    )
+    clips = []
+    for frame_idx in range(num_frames):
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if frame_idx in starts:
+            clips.append([])
+        if clips and len(clips[-1]) < clip_length:
+            clips[-1].append(frame)
+    capture.release()
+    return [clip for clip in clips if len(clip) == clip_length]
+
+
+def quantize_onnx(
+    fp32_path: pathlib.Path,
+    int8_path: pathlib.Path,
+    inputs: list[dict[str, np.ndarray]],
+) -> None:
+    """
+    Quantizes the convolutions of an ONNX model to INT8 with ONNX Runtime,
+    calibrating the activations on `inputs`. Other operations (e.g. decoding
+    of the boxes) stay in FP32.
+    """
+
+    # pylint: disable=too-few-public-methods
+    class Reader(onnxruntime.quantization.CalibrationDataReader):
+        def __init__(self) -> None:
+            self.inputs = iter(inputs)
+
+        def get_next(self) -> dict[str, np.ndarray] | None:
+            return next(self.inputs, None)
+
+    preprocessed_path = int8_path.with_suffix(".preprocessed.onnx")
+    onnxruntime.quantization.quant_pre_process(
+        fp32_path, preprocessed_path, skip_symbolic_shape=True
+    )
+    onnxruntime.quantization.quantize_static(
+        preprocessed_path,
+        int8_path,
+        Reader(),
+        quant_format=onnxruntime.quantization.QuantFormat.QDQ,
+        per_channel=True,
+        op_types_to_quantize=["Conv"],
+    )
+    preprocessed_path.unlink()
+
+
+def quantize_openvino(
+    fp32_dir: pathlib.Path,
+    int8_dir: pathlib.Path,
+    inputs: list[np.ndarray] | list[dict[str, np.ndarray]],
+    ignored_scope: nncf.IgnoredScope | None = None,
+) -> None:
+    """
+    Quantizes an OpenVINO model to INT8 with NNCF, calibrating the activations
+    on `inputs` (arrays for models with one input, dicts by input name
+    otherwise). The metadata of `ultralytics` is copied along with it.
+    """
+    model = openvino.Core().read_model(next(fp32_dir.glob("*.xml")))
+    quantized = nncf.quantize(
+        model,
+        nncf.Dataset(inputs),
+        preset=nncf.QuantizationPreset.MIXED,
+        subset_size=len(inputs),
+        ignored_scope=ignored_scope,
+    )
+    int8_dir.mkdir(exist_ok=True)
+    name = int8_dir.name.removesuffix("_openvino_model")
+    openvino.save_model(
+        quantized, int8_dir / f"{name}.xml", compress_to_fp16=False
+    )
+    if (fp32_dir / "metadata.yaml").exists():
+        shutil.copy(fp32_dir / "metadata.yaml", int8_dir)
+
+
+def export_detector(
+    slug: str, backend: str, int8: bool, frames: list[np.ndarray]
+) -> str:
+    """
+    Exports the detector `slug` with dynamic input shapes, so that frames
+    can be detected in batches. If `int8` is set, it's also quantized
+    using `frames` for calibration. Returns the path of the exported model.
+    """
+    detector = tracking.DETECTORS[slug]
+    model = detector.model_class(detector.weights_path)
+    imgsz = model.model.args["imgsz"]
+    fp32_path = pathlib.Path(
+        model.export(format=backend, imgsz=imgsz, dynamic=True)
+    )
+    if not int8:
+        return str(fp32_path)
+
+    # The same preprocessing as in `ultralytics` for exported models
+    letterbox = ultralytics.data.augment.LetterBox((imgsz, imgsz), auto=False)
+    images = [
+        np.ascontiguousarray(
+            letterbox(image=frame)[None, :, :, ::-1].transpose(0, 3, 1, 2),
+            dtype=np.float32,
+        )
+        / 255
+        for frame in frames
+    ]
+    int8_path = pathlib.Path(
+        tracking.exported_path(detector.weights_path, backend, int8=True)
+    )
+    if backend == "onnx":
+        quantize_onnx(fp32_path, int8_path, [{"images": x} for x in images])
+    else:
+        # Keeps the decoding of the boxes in FP32, like `ultralytics` does
+        head = ".".join(
+            list(model.model.named_modules())[-1][0].split(".")[:2]
+        )
+        ignored_scope = nncf.IgnoredScope(
+            patterns=[
+                f".*{head}/.*/Add",
+                f".*{head}/.*/Sub*",
+                f".*{head}/.*/Mul*",
+                f".*{head}/.*/Div*",
+                f".*{head}\\.dfl.*",
+            ],
+            types=["Sigmoid"],
+            validate=False,
+        )
+        quantize_openvino(fp32_path, int8_path, images, ignored_scope)
+    return str(int8_path)
+
+
+class RaftFlow(torch.nn.Module):
+    """RAFT returning only the flow after the last update, for export."""
+
+    def __init__(self, raft: gmc.RaftGMC) -> None:
+        super().__init__()
+        self.model = raft.model
+        self.num_flow_updates = raft.num_flow_updates
+
+    def forward(
+        self, frame1: torch.Tensor, frame2: torch.Tensor
+    ) -> torch.Tensor:
+        flows = self.model(
+            frame1, frame2, num_flow_updates=self.num_flow_updates
+        )
+        return flows[-1]
+
+
+def export_raft(
+    backend: str,
+    int8: bool,
+    clips: list[list[np.ndarray]],
+    image_size: int,
+    num_flow_updates: int,
+) -> str:
+    """
+    Exports RAFT-small for `gmc.ExportedRaftGMC` with dynamic input shapes.
+    If `int8` is set, it's also quantized using pairs of consecutive frames
+    (`clips`) for calibration.
+    Returns the path of the exported model.
+    """
+    torchvision.models.optical_flow.raft.upsample_flow = gmc.scale_raft_flow
+    raft = gmc.BatchedRaftGMC("small", image_size, num_flow_updates)
+    raft.model.cpu()
+    inputs = []
+    for clip in clips:
+        frames = raft.downsize(np.stack(clip))
+        frame1, frame2 = raft.transforms(frames[:-1], frames[1:])
+        inputs.append({"frame1": frame1.numpy(), "frame2": frame2.numpy()})
+
+    onnx_path = pathlib.Path(
+        tracking.exported_path(tracking.RAFT_EXPORT_STEM, "onnx", int8=False)
+    )
+    example = torch.zeros(1, 3, image_size, 2 * image_size)
+    dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+    torch.onnx.export(
+        RaftFlow(raft).eval(),
+        (example, example),
+        onnx_path,
+        input_names=["frame1", "frame2"],
+        output_names=["flow"],
+        dynamic_axes={
+            "frame1": dynamic_axes,
+            "frame2": dynamic_axes,
+            "flow": dynamic_axes,
+        },
+        opset_version=17,
+        dynamo=False,
+    )
+
+    path = pathlib.Path(
+        tracking.exported_path(tracking.RAFT_EXPORT_STEM, backend, int8)
+    )
+    if backend == "onnx":
+        if int8:
+            quantize_onnx(onnx_path, path, inputs)
+        return str(path)
+
+    fp32_dir = pathlib.Path(
+        tracking.exported_path(tracking.RAFT_EXPORT_STEM, backend, int8=False)
+    )
+    fp32_dir.mkdir(exist_ok=True)
+    openvino.save_model(
+        openvino.Core().read_model(onnx_path),
+        fp32_dir / f"{pathlib.Path(tracking.RAFT_EXPORT_STEM).name}.xml",
+        compress_to_fp16=False,
+    )
+    if int8:
+        quantize_openvino(fp32_dir, path, inputs)
+    return str(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="model", required=True)
+
+    detector_parser = subparsers.add_parser(
+        "detector", help="YOLO or RT-DETR detector"
+    )
+    detector_parser.add_argument(
+        "slug",
+        choices=[
+            slug
+            for slug, detector in tracking.DETECTORS.items()
+            if detector.weights_path.endswith(".pt")
+        ],
+    )
+    raft_parser = subparsers.add_parser("raft", help="RAFT-small GMC")
+    raft_parser.add_argument("--image-size", type=int, default=128)
+    raft_parser.add_argument("--num-flow-updates", type=int, default=1)
+
+    for subparser in [detector_parser, raft_parser]:
+        subparser.add_argument(
+            "--backend", choices=list(tracking.BACKENDS.keys()), required=True
+        )
+        subparser.add_argument("--int8", action="store_true")
+        subparser.add_argument(
+            "--calibration", help="video for INT8 calibration"
+        )
+        subparser.add_argument(
+            "--num-frames",
+            type=int,
+            default=300,
+            help="number of calibration frames (pairs for RAFT)",
+        )
+
+    args = parser.parse_args()
+    if args.int8 and args.calibration is None:
+        parser.error("--int8 requires --calibration")
+    clip_length = 1 if args.model == "detector" else 2
+    clips = []
+    if args.calibration is not None:
+        clips = calibration_clips(
+            args.calibration, args.num_frames, clip_length
+        )
+
+    if args.model == "detector":
+        path = export_detector(
+            args.slug,
+            args.backend,
+            args.int8,
+            [frame for frame, in clips],
+        )
+    else:
+        path = export_raft(
+            args.backend,
+            args.int8,
+            clips,
+            args.image_size,
+            args.num_flow_updates,
+        )
+    print(f"Exported to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,596 @@
+import collections
+import pathlib
+import time
+import typing as tp
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+import torchvision.transforms.functional as F
+
+import video
+
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class GMC(tp.Protocol):
+    """
+    The minimal interface required to replace
+    the stock `ultralytics.trackers.utils.gmc.GMC` class
+    to implement a new GMC method within BoT-SORT.
+    """
+
+    def apply(self, raw_frame: np.ndarray, detections: list) -> np.ndarray:
+        """
+        `raw_frame`: frame with shape [H, W, C].
+        `detections`: list of detections for this frame.
+        Returns a 2x3 homography matrix.
+        """
+
+    def reset_params(self) -> None:
+        """Resets all internal parameters (e.g. last seen frame)."""
+
+
+class RaftGMC:
+    def __init__(
+        self,
+        model_size: str = "small",
+        image_size: int = 128,
+        num_flow_updates: int = 1,
+    ) -> None:
+        if model_size == "small":
+            wgts = torchvision.models.optical_flow.Raft_Small_Weights.DEFAULT
+            self.model = torchvision.models.optical_flow.raft_small(
+                weights=wgts
+            )
+        elif model_size == "large":
+            wgts = torchvision.models.optical_flow.Raft_Large_Weights.DEFAULT
+            self.model = torchvision.models.optical_flow.raft_large(
+                weights=wgts
+            )
+        else:
+            raise ValueError
+
+        self.model = self.model.to(DEVICE).eval()
+        self.transforms = wgts.transforms()
+        self.image_size = image_size
+        self.num_flow_updates = num_flow_updates
+        self.last_frame = None
+
+    def apply(
+        self,
+        raw_frame: np.ndarray,
+        detections: list = None,  # pylint: disable=unused-argument
+    ) -> np.ndarray:
+        """
+        `raw_frame`: frame with shape [H, W, C].
+        `detections`: unused for RAFT.
+        Returns a 2x3 homography matrix.
+        """
+        raw_frame = torch.tensor(raw_frame)
+        raw_frame = raw_frame.permute(2, 0, 1)[None, :]  # [1, C, H, W]
+        raw_frame = raw_frame[:, :, :, 10:-10]
+
+        scale_factor = raw_frame.shape[2] / self.image_size
+        raw_frame = F.resize(
+            raw_frame, size=self.image_size, antialias=False
+        )  # [1, C, h, w]
+
+        if self.last_frame is None:
+            self.last_frame = raw_frame
+            return np.eye(2, 3)
+
+        frame1, frame2 = self.transforms(self.last_frame, raw_frame)
+        flow = self.flow(frame1, frame2)  # [1, 2, h/8, w/8]
+
+        medians = flow.reshape(2, -1).median(dim=1).values  # [2]
+        medians = medians.cpu().numpy()
+        hom = np.eye(2, 3)
+        hom[:, 2] = medians * scale_factor
+
+        self.last_frame = raw_frame
+        return hom
+
+    def flow(self, frame1: torch.Tensor, frame2: torch.Tensor) -> torch.Tensor:
+        """
+        `frame1`, `frame2`: transformed frames with shape [B, C, h, w].
+        Returns the flow after the last update with shape [B, 2, h/8, w/8].
+        """
+        flows = self.model(  # list[num_flow_updates] of [B, 2, h/8, w/8]
+            frame1.to(DEVICE),
+            frame2.to(DEVICE),
+            num_flow_updates=self.num_flow_updates,
+        )
+        return flows[-1]
+
+    def reset_params(self) -> None:
+        """Forgets the last seen frame before tracking a new clip."""
+        self.last_frame = None
+
+
+def scale_raft_flow(flow: torch.Tensor, **_) -> torch.Tensor:
+    """
+    Scales a tensor by a factor of 8.
+    Used to replace the upscaling function in the torchvision RAFT model
+    (`torchvision.models.optical_flow.raft.upsample_flow`),
+    since we don't need upscaling for this task.
+    """
+    return flow * 8
+
+
+class BatchedRaftGMC(RaftGMC):
+    """
+    Same as `RaftGMC`, but can compute the matrices of a whole video at once
+    (`compute_all`): frames are decoded ahead in a background thread,
+    downsized in batches and RAFT runs on `batch_size` frame pairs
+    per forward pass. Everything runs in inference mode.
+    """
+
+    def __init__(
+        self,
+        model_size: str = "small",
+        image_size: int = 128,
+        num_flow_updates: int = 1,
+        batch_size: int = 8,
+    ) -> None:
+        super().__init__(model_size, image_size, num_flow_updates)
+        self.batch_size = batch_size
+
+    def apply(
+        self,
+        raw_frame: np.ndarray,
+        detections: list = None,
+    ) -> np.ndarray:
+        """Same as `RaftGMC.apply`, but in inference mode."""
+        with torch.inference_mode():
+            return super().apply(raw_frame, detections)
+
+    def downsize(self, raw_frames: np.ndarray) -> torch.Tensor:
+        """
+        `raw_frames`: frames with shape [B, H, W, C].
+        Returns the frames prepared like in `apply`, with shape [B, C, h, w].
+        """
+        frames = torch.from_numpy(raw_frames).permute(0, 3, 1, 2)
+        return F.resize(
+            frames[:, :, :, 10:-10], size=self.image_size, antialias=False
+        )
+
+    @torch.inference_mode()
+    def flow_medians(self, frames: torch.Tensor) -> np.ndarray:
+        """
+        `frames`: downsized frames with shape [B + 1, C, h, w].
+        Returns the median flow between each pair of consecutive frames
+        with shape [B, 2].
+        """
+        frame1, frame2 = self.transforms(frames[:-1], frames[1:])
+        flow = self.flow(frame1, frame2)
+        return flow.flatten(start_dim=2).median(dim=2).values.cpu().numpy()
+
+    def compute_all(
+        self,
+        source: str | pathlib.Path,
+        progress: tp.Callable[[int], None] | None = None,
+    ) -> np.ndarray:
+        """
+        Returns the [N, 2, 3] matrices between each frame of `source`
+        and the previous one (the identity for the first frame),
+        the same as calling `apply` on each frame.
+        `progress` is called with the number of processed frames.
+        """
+        matrices = [np.eye(2, 3)]
+        raw_frames = None  # [batch_size, H, W, C], reused for all batches
+        last_frame = None  # Downsized last frame of the previous batch
+        num_queued = 0
+
+        def process_batch() -> None:
+            nonlocal last_frame
+            frames = self.downsize(raw_frames[:num_queued])
+            if last_frame is not None:
+                frames = torch.cat([last_frame, frames])
+            last_frame = frames[-1:]
+            if len(frames) < 2:
+                return
+
+            scale_factor = raw_frames.shape[1] / self.image_size
+            for medians in self.flow_medians(frames):
+                hom = np.eye(2, 3)
+                hom[:, 2] = medians * scale_factor
+                matrices.append(hom)
+            if progress is not None:
+                progress(len(matrices))
+
+        with video.FrameReader(
+            source, max_queued=2 * self.batch_size
+        ) as reader:
+            for raw_frame in reader:
+                if raw_frames is None:
+                    raw_frames = np.empty(
+                        (self.batch_size, *raw_frame.shape), dtype=np.uint8
+                    )
+                raw_frames[num_queued] = raw_frame
+                num_queued += 1
+                if num_queued == self.batch_size:
+                    process_batch()
+                    num_queued = 0
+        if raw_frames is None:  # Empty video
+            return np.empty((0, 2, 3))
+        if num_queued > 0:
+            process_batch()
+        return np.array(matrices)
+
+
+class ExportedRaftGMC(BatchedRaftGMC):
+    """
+    Same as `BatchedRaftGMC`, but RAFT-small runs as a graph exported by
+    `export.py` (with the number of flow updates fixed at export) on the CPU:
+    with ONNX Runtime if `model_path` is an .onnx file, otherwise with OpenVINO
+    from a directory with an .xml file. The graph may be INT8-quantized.
+    """
+
+    def __init__(
+        self,
+        model_path: str | pathlib.Path,
+        image_size: int = 128,
+        batch_size: int = 8,
+    ) -> None:
+        # pylint: disable=super-init-not-called
+        model_path = pathlib.Path(model_path)
+        if not model_path.exists():
+            raise FileNotFoundError(f"{model_path} not found, run export.py")
+        wgts = torchvision.models.optical_flow.Raft_Small_Weights.DEFAULT
+        self.transforms = wgts.transforms()
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.last_frame = None
+
+        # The runtimes are imported here, so that the server doesn't need
+        # the one that isn't used (or either of them, without exported GMCs)
+        num_threads = torch.get_num_threads()
+        if model_path.suffix == ".onnx":
+            import onnxruntime  # pylint: disable=import-outside-toplevel
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = num_threads
+            session = onnxruntime.InferenceSession(
+                model_path, options, providers=["CPUExecutionProvider"]
+            )
+            self.run = lambda inputs: session.run(None, inputs)[0]
+        else:
+            import openvino  # pylint: disable=import-outside-toplevel
+
+            core = openvino.Core()
+            core.set_property("CPU", {"INFERENCE_NUM_THREADS": num_threads})
+            compiled = core.compile_model(
+                next(model_path.glob("*.xml")), "CPU"
+            )
+            self.run = lambda inputs: compiled(inputs)[0]
+
+    def flow(self, frame1: torch.Tensor, frame2: torch.Tensor) -> torch.Tensor:
+        """Same as `RaftGMC.flow`, but runs the exported graph."""
+        return torch.from_numpy(
+            self.run(
+                {
+                    "frame1": frame1.contiguous().numpy(),
+                    "frame2": frame2.contiguous().numpy(),
+                }
+            )
+        )
+
+
+def estimate_partial_affine(
+    src: np.ndarray, dst: np.ndarray, num_iters: int = 3, min_error: float = 1
+) -> tuple[np.ndarray, np.ndarray] | None:
+    """
+    Fits a 2x3 matrix of rotation, uniform scale and translation mapping
+    points `src` to `dst` (both [N, 2]) by least squares. Before the first
+    fit and after each of `num_iters` fits, points with errors above
+    3 medians (but at least `min_error`) are dropped as outliers. The first
+    errors are the distances from the median displacement of all points.
+    Returns the matrix and the inlier mask, or None if there are too few
+    points.
+    """
+    if len(src) < 3:
+        return None
+    shifts = dst - src
+    errors = np.linalg.norm(shifts - np.median(shifts, axis=0), axis=1)
+    inliers = errors <= max(min_error, 3 * np.median(errors))
+
+    hom = None
+    for _ in range(num_iters):
+        if inliers.sum() < 3:
+            return None
+        x, y = src[inliers].T
+        ones, zeros = np.ones_like(x), np.zeros_like(x)
+        # Each point gives two equations:
+        # a*x - b*y + tx = x', b*x + a*y + ty = y'
+        coefs = np.stack(
+            [
+                np.stack([x, -y, ones, zeros], axis=1),
+                np.stack([y, x, zeros, ones], axis=1),
+            ],
+            axis=1,
+        ).reshape(-1, 4)
+        (a, b, tx, ty), *_ = np.linalg.lstsq(
+            coefs, dst[inliers].reshape(-1), rcond=None
+        )
+        hom = np.array([[a, -b, tx], [b, a, ty]])
+
+        errors = np.linalg.norm(src @ hom[:, :2].T + hom[:, 2] - dst, axis=1)
+        inliers = errors <= max(min_error, 3 * np.median(errors[inliers]))
+    return hom, inliers
+
+
+class PersistentSparseFlowGMC:
+    """
+    Sparse optical flow GMC. Unlike the stock `sparseOptFlow` method,
+    it keeps tracking the same features across frames and only looks for
+    new ones when fewer than `min_points` are left, and it never picks
+    features inside detection boxes (enlarged by `box_margin` of their size),
+    since players move independently of the camera.
+    Features that don't follow the estimated camera motion are dropped.
+    """
+
+    def __init__(
+        self,
+        downscale: int = 2,
+        max_corners: int = 500,
+        min_points: int = 150,
+        box_margin: float = 0.1,
+    ) -> None:
+        self.downscale = downscale
+        self.max_corners = max_corners
+        self.min_points = min_points
+        self.box_margin = box_margin
+        self.last_frame = None
+        self.points = np.empty((0, 1, 2), dtype=np.float32)
+
+    def feature_mask(
+        self, frame: np.ndarray, detections: np.ndarray | None
+    ) -> np.ndarray:
+        """
+        Returns a mask of the pixels of `frame` where new features can be
+        picked: outside of the detection boxes and away from current features.
+        """
+        mask = np.full(frame.shape, 255, dtype=np.uint8)
+        if detections is not None and len(detections) > 0:
+            # Detections are [x_center, y_center, w, h, index] in full size
+            xywh = np.asarray(detections)[:, :4] / self.downscale
+            half_sizes = xywh[:, 2:] * (0.5 + self.box_margin)
+            x1y1 = np.floor(xywh[:, :2] - half_sizes).clip(min=0).astype(int)
+            x2y2 = np.ceil(xywh[:, :2] + half_sizes).astype(int)
+            for (x1, y1), (x2, y2) in zip(x1y1, x2y2):
+                mask[y1:y2, x1:x2] = 0
+
+        if len(self.points) > 0:
+            xy = self.points.reshape(-1, 2).round().astype(int)
+            inside = (
+                (xy[:, 0] >= 0)
+                & (xy[:, 0] < frame.shape[1])
+                & (xy[:, 1] >= 0)
+                & (xy[:, 1] < frame.shape[0])
+            )
+            mask[xy[inside, 1], xy[inside, 0]] = 0
+            mask = cv2.erode(mask, np.ones((3, 3), dtype=np.uint8))
+        return mask
+
+    def add_features(
+        self, frame: np.ndarray, detections: np.ndarray | None
+    ) -> None:
+        """Adds new features from `frame` up to `max_corners` in total."""
+        new_points = cv2.goodFeaturesToTrack(
+            frame,
+            maxCorners=self.max_corners - len(self.points),
+            qualityLevel=0.01,
+            minDistance=1,
+            blockSize=3,
+            mask=self.feature_mask(frame, detections),
+        )
+        if new_points is not None:
+            self.points = np.concatenate([self.points, new_points])
+
+    def apply(
+        self, raw_frame: np.ndarray, detections: np.ndarray | None = None
+    ) -> np.ndarray:
+        """
+        `raw_frame`: frame with shape [H, W, C].
+        `detections`: detections for this frame from BoT-SORT
+        (center x, center y, width, height, index).
+        Returns a 2x3 homography matrix.
+        """
+        height, width = raw_frame.shape[:2]
+        frame = cv2.resize(
+            cv2.cvtColor(raw_frame, cv2.COLOR_BGR2GRAY),
+            (width // self.downscale, height // self.downscale),
+        )
+        hom = np.eye(2, 3)
+
+        if self.last_frame is not None and len(self.points) > 0:
+            next_points, status, _ = cv2.calcOpticalFlowPyrLK(
+                self.last_frame, frame, self.points, None
+            )
+            found = status.ravel() == 1
+            src = self.points[found].reshape(-1, 2)
+            dst = next_points[found].reshape(-1, 2)
+
+            fit = estimate_partial_affine(src, dst)
+            if fit is not None:
+                hom, inliers = fit
+                hom[:, 2] *= self.downscale
+                dst = dst[inliers]
+            self.points = dst.reshape(-1, 1, 2)
+
+        if len(self.points) < self.min_points:
+            self.add_features(frame, detections)
+        self.last_frame = frame
+        return hom
+
+    def reset_params(self) -> None:
+        """Forgets the last seen frame and its features."""
+        self.last_frame = None
+        self.points = np.empty((0, 1, 2), dtype=np.float32)
+
+
+class AdaptiveGMC:
+    """
+    Wraps another GMC and runs it only when the camera moves.
+
+    Each frame is first compared with the previous one by phase correlation
+    on a small grayscale copy (`gate_width` pixels wide), which is much
+    cheaper than optical flow. Then one of the paths is taken:
+      - "static": the shift is below `static_shift` pixels of the small copy
+        and the correlation is reliable, so the identity is returned,
+      - "phase": the camera moves, but the wrapped GMC has already spent
+        more than `budget_ms` per frame on average in this clip, so the shift
+        found by phase correlation is returned,
+      - "full": otherwise the wrapped GMC is run.
+    `path_counts` holds the number of frames that took each path in the clip.
+    """
+
+    def __init__(
+        self,
+        inner_class: type[GMC],
+        inner_args: dict[str, tp.Any],
+        gate_width: int = 160,
+        static_shift: float = 0.1,
+        min_response: float = 0.3,
+        budget_ms: float | None = None,
+    ) -> None:
+        self.inner = inner_class(**inner_args)
+        self.gate_width = gate_width
+        self.static_shift = static_shift
+        self.min_response = min_response
+        self.budget_ms = budget_ms
+        self.reset_params()
+
+    def reset_params(self) -> None:
+        """Resets the wrapped GMC and the counters before a new clip."""
+        self.inner.reset_params()
+        self.inner_stale = False
+        self.last_gate = None
+        self.window = None
+        self.inner_secs = 0.0
+        self.path_counts = collections.Counter()
+
+    def gate_frame(self, raw_frame: np.ndarray) -> np.ndarray:
+        """Returns the small grayscale copy of a frame used for gating."""
+        height, width = raw_frame.shape[:2]
+        gate_height = max(1, round(height * self.gate_width / width))
+        gray = cv2.cvtColor(raw_frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(
+            gray, (self.gate_width, gate_height), interpolation=cv2.INTER_AREA
+        ).astype(np.float32)
+
+    def apply(
+        self, raw_frame: np.ndarray, detections: list = None
+    ) -> np.ndarray:
+        """
+        `raw_frame`: frame with shape [H, W, C].
+        `detections`: passed on to the wrapped GMC.
+        Returns a 2x3 homography matrix.
+        """
+        gate = self.gate_frame(raw_frame)
+        last_gate, self.last_gate = self.last_gate, gate
+        if last_gate is None:
+            self.path_counts["full"] += 1
+            return self.inner.apply(raw_frame, detections)
+
+        if self.window is None:
+            self.window = cv2.createHanningWindow(gate.shape[::-1], cv2.CV_32F)
+        (shift_x, shift_y), response = cv2.phaseCorrelate(
+            last_gate, gate, self.window
+        )
+        scale = raw_frame.shape[1] / self.gate_width
+        phase_hom = np.eye(2, 3)
+        phase_hom[:, 2] = [shift_x * scale, shift_y * scale]
+
+        num_frames = sum(self.path_counts.values())
+        over_budget = (
+            self.budget_ms is not None
+            and 1000 * self.inner_secs > self.budget_ms * num_frames
+        )
+        if (
+            np.hypot(shift_x, shift_y) < self.static_shift
+            and response >= self.min_response
+        ):
+            self.path_counts["static"] += 1
+            self.inner_stale = True
+            return np.eye(2, 3)
+        if over_budget:
+            self.path_counts["phase"] += 1
+            self.inner_stale = True
+            return phase_hom
+
+        self.path_counts["full"] += 1
+        start = time.perf_counter()
+        if self.inner_stale:
+            # The wrapped GMC hasn't seen the previous frames, so it only
+            # remembers this frame, and phase correlation is used for it
+            self.inner.reset_params()
+            self.inner.apply(raw_frame, detections)
+            self.inner_stale = False
+            hom = phase_hom
+        else:
+            hom = self.inner.apply(raw_frame, detections)
+        self.inner_secs += time.perf_counter() - start
+        return hom
+
+
+def to_3x3(hom: np.ndarray) -> np.ndarray:
+    """Converts a 2x3 homography matrix to a 3x3 one."""
+    return np.vstack([hom, [0, 0, 1]])
+
+
+class CachedGMC:
+    """
+    Wraps a GMC that doesn't use detections, so its matrices depend only on
+    the frames, and lets them be saved and reused for the same video.
+
+    `observe` must be called with every frame of the video before `apply`.
+    It runs `inner` on the frame, or takes the matrix from `matrices` if they
+    are given, and accumulates the motion since the last `apply` call.
+    BoT-SORT only calls `apply` on frames with detections, so the matrices of
+    the frames in between are composed, which makes them independent of the
+    detector. The computed matrices are returned by `matrices`.
+    """
+
+    def __init__(self, inner: GMC, matrices: np.ndarray | None = None) -> None:
+        self.inner = inner
+        self.cached = matrices
+        self.computed = []
+        self.num_frames = 0
+        self.motion = None
+
+    def observe(self, raw_frame: np.ndarray) -> None:
+        """Processes the next frame of the video."""
+        if self.cached is not None:
+            hom = self.cached[self.num_frames]
+        else:
+            hom = self.inner.apply(raw_frame, [])
+            self.computed.append(hom)
+        self.num_frames += 1
+
+        if self.motion is not None:
+            self.motion = to_3x3(hom) @ self.motion
+
+    def apply(
+        self,
+        raw_frame: np.ndarray,  # pylint: disable=unused-argument
+        detections: list = None,  # pylint: disable=unused-argument
+    ) -> np.ndarray:
+        """
+        Returns a 2x3 homography matrix of the motion since the last call,
+        or the identity on the first call. The frame must be observed first.
+        """
+        hom = np.eye(2, 3) if self.motion is None else self.motion[:2]
+        self.motion = np.eye(3)
+        return hom
+
+    def reset_params(self) -> None:
+        """Forgets the motion since the last `apply` call."""
+        self.motion = None
+
+    def matrices(self) -> np.ndarray:
+        """Returns the [N, 2, 3] matrices computed for the observed frames."""
+        return np.array(self.computed, dtype=np.float64).reshape(-1, 2, 3)
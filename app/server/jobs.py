@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import enum
+import logging
+import multiprocessing
+import typing as tp
+import uuid
+
+
+class JobStatus(str, enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker when its job has been cancelled."""
+
+
+class QueueFull(Exception):
+    """Raised when too many jobs are waiting to be run."""
+
+
+def terminate_workers(pool: concurrent.futures.ProcessPoolExecutor) -> None:
+    """
+    Shuts down `pool` without waiting for its tasks and kills its workers,
+    since `shutdown` only cancels the tasks that haven't started yet.
+    """
+    # pylint: disable-next=protected-access
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+class JobContext:
+    """
+    Passed to every job function. Lets the job report its progress
+    and stops it at the next report if the job is cancelled.
+    """
+
+    def __init__(self, job_id: str, progress, cancelled) -> None:
+        self.job_id = job_id
+        self._progress = progress
+        self._cancelled = cancelled
+
+    def report(self, stage: str, done: int, total: int) -> None:
+        """
+        Reports that `done` out of `total` steps of `stage` are finished.
+        Raises `JobCancelled` if the job has been cancelled.
+        """
+        if self._cancelled.get(self.job_id, False):
+            raise JobCancelled
+        self._progress[self.job_id] = (stage, done / total if total else 0)
+
+    def progress(self, stage: str) -> tp.Callable[[int, int], None]:
+        """Returns a `(done, total)` progress callback for `stage`."""
+        return lambda done, total: self.report(stage, done, total)
+
+
+@dataclasses.dataclass
+class Job:
+    id: str
+    kind: str
+    session_id: str
+    future: concurrent.futures.Future
+    status: JobStatus = JobStatus.PENDING
+    error: str | None = None
+    result: tp.Any = None
+    finished: asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+
+
+class JobManager:
+    """
+    Runs blocking jobs (tracking, rendering) in a pool of worker processes,
+    so they don't block the event loop and several jobs can run in parallel.
+
+    At most `max_workers` jobs run at the same time and at most `max_pending`
+    more can wait in the queue. `initializer` is called in each worker process
+    with a dict shared between all processes (`shared`) and `initargs`.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        max_pending: int,
+        initializer: tp.Callable[..., None] | None = None,
+        initargs: tuple = (),
+    ) -> None:
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.dict()
+        self.cancelled = self.manager.dict()
+        self.shared = self.manager.dict()
+        self.make_pool = lambda: concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=(self.shared, *initargs),
+        )
+        self.pool = self.make_pool()
+
+    def submit(
+        self,
+        kind: str,
+        session_id: str,
+        fn: tp.Callable[..., tp.Any],
+        *args,
+        on_done: tp.Callable[[Job], None] | None = None,
+        on_finish: tp.Callable[[Job], None] | None = None,
+    ) -> Job:
+        """
+        Schedules `fn(context, *args)` to run in a worker process
+        as part of session `session_id`.
+        `on_done` is called in the event loop after the job succeeds,
+        `on_finish` is called after it finishes in any way.
+        Raises `QueueFull` if there are already `max_pending` waiting jobs.
+        """
+        pending = sum(
+            not (job.future.running() or job.future.done())
+            for job in self.jobs.values()
+        )
+        if pending >= self.max_pending:
+            raise QueueFull
+
+        job_id = uuid.uuid4().hex
+        context = JobContext(job_id, self.progress, self.cancelled)
+        try:
+            future = self.pool.submit(fn, context, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. OOM-killed), so the pool has to be replaced
+            logging.error("Process pool is broken, starting a new one")
+            self.pool.shutdown(wait=False)
+            self.pool = self.make_pool()
+            future = self.pool.submit(fn, context, *args)
+        job = Job(id=job_id, kind=kind, session_id=session_id, future=future)
+        self.jobs[job_id] = job
+        asyncio.create_task(self._watch(job, on_done, on_finish))
+        logging.info(f"Submitted {kind} job {job_id}")
+        return job
+
+    async def _watch(
+        self,
+        job: Job,
+        on_done: tp.Callable[[Job], None] | None,
+        on_finish: tp.Callable[[Job], None] | None,
+    ) -> None:
+        """Waits for `job` to finish and records its result."""
+        try:
+            job.result = await asyncio.wrap_future(job.future)
+            if on_done is not None:
+                on_done(job)
+        except (asyncio.CancelledError, JobCancelled):
+            job.status = JobStatus.CANCELLED
+            logging.info(f"Job {job.id} cancelled")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            job.status = JobStatus.FAILED
+            job.error = repr(e)
+            logging.error(f"Job {job.id} failed: {e!r}")
+        else:
+            job.status = JobStatus.DONE
+            logging.info(f"Job {job.id} done")
+        finally:
+            self.progress.pop(job.id, None)
+            self.cancelled.pop(job.id, None)
+            job.finished.set()
+            if on_finish is not None:
+                on_finish(job)
+
+    def get(self, job_id: str) -> Job | None:
+        """Returns the job with id `job_id`, or None if there isn't one."""
+        job = self.jobs.get(job_id)
+        if job is not None and job.status == JobStatus.PENDING:
+            if job.future.running() or job.id in self.progress:
+                job.status = JobStatus.RUNNING
+        return job
+
+    def stage_progress(self, job: Job) -> tuple[str | None, float]:
+        """Returns the current stage of `job` and its progress from 0 to 1."""
+        if job.status == JobStatus.DONE:
+            return None, 1.0
+        return self.progress.get(job.id, (None, 0.0))
+
+    async def wait(self, job: Job) -> Job:
+        """Waits until `job` is finished (successfully or not)."""
+        await job.finished.wait()
+        return job
+
+    def cancel(self, job: Job) -> None:
+        """
+        Cancels `job`. A pending job is removed from the queue,
+        a running one stops at its next progress report.
+        """
+        if not job.future.cancel():
+            self.cancelled[job.id] = True
+        logging.info(f"Cancellation requested for job {job.id}")
+
+    def forget_session(self, session_id: str) -> None:
+        """Forgets all finished jobs of session `session_id`."""
+        for job in list(self.jobs.values()):
+            if job.session_id == session_id and job.finished.is_set():
+                del self.jobs[job.id]
+
+    def shutdown(self) -> None:
+        """Stops the worker processes, cancelling all pending jobs."""
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.manager.shutdown()
@@ -0,0 +1,292 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+import pathlib
+import queue
+import threading
+import time
+import typing as tp
+import urllib.parse
+
+import cv2
+import numpy as np
+
+
+# URL schemes of live streams that can be opened with OpenCV (FFmpeg)
+STREAM_SCHEMES = {
+    "http",
+    "https",
+    "rtmp",
+    "rtsp",
+    "rtsps",
+    "srt",
+    "tcp",
+    "udp",
+}
+# Number of the latest frames the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+# Frame messages waiting to be sent to clients before new ones are dropped
+MESSAGE_QUEUE_SIZE = 64
+# How often the broadcast checks whether the tracking job has finished
+POLL_SECS = 0.5
+# Time to connect to a stream and to wait for each of its frames
+# before giving up on it as stalled
+OPEN_TIMEOUT_MS = 10000
+READ_TIMEOUT_MS = 10000
+# Time `LatestFrameSource.close` waits for the reading thread to stop
+CLOSE_TIMEOUT_SECS = 2.0
+
+
+def resolve_source(source: str, replay_dir: pathlib.Path) -> tuple[str, bool]:
+    """
+    Returns what OpenCV should open for `source` and whether it's a local
+    video, which is replayed at its native fps like a live stream.
+    `source` is either a stream URL with one of `STREAM_SCHEMES` or a path
+    relative to `replay_dir`. Raises ValueError for anything else.
+    """
+    scheme = urllib.parse.urlparse(source).scheme.lower()
+    if scheme in STREAM_SCHEMES:
+        return source, False
+    if scheme:
+        raise ValueError(f"unsupported stream scheme {scheme}")
+
+    replay_dir = replay_dir.resolve()
+    path = (replay_dir / source).resolve()
+    if not path.is_relative_to(replay_dir) or not path.is_file():
+        raise ValueError(f"video {source} not found in {replay_dir}")
+    return str(path), True
+
+
+@dataclasses.dataclass
+class LiveFrame:
+    idx: int
+    # Wall-clock time (time.time()) when the frame was received
+    captured_at: float
+    image: np.ndarray  # BGR
+
+
+class LatestFrameSource:
+    """
+    Reads a live stream in a background thread and keeps only its latest
+    frame, so a consumer that can't keep up gets the freshest frame instead
+    of falling further and further behind. Frames replaced before they are
+    taken are counted in `dropped`.
+
+    If `replay` is set, `source` is a video file whose frames are released
+    at its native fps, as if they arrived from a camera.
+    """
+
+    def __init__(self, source: str, replay: bool = False) -> None:
+        self.source = source
+        self.replay = replay
+        # Without timeouts, a stalled stream blocks `read` indefinitely
+        capture = cv2.VideoCapture(
+            source,
+            cv2.CAP_ANY,
+            [
+                cv2.CAP_PROP_OPEN_TIMEOUT_MSEC,
+                OPEN_TIMEOUT_MS,
+                cv2.CAP_PROP_READ_TIMEOUT_MSEC,
+                READ_TIMEOUT_MS,
+            ],
+        )
+        if not capture.isOpened():
+            raise ValueError(f"can't open video stream {source}")
+        self.capture = capture
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+        self.width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.latest = None
+        self.ended = False
+        self.dropped = 0
+        self.error = None
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self) -> None:
+        """Replaces the latest frame with each new one until the end."""
+        start = time.perf_counter()
+        frame_idx = 0
+        try:
+            while not self.stopped.is_set():
+                ok, image = self.capture.read()
+                if not ok:
+                    break
+                if self.replay:
+                    due = start + frame_idx / self.fps
+                    time.sleep(max(0.0, due - time.perf_counter()))
+                with self.condition:
+                    self.dropped += self.latest is not None
+                    self.latest = LiveFrame(frame_idx, time.time(), image)
+                    self.condition.notify()
+                frame_idx += 1
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+        finally:
+            self.capture.release()
+            with self.condition:
+                self.ended = True
+                self.condition.notify()
+
+    def get(self) -> LiveFrame | None:
+        """
+        Waits for a frame newer than the last one taken and returns it,
+        or returns None when the stream has ended.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.latest is not None or self.ended
+            )
+            frame, self.latest = self.latest, None
+        if frame is None and self.error is not None:
+            raise self.error
+        return frame
+
+    def __iter__(self) -> tp.Iterator[LiveFrame]:
+        while (frame := self.get()) is not None:
+            yield frame
+
+    def close(self) -> None:
+        """
+        Stops reading the stream. Waits at most `CLOSE_TIMEOUT_SECS` for
+        a pending read, after which the (daemon) thread releases the stream
+        on its own once the read returns or times out.
+        """
+        self.stopped.set()
+        self.thread.join(CLOSE_TIMEOUT_SECS)
+        if self.thread.is_alive():
+            logging.warning(f"stream {self.source} is still being read")
+
+    def __enter__(self) -> "LatestFrameSource":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def percentiles(values: tp.Iterable[float]) -> dict[str, float]:
+    """Returns the median, the 95th percentile and the maximum of `values`."""
+    values = np.fromiter(values, dtype=float)
+    if len(values) == 0:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    p50, p95 = np.percentile(values, [50, 95])
+    return {"p50": float(p50), "p95": float(p95), "max": float(values.max())}
+
+
+class LatencyStats:
+    """
+    Latencies of the last `window` frames of a live stream:
+      - end-to-end, from receiving a frame to sending its tracks to clients,
+      - processing, from receiving a frame to its tracks being ready,
+    and the numbers of sent and dropped frames.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW) -> None:
+        self.end_to_end_ms = collections.deque(maxlen=window)
+        self.processing_ms = collections.deque(maxlen=window)
+        self.frames = 0
+        self.dropped = 0
+        self.start_secs = time.perf_counter()
+
+    def add(self, message: dict[str, tp.Any], sent_at: float) -> None:
+        """Records a frame message of the tracking job sent at `sent_at`."""
+        captured_at = message["captured_at"]
+        self.end_to_end_ms.append((sent_at - captured_at) * 1000)
+        self.processing_ms.append(
+            (message["processed_at"] - captured_at) * 1000
+        )
+        self.frames += 1
+        self.dropped = message["dropped"]
+
+    def to_dict(self) -> dict[str, tp.Any]:
+        """Summarizes the statistics, with latencies in milliseconds."""
+        wall_secs = time.perf_counter() - self.start_secs
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "fps": self.frames / wall_secs if wall_secs else 0.0,
+            "latency_ms": percentiles(self.end_to_end_ms),
+            "processing_ms": percentiles(self.processing_ms),
+        }
+
+
+class LiveBroadcast:
+    """
+    Forwards the messages of a live tracking job (see `tasks.track_live`)
+    from `messages`, a queue shared with the worker, to the subscribed
+    WebSockets and records their latencies in `stats`.
+    The first message ("start") is kept and sent to each new subscriber,
+    the last one ("end") is followed by closing all subscribers.
+    `finished` is set when the job has finished, in case it dies without
+    sending "end".
+    """
+
+    def __init__(self, messages, finished: asyncio.Event) -> None:
+        self.messages = messages
+        self.finished = finished
+        self.subscribers = set()
+        self.start = None
+        self.stats = LatencyStats()
+        self.done = asyncio.Event()
+        self.task = None
+
+    def start_forwarding(self) -> None:
+        """Starts forwarding messages in the background (see `run`)."""
+        self.task = asyncio.create_task(self.run())
+
+    async def subscribe(self, websocket) -> None:
+        """Sends the tracks of each new frame to `websocket` until the end."""
+        if self.start is not None:
+            await websocket.send_json(self.start)
+        self.subscribers.add(websocket)
+
+    def unsubscribe(self, websocket) -> None:
+        """Stops sending messages to `websocket`."""
+        self.subscribers.discard(websocket)
+
+    async def _send(self, message: dict[str, tp.Any]) -> None:
+        """Sends `message` to all subscribers, dropping those that fail."""
+        subscribers = list(self.subscribers)
+        results = await asyncio.gather(
+            *[websocket.send_json(message) for websocket in subscribers],
+            return_exceptions=True,
+        )
+        for websocket, result in zip(subscribers, results):
+            if isinstance(result, Exception):
+                self.subscribers.discard(websocket)
+
+    async def run(self) -> None:
+        """Forwards messages until the job ends."""
+        try:
+            while True:
+                try:
+                    message = await asyncio.to_thread(
+                        self.messages.get, timeout=POLL_SECS
+                    )
+                except queue.Empty:
+                    if self.finished.is_set():
+                        break
+                    continue
+                if message["type"] == "start":
+                    self.start = message
+                elif message["type"] == "frame":
+                    sent_at = time.time()
+                    message["latency_ms"] = (
+                        sent_at - message["captured_at"]
+                    ) * 1000
+                    self.stats.add(message, sent_at)
+                elif message["type"] == "end":
+                    break
+                await self._send(message)
+        finally:
+            self.done.set()
+            await self._send({"type": "end", "stats": self.stats.to_dict()})
+            for websocket in list(self.subscribers):
+                try:
+                    await websocket.close()
+                except Exception:  # pylint: disable=broad-exception-caught
+                    pass
+            self.subscribers.clear()
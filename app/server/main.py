@@ -1,27 +1,72 @@
+import contextlib
 import logging.handlers
+import math
+import os
 import pathlib
-import zipfile
+import time
+import uuid
 
 import fastapi
 import pydantic
 import uvicorn
 
+import jobs
+import live
+import sessions
+import tasks
+import track_store
 import tracking
+import upload
 import video
 
 
 RESULTS_DIR = pathlib.Path("results")
-IMAGES_DIR = RESULTS_DIR / "images"
-IMAGES_DIR.mkdir(parents=True, exist_ok=True)
+SESSIONS_DIR = RESULTS_DIR / "sessions"
+# Disk space for uploaded videos, track stores and rendered videos
+RESULTS_MAX_MB = int(os.environ.get("RESULTS_MAX_MB", 10240))
 
 LOG_PATH = pathlib.Path("logs/server.log")
 LOG_PATH.parent.mkdir(exist_ok=True)
 
-ORIGINAL_PATH_NO_SUFFIX = RESULTS_DIR / "original"
-ANNOTATED_PATH = RESULTS_DIR / "annotated.mp4"
-ZIP_PATH = RESULTS_DIR / "archive.zip"
+# Load all models on startup instead of on the first request that needs them
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "0") == "1"
 
-app = fastapi.FastAPI()
+# Number of worker processes running tracking and rendering jobs
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", min(4, os.cpu_count())))
+# Number of jobs that can wait for a free worker before new ones are rejected
+MAX_PENDING_JOBS = int(os.environ.get("MAX_PENDING_JOBS", 16))
+# Number of processes rendering segments of one video in /make_video
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", 1))
+# Number of processes tracking parts of one long video in /infer
+TRACKING_SHARDS = int(os.environ.get("TRACKING_SHARDS", 1))
+
+# Directory with local videos that /live can replay as if they were streamed
+LIVE_REPLAY_DIR = pathlib.Path(os.environ.get("LIVE_REPLAY_DIR", "videos"))
+# Default time a live frame may wait for processing before it's dropped
+LIVE_LATENCY_MS = float(os.environ.get("LIVE_LATENCY_MS", 500))
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_: fastapi.FastAPI):
+    app.state.jobs = jobs.JobManager(
+        max_workers=JOB_WORKERS,
+        max_pending=MAX_PENDING_JOBS,
+        initializer=tasks.init_worker,
+        initargs=(
+            LOG_PATH,
+            max(1, os.cpu_count() // JOB_WORKERS),
+            PRELOAD_MODELS,
+        ),
+    )
+    app.state.sessions = sessions.SessionStore(
+        SESSIONS_DIR, max_bytes=RESULTS_MAX_MB * 2**20
+    )
+    app.state.live = {}
+    yield
+    app.state.jobs.shutdown()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
 
 
 class Model(pydantic.BaseModel):
@@ -34,47 +79,139 @@ class GetModelsResponse(pydantic.BaseModel):
     trackers: list[Model]
 
 
+class ModelStats(pydantic.BaseModel):
+    name: str
+    worker: int
+    loaded: bool
+    loads: int
+    hits: int
+    evictions: int
+    load_secs: float
+    size_mb: float
+
+
+class CacheStats(pydantic.BaseModel):
+    name: str
+    hits: int
+    misses: int
+    evictions: int
+    size_mb: float
+
+
+class JobInfo(pydantic.BaseModel):
+    job_id: str
+    kind: str
+    session_id: str
+    status: jobs.JobStatus
+    stage: str | None
+    progress: float
+    error: str | None
+
+
+class LiveStats(pydantic.BaseModel):
+    frames: int
+    dropped: int
+    fps: float
+    latency_ms: dict[str, float]
+    processing_ms: dict[str, float]
+
+
+class LiveStreamInfo(pydantic.BaseModel):
+    stream_id: str
+    status: jobs.JobStatus
+    error: str | None
+    stats: LiveStats
+
+
+class GetTrajectoryResponse(pydantic.BaseModel):
+    player_id: int
+    fps: float
+    frames: list[int]
+    boxes: list[list[float]]
+
+
+class GetOverlayResponse(pydantic.BaseModel):
+    fps: float
+    num_frames: int
+    frame_starts: list[int]
+    track_ids: list[int]
+    boxes: list[list[int]]
+
+
 @app.get("/get_models")
 async def get_models() -> GetModelsResponse:
-    """Lists the detectors and trackers available on the server."""
+    """
+    Lists the detectors and trackers available on the server.
+    Exported models are listed only after they have been exported.
+    """
     logging.info("Received GET /get_models. Returning model lists")
     return GetModelsResponse(
         detectors=[
             Model(slug=slug, ui_name=detector.ui_name)
             for slug, detector in tracking.DETECTORS.items()
+            if detector.is_available()
         ],
         trackers=[
             Model(slug=slug, ui_name=tracker.ui_name)
             for slug, tracker in tracking.TRACKERS.items()
+            if tracker.is_available()
         ],
     )
 
 
-@app.post("/infer", response_class=fastapi.responses.FileResponse)
-async def infer(
-    video_file: fastapi.UploadFile,
-    detector: str,
-    tracker: str,
-):
+@app.get("/get_model_stats")
+async def get_model_stats() -> list[ModelStats]:
     """
-    Infers the chosen detector and tracker on a video file.
+    Lists the models that have been requested in each worker process,
+    with load and cache hit statistics for each of them.
+    """
+    logging.info("Received GET /get_model_stats. Returning model stats")
+    return [
+        ModelStats(
+            name=name,
+            worker=int(key.removeprefix("model_stats:")),
+            loaded=loaded,
+            loads=stats.loads,
+            hits=stats.hits,
+            evictions=stats.evictions,
+            load_secs=stats.load_secs,
+            size_mb=stats.size_bytes / 2**20,
+        )
+        for key, worker_stats in app.state.jobs.shared.items()
+        if key.startswith("model_stats:")
+        for name, (stats, loaded) in worker_stats.items()
+    ]
 
-    Returns a zip file with:
-      - a new video with added boxes and labels highlighting the players,
-      - an image of each detected player from their first detection.
 
-    The response headers contain:
-      - ids of all detected players (player_ids),
-      - time ranges when each player was present in the video (player_times).
+@app.get("/get_cache_stats")
+async def get_cache_stats() -> list[CacheStats]:
     """
-    logging.info("Received POST /infer")
+    Lists the on-disk caches of intermediate results (e.g. detections)
+    with their hit, miss and eviction counts summed over all workers.
+    """
+    logging.info("Received GET /get_cache_stats. Returning cache stats")
+    worker_stats = [
+        stats
+        for key, stats in app.state.jobs.shared.items()
+        if key.startswith("cache_stats:")
+    ]
+    return [
+        CacheStats(
+            name=name,
+            hits=sum(stats[name].hits for stats in worker_stats),
+            misses=sum(stats[name].misses for stats in worker_stats),
+            evictions=sum(stats[name].evictions for stats in worker_stats),
+            size_mb=disk_cache.size_bytes() / 2**20,
+        )
+        for name, disk_cache in tracking.CACHES.items()
+    ]
 
-    original_path = ORIGINAL_PATH_NO_SUFFIX.with_suffix(
-        pathlib.Path(video_file.filename).suffix
-    )
-    with open(original_path, "wb") as fout:
-        fout.write(await video_file.read())
 
+def check_models(detector: str, tracker: str) -> None:
+    """
+    Raises a 404 error if `detector` or `tracker` doesn't exist
+    or hasn't been exported.
+    """
     if detector not in tracking.DETECTORS:
         logging.warning(
             f"detector {detector} not found in available detectors "
@@ -95,116 +232,950 @@ async def infer(
             f"tracker {tracker} not found",
         )
 
-    results = tracking.track(
-        source=original_path,
-        detector=tracking.DETECTORS[detector],
-        tracker=tracking.TRACKERS[tracker],
+    for slug, model in [
+        (detector, tracking.DETECTORS[detector]),
+        (tracker, tracking.TRACKERS[tracker]),
+    ]:
+        if not model.is_available():
+            logging.warning(f"model {slug} hasn't been exported")
+            raise fastapi.HTTPException(
+                fastapi.status.HTTP_404_NOT_FOUND,
+                f"model {slug} hasn't been exported, run export.py",
+            )
+
+
+def check_stride(stride: int | None) -> None:
+    """Raises a 400 error if `stride` isn't a positive number of frames."""
+    if stride is not None and stride < 1:
+        logging.warning(f"invalid detector stride {stride}")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            "stride must be at least 1",
+        )
+
+
+def check_precompute_focused(precompute_focused: int) -> None:
+    """Raises a 400 error if `precompute_focused` is negative."""
+    if precompute_focused < 0:
+        logging.warning(f"invalid precompute_focused {precompute_focused}")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            "precompute_focused must be non-negative",
+        )
+
+
+def get_session(session_id: str, endpoint: str) -> sessions.Session:
+    """
+    Returns the session with id `session_id`. Raises a 404 error if it doesn't
+    exist (or has been evicted) and a 400 error if its /infer hasn't finished.
+    """
+    session = app.state.sessions.get(session_id)
+    if session is None:
+        logging.warning(f"{endpoint} called with unknown session {session_id}")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_404_NOT_FOUND,
+            f"session {session_id} not found, /infer must be called again",
+        )
+    if session.index is None:
+        logging.warning(f"{endpoint} called before /infer of {session_id}")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            "/infer must finish first",
+        )
+    return session
+
+
+def check_player_id(session: sessions.Session, player_id: int) -> None:
+    """Raises a 404 error if there is no player with id `player_id`."""
+    if player_id not in session.player_ids():
+        logging.warning(
+            f"player_id {player_id} not found in player ids "
+            f"{sorted(session.player_ids())}"
+        )
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_404_NOT_FOUND,
+            f"player id {player_id} not found",
+        )
+
+
+def check_player_params(
+    session: sessions.Session, player_params: dict[int, video.PlayerParams]
+) -> None:
+    """Raises a 422 error if `player_params` doesn't match the player ids."""
+    if set(player_params.keys()) != session.player_ids():
+        logging.warning(
+            "player_params has wrong keys: "
+            f"expected {sorted(session.player_ids())}, "
+            f"got {sorted(player_params.keys())}"
+        )
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "player_params must have exactly one element for each player id",
+        )
+
+
+def get_job(job_id: str) -> jobs.Job:
+    """Returns the job with id `job_id` or raises a 404 error."""
+    job = app.state.jobs.get(job_id)
+    if job is None:
+        logging.warning(f"job {job_id} not found")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_404_NOT_FOUND, f"job {job_id} not found"
+        )
+    return job
+
+
+def submit_job(
+    kind: str, session: sessions.Session, fn, *args, on_done=None
+) -> jobs.Job:
+    """
+    Submits a job of `session` to the worker pool or raises a 503 error
+    if it's full. The session isn't evicted while the job is running,
+    nor when it finishes, and is evicted last until its result is fetched
+    (see `job_result`).
+    """
+
+    def on_finish(job: jobs.Job) -> None:
+        """Frees disk space if the results don't fit in the budget anymore."""
+        session.active_jobs -= 1
+        if job.status == jobs.JobStatus.DONE:
+            session.unfetched_jobs.add(job.id)
+        for session_id in app.state.sessions.evict(keep=session.id):
+            app.state.jobs.forget_session(session_id)
+
+    try:
+        job = app.state.jobs.submit(
+            kind, session.id, fn, *args, on_done=on_done, on_finish=on_finish
+        )
+    except jobs.QueueFull as e:
+        logging.warning(f"job queue is full, rejecting {kind} job")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            "too many jobs in the queue, try again later",
+        ) from e
+    session.active_jobs += 1
+    return job
+
+
+def job_info(job: jobs.Job) -> JobInfo:
+    """Describes the current state of `job`."""
+    stage, progress = app.state.jobs.stage_progress(job)
+    return JobInfo(
+        job_id=job.id,
+        kind=job.kind,
+        session_id=job.session_id,
+        status=job.status,
+        stage=stage,
+        progress=progress,
+        error=job.error,
     )
-    boxes_list = [res.boxes for res in results]
 
-    start_time, end_time = await video.get_player_times(
-        original_path, boxes_list
+
+def job_result(job: jobs.Job) -> fastapi.responses.FileResponse:
+    """Returns the result file of a finished job or raises an error."""
+    if job.status != jobs.JobStatus.DONE:
+        logging.warning(f"result of job {job.id} requested, but {job.status}")
+        raise fastapi.HTTPException(
+            (
+                fastapi.status.HTTP_500_INTERNAL_SERVER_ERROR
+                if job.status == jobs.JobStatus.FAILED
+                else fastapi.status.HTTP_409_CONFLICT
+            ),
+            f"job {job.id} is {job.status.value}",
+        )
+    if not job.result.path.exists():
+        logging.warning(f"result of job {job.id} has been evicted")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_410_GONE,
+            f"result of job {job.id} has been deleted, submit it again",
+        )
+    # The session may be evicted as usual once the result has been sent
+    background = fastapi.BackgroundTasks()
+    session = app.state.sessions.get(job.session_id)
+    if session is not None:
+        background.add_task(session.unfetched_jobs.discard, job.id)
+    return fastapi.responses.FileResponse(
+        path=job.result.path, headers=job.result.headers, background=background
     )
 
-    player_ids = set(start_time.keys())
-    player_ids_sorted = sorted(player_ids)
-    player_ids_header = ",".join(str(pid) for pid in player_ids_sorted)
-    player_times_header = ",".join(
-        f"{start_time[pid]}-{end_time[pid]}" for pid in player_ids_sorted
+
+def submit_tracking(
+    session: sessions.Session,
+    upload_times: upload.UploadTimes,
+    growing: bool,
+    *infer_args,
+) -> jobs.Job:
+    """
+    Submits a tracking job for the video of `session`, which is still being
+    uploaded if `growing` is set. `infer_args` are passed to `tasks.infer`
+    after the paths. The result headers report how much of the upload
+    overlapped with processing.
+    """
+
+    def on_done(job: jobs.Job) -> None:
+        """Makes the results of this job available to other endpoints."""
+        session.index = track_store.PlayerIndex(
+            track_store.TrackStore.load(session.tracks_dir)
+        )
+        job.result.headers["session_id"] = session.id
+
+        started_at = float(job.result.headers.pop("started_at"))
+        finished_at = time.time()
+        overlap = max(
+            0.0,
+            min(upload_times.end, finished_at)
+            - max(upload_times.start, started_at),
+        )
+        job.result.headers["upload_overlap"] = (
+            f"upload={upload_times.end - upload_times.start:.2f},"
+            f"processing={finished_at - started_at:.2f},"
+            f"overlap={overlap:.2f}"
+        )
+        logging.info(
+            f"infer job {job.id} upload/processing (s): "
+            f"{job.result.headers['upload_overlap']}"
+        )
+
+    return submit_job(
+        "infer",
+        session,
+        tasks.infer,
+        session.dir,
+        session.original_path,
+        *infer_args,
+        growing,
+        TRACKING_SHARDS,
+        on_done=on_done,
     )
 
-    await video.draw_bboxes(
-        original_path,
-        ANNOTATED_PATH,
-        boxes_list,
-        {pid: video.PlayerParams() for pid in player_ids},
+
+async def submit_infer(
+    video_file: fastapi.UploadFile,
+    detector: str,
+    tracker: str,
+    stride: int | None,
+    adaptive_stride: bool | None,
+    output: video.OutputMode,
+    precompute_focused: int,
+) -> jobs.Job:
+    """
+    Saves the uploaded video to a new session in chunks and submits
+    a tracking job for it.
+    """
+    check_models(detector, tracker)
+    check_stride(stride)
+    check_precompute_focused(precompute_focused)
+
+    session = app.state.sessions.create()
+    original_path = (session.dir / "original").with_suffix(
+        pathlib.Path(video_file.filename).suffix
     )
-    await video.save_player_images(original_path, IMAGES_DIR, boxes_list)
+    upload_times = upload.UploadTimes(start=time.time())
+    # The upload counts as a job, so that the session isn't evicted meanwhile
+    session.active_jobs += 1
+    try:
+        with open(original_path, "wb") as fout:
+            while chunk := await video_file.read(upload.CHUNK_SIZE):
+                fout.write(chunk)
+    finally:
+        session.active_jobs -= 1
+    upload_times.end = time.time()
+    session.original_path = original_path
 
-    archive = zipfile.ZipFile(ZIP_PATH, "w")
-    archive.write(ANNOTATED_PATH, ANNOTATED_PATH.relative_to(RESULTS_DIR))
-    for file in IMAGES_DIR.iterdir():
-        archive.write(file, file.relative_to(RESULTS_DIR))
+    return submit_tracking(
+        session,
+        upload_times,
+        False,
+        detector,
+        tracker,
+        stride,
+        adaptive_stride,
+        output,
+        precompute_focused,
+    )
 
-    app.state.original_path = original_path
-    app.state.boxes_list = boxes_list
-    app.state.player_ids = player_ids
 
-    logging.info(f"/infer done, returning {ZIP_PATH}")
+async def submit_infer_stream(
+    request: fastapi.Request,
+    filename: str,
+    detector: str,
+    tracker: str,
+    stride: int | None,
+    adaptive_stride: bool | None,
+    output: video.OutputMode,
+    precompute_focused: int,
+) -> jobs.Job:
+    """
+    Writes the video streamed in the request body to a new session chunk
+    by chunk. If its container can be decoded before it's complete
+    (`upload.is_streamable`), the tracking job is submitted as soon as
+    the beginning of the video is received, otherwise after the upload.
+    """
+    check_models(detector, tracker)
+    check_stride(stride)
+    check_precompute_focused(precompute_focused)
 
-    return fastapi.responses.FileResponse(
-        path=ZIP_PATH,
-        headers={
-            "player_ids": player_ids_header,
-            "player_times": player_times_header,
-        },
+    session = app.state.sessions.create()
+    original_path = (session.dir / "original").with_suffix(
+        pathlib.Path(filename).suffix
+    )
+    partial_path = upload.partial_path(original_path)
+    session.original_path = original_path
+    infer_args = (
+        detector,
+        tracker,
+        stride,
+        adaptive_stride,
+        output,
+        precompute_focused,
     )
 
+    upload_times = upload.UploadTimes(start=time.time())
+    job = None
+    head = b""
+    streamable = None
+    # The upload counts as a job, so that the session isn't evicted meanwhile
+    session.active_jobs += 1
+    try:
+        with open(partial_path, "wb") as fout:
+            async for chunk in request.stream():
+                fout.write(chunk)
+                if streamable is None:
+                    head += chunk
+                    streamable = upload.is_streamable(
+                        original_path.suffix, head
+                    )
+                if streamable:
+                    # The tracking job reads the file while it's written
+                    fout.flush()
+                    if job is None:
+                        logging.info("Streamable upload, starting tracking")
+                        job = submit_tracking(
+                            session, upload_times, True, *infer_args
+                        )
+    except BaseException:
+        partial_path.unlink(missing_ok=True)  # Stops the tracking job
+        raise
+    finally:
+        session.active_jobs -= 1
+    os.replace(partial_path, original_path)
+    upload_times.end = time.time()
 
-@app.post("/make_video", response_class=fastapi.responses.FileResponse)
-async def make_video(player_params: dict[int, video.PlayerParams]):
+    if job is None:
+        job = submit_tracking(session, upload_times, False, *infer_args)
+    return job
+
+
+def submit_make_video(
+    session_id: str, player_params: dict[int, video.PlayerParams]
+) -> jobs.Job:
     """
-    Generates a video with bounding boxes and labels like /infer,
-    but using custom visualization parameters.
+    Submits a job rendering the video with custom player params.
+    Segments of the last render of the session are reused where possible.
     """
-    logging.info(f"Received POST /make_video, player_params: {player_params}")
+    session = get_session(session_id, "/make_video")
+    check_player_params(session, player_params)
+
+    def on_done(job: jobs.Job) -> None:
+        """
+        Keeps the render for the next /make_video of this session and
+        deletes the segments it doesn't reuse, unless other jobs of
+        the session (which may be rendering from them) are running.
+        """
+        session.last_render = job.result.render
+        if session.active_jobs == 1:  # Only this job
+            video.delete_unused_segments(
+                session.segments_dir, session.last_render
+            )
+
+    return submit_job(
+        "make_video",
+        session,
+        tasks.make_video,
+        session.renders_dir / f"annotated-{uuid.uuid4().hex}.mp4",
+        session.original_path,
+        session.tracks_dir,
+        player_params,
+        session.segments_dir,
+        session.last_render,
+        RENDER_WORKERS,
+        on_done=on_done,
+    )
+
+
+def submit_make_focused_video(session_id: str, player_id: int) -> jobs.Job:
+    """Submits a job rendering the video focused on a player."""
+    session = get_session(session_id, "/make_focused_video")
+    check_player_id(session, player_id)
+    return submit_job(
+        "make_focused_video",
+        session,
+        tasks.make_focused_video,
+        session.renders_dir / f"focused-{uuid.uuid4().hex}.mp4",
+        session.original_path,
+        session.tracks_dir,
+        player_id,
+        session.focused_dir,
+    )
 
-    if not hasattr(app.state, "player_ids"):
-        logging.warning("/make_video called without an /infer")
+
+def submit_make_focused_videos(
+    session_id: str, player_ids: list[int]
+) -> jobs.Job:
+    """Submits a job rendering the videos focused on several players."""
+    session = get_session(session_id, "/make_focused_videos")
+    if not player_ids:
+        logging.warning("/make_focused_videos called without player ids")
         raise fastapi.HTTPException(
-            fastapi.status.HTTP_400_BAD_REQUEST, "/infer must be called first"
+            fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "at least one player id is required",
         )
+    for player_id in player_ids:
+        check_player_id(session, player_id)
+    return submit_job(
+        "make_focused_videos",
+        session,
+        tasks.make_focused_videos,
+        session.renders_dir / f"focused-{uuid.uuid4().hex}.zip",
+        session.original_path,
+        session.tracks_dir,
+        sorted(set(player_ids)),
+        session.focused_dir,
+    )
 
-    if set(player_params.keys()) != app.state.player_ids:
-        logging.warning(
-            "player_params has wrong keys: "
-            f"expected {sorted(app.state.player_ids)}, "
-            f"got {sorted(player_params.keys())}"
+
+def submit_live(
+    source: str,
+    detector: str,
+    tracker: str,
+    latency_ms: float,
+    stride: int | None,
+    adaptive_stride: bool | None,
+) -> jobs.Job:
+    """
+    Submits a job tracking a live stream and starts forwarding its tracks
+    to the WebSocket clients of the stream.
+    """
+    check_models(detector, tracker)
+    check_stride(stride)
+    if latency_ms <= 0:
+        logging.warning(f"invalid live latency budget {latency_ms}")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_400_BAD_REQUEST,
+            "latency_ms must be positive",
         )
+    try:
+        source, replay = live.resolve_source(source, LIVE_REPLAY_DIR)
+    except ValueError as e:
+        logging.warning(f"invalid live source: {e}")
         raise fastapi.HTTPException(
-            fastapi.status.HTTP_422_UNPROCESSABLE_ENTITY,
-            "player_params must have exactly one element for each player id",
+            fastapi.status.HTTP_400_BAD_REQUEST, str(e)
+        ) from e
+
+    messages = app.state.jobs.manager.Queue(maxsize=live.MESSAGE_QUEUE_SIZE)
+    try:
+        job = app.state.jobs.submit(
+            "live",
+            "live",
+            tasks.track_live,
+            RESULTS_DIR / "live" / f"{uuid.uuid4().hex}.json",
+            messages,
+            source,
+            replay,
+            detector,
+            tracker,
+            latency_ms,
+            stride,
+            adaptive_stride,
         )
+    except jobs.QueueFull as e:
+        logging.warning("job queue is full, rejecting live job")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_503_SERVICE_UNAVAILABLE,
+            "too many jobs in the queue, try again later",
+        ) from e
+    broadcast = live.LiveBroadcast(messages, job.finished)
+    broadcast.start_forwarding()
+    app.state.live[job.id] = broadcast
+    # Forgets the broadcast and its queue once the stream has ended,
+    # its counts stay in the headers of the job result
+    broadcast.task.add_done_callback(
+        lambda _: app.state.live.pop(job.id, None)
+    )
+    return job
 
-    await video.draw_bboxes(
-        app.state.original_path,
-        ANNOTATED_PATH,
-        app.state.boxes_list,
-        player_params,
+
+def get_live(stream_id: str) -> tuple[jobs.Job, live.LiveBroadcast]:
+    """Returns the job and the broadcast of a live stream or raises a 404."""
+    broadcast = app.state.live.get(stream_id)
+    if broadcast is None:
+        logging.warning(f"live stream {stream_id} not found")
+        raise fastapi.HTTPException(
+            fastapi.status.HTTP_404_NOT_FOUND,
+            f"live stream {stream_id} not found",
+        )
+    return get_job(stream_id), broadcast
+
+
+def live_info(job: jobs.Job, broadcast: live.LiveBroadcast) -> LiveStreamInfo:
+    """Describes the current state of a live stream."""
+    return LiveStreamInfo(
+        stream_id=job.id,
+        status=job.status,
+        error=job.error,
+        stats=LiveStats(**broadcast.stats.to_dict()),
     )
-    logging.info(f"/make_video done, returning {ANNOTATED_PATH}")
-    return ANNOTATED_PATH
+
+
+@app.post("/infer", response_class=fastapi.responses.FileResponse)
+async def infer(
+    video_file: fastapi.UploadFile,
+    detector: str,
+    tracker: str,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    output: video.OutputMode = video.OutputMode.VIDEO,
+    precompute_focused: int = 0,
+):
+    """
+    Infers the chosen detector and tracker on a video file.
+
+    The detector runs on every `stride`-th frame (by default, on every frame);
+    tracks are propagated by the Kalman filter and GMC in between.
+    With `adaptive_stride`, it also runs earlier when the tracks become
+    uncertain. Both default to the settings of the detector.
+    Videos focused on the `precompute_focused` players with the most screen
+    time are rendered in advance, so that /make_focused_video and
+    /make_focused_videos return them right away.
+
+    Returns a zip file with:
+      - a new video with added boxes and labels highlighting the players
+        (annotated.mp4) or, if `output` is "overlay", the clean video
+        (clean.mp4) and the boxes for the client to draw on top of it
+        during playback (overlay.json, same as /get_overlay),
+      - an image of each detected player from their first detection.
+
+    The response headers contain:
+      - the id of the session with the results, which is passed to the other
+        endpoints (session_id),
+      - ids of all detected players (player_ids),
+      - time ranges when each player was present in the video (player_times),
+      - ids of the players with precomputed focused videos (focused_ids),
+      - seconds spent in each processing stage (stage_times),
+      - seconds spent on saving the upload and on processing and how long
+        they overlapped (upload_overlap),
+      - utilisation of each stage of the tracking pipeline and mean depths
+        of its queues (pipeline_stats),
+      - with an adaptive tracker, the number of frames on each path of its
+        GMC (gmc_paths).
+    """
+    logging.info("Received POST /infer")
+    job = await app.state.jobs.wait(
+        await submit_infer(
+            video_file,
+            detector,
+            tracker,
+            stride,
+            adaptive_stride,
+            output,
+            precompute_focused,
+        )
+    )
+    logging.info(f"/infer done, job {job.id} is {job.status.value}")
+    return job_result(job)
+
+
+@app.post("/infer_stream", response_class=fastapi.responses.FileResponse)
+async def infer_stream(
+    request: fastapi.Request,
+    filename: str,
+    detector: str,
+    tracker: str,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    output: video.OutputMode = video.OutputMode.VIDEO,
+    precompute_focused: int = 0,
+):
+    """
+    Same as /infer, but the video is sent as the raw request body
+    (`filename` is only used for its extension) and written to disk
+    in chunks as it arrives. For streamable containers (MPEG-TS, MKV, WebM,
+    MP4 with the index at the start) tracking starts before the upload
+    is complete. The response header upload_overlap contains the seconds
+    spent on the upload and on processing and how long they overlapped.
+    """
+    logging.info(f"Received POST /infer_stream, filename: {filename}")
+    job = await app.state.jobs.wait(
+        await submit_infer_stream(
+            request,
+            filename,
+            detector,
+            tracker,
+            stride,
+            adaptive_stride,
+            output,
+            precompute_focused,
+        )
+    )
+    logging.info(f"/infer_stream done, job {job.id} is {job.status.value}")
+    return job_result(job)
+
+
+@app.post("/make_video", response_class=fastapi.responses.FileResponse)
+async def make_video(
+    session_id: str, player_params: dict[int, video.PlayerParams]
+):
+    """
+    Generates a video with bounding boxes and labels like /infer,
+    but using custom visualization parameters.
+
+    Only the parts of the video where players with params changed since
+    the last /make_video of the session appear are rendered again.
+    The response header rendered_segments contains the number of rendered
+    and total segments (e.g. 3/40).
+    """
+    logging.info(
+        f"Received POST /make_video, session_id: {session_id}, "
+        f"player_params: {player_params}"
+    )
+    job = await app.state.jobs.wait(
+        submit_make_video(session_id, player_params)
+    )
+    logging.info(f"/make_video done, job {job.id} is {job.status.value}")
+    return job_result(job)
 
 
 @app.post("/make_focused_video", response_class=fastapi.responses.FileResponse)
-async def make_focused_video(player_id: int):
+async def make_focused_video(session_id: str, player_id: int):
     """Generates a video focused on a specific player's movements."""
-    logging.info(f"Received POST /make_focused_video, player_id: {player_id}")
+    logging.info(
+        f"Received POST /make_focused_video, session_id: {session_id}, "
+        f"player_id: {player_id}"
+    )
+    job = await app.state.jobs.wait(
+        submit_make_focused_video(session_id, player_id)
+    )
+    logging.info(
+        f"/make_focused_video done, job {job.id} is {job.status.value}"
+    )
+    return job_result(job)
 
-    if not hasattr(app.state, "player_ids"):
-        logging.warning("/make_focused_video called without an /infer")
-        raise fastapi.HTTPException(
-            fastapi.status.HTTP_400_BAD_REQUEST, "/infer must be called first"
+
+@app.post(
+    "/make_focused_videos", response_class=fastapi.responses.FileResponse
+)
+async def make_focused_videos(
+    session_id: str, player_ids: list[int] = fastapi.Query()
+):
+    """
+    Generates videos focused on several players at once, decoding the video
+    only once. Returns a zip file with a video for each player
+    ({player_id}.mp4).
+    """
+    logging.info(
+        f"Received POST /make_focused_videos, session_id: {session_id}, "
+        f"player_ids: {player_ids}"
+    )
+    job = await app.state.jobs.wait(
+        submit_make_focused_videos(session_id, player_ids)
+    )
+    logging.info(
+        f"/make_focused_videos done, job {job.id} is {job.status.value}"
+    )
+    return job_result(job)
+
+
+@app.post("/jobs/infer")
+async def submit_infer_job(
+    video_file: fastapi.UploadFile,
+    detector: str,
+    tracker: str,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    output: video.OutputMode = video.OutputMode.VIDEO,
+    precompute_focused: int = 0,
+) -> JobInfo:
+    """
+    Same as /infer, but returns a job immediately instead of waiting.
+    The result can be fetched from /jobs/{job_id}/result when it's done.
+    """
+    logging.info("Received POST /jobs/infer")
+    return job_info(
+        await submit_infer(
+            video_file,
+            detector,
+            tracker,
+            stride,
+            adaptive_stride,
+            output,
+            precompute_focused,
         )
+    )
 
-    if player_id not in app.state.player_ids:
-        logging.warning(
-            f"player_id {player_id} not found in player ids "
-            f"{sorted(app.state.player_ids)}"
+
+@app.post("/jobs/infer_stream")
+async def submit_infer_stream_job(
+    request: fastapi.Request,
+    filename: str,
+    detector: str,
+    tracker: str,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    output: video.OutputMode = video.OutputMode.VIDEO,
+    precompute_focused: int = 0,
+) -> JobInfo:
+    """
+    Same as /infer_stream, but returns the job as soon as the upload is
+    complete instead of waiting for the results.
+    """
+    logging.info(f"Received POST /jobs/infer_stream, filename: {filename}")
+    return job_info(
+        await submit_infer_stream(
+            request,
+            filename,
+            detector,
+            tracker,
+            stride,
+            adaptive_stride,
+            output,
+            precompute_focused,
         )
+    )
+
+
+@app.post("/jobs/make_video")
+async def submit_make_video_job(
+    session_id: str,
+    player_params: dict[int, video.PlayerParams],
+) -> JobInfo:
+    """Same as /make_video, but returns a job immediately."""
+    logging.info(
+        f"Received POST /jobs/make_video, session_id: {session_id}, "
+        f"player_params: {player_params}"
+    )
+    return job_info(submit_make_video(session_id, player_params))
+
+
+@app.post("/jobs/make_focused_video")
+async def submit_make_focused_video_job(
+    session_id: str, player_id: int
+) -> JobInfo:
+    """Same as /make_focused_video, but returns a job immediately."""
+    logging.info(
+        f"Received POST /jobs/make_focused_video, session_id: {session_id}, "
+        f"player_id: {player_id}"
+    )
+    return job_info(submit_make_focused_video(session_id, player_id))
+
+
+@app.post("/jobs/make_focused_videos")
+async def submit_make_focused_videos_job(
+    session_id: str, player_ids: list[int] = fastapi.Query()
+) -> JobInfo:
+    """Same as /make_focused_videos, but returns a job immediately."""
+    logging.info(
+        f"Received POST /jobs/make_focused_videos, session_id: {session_id}, "
+        f"player_ids: {player_ids}"
+    )
+    return job_info(submit_make_focused_videos(session_id, player_ids))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_info(job_id: str) -> JobInfo:
+    """Returns the status and progress of a job."""
+    logging.info(f"Received GET /jobs/{job_id}")
+    return job_info(get_job(job_id))
+
+
+@app.get(
+    "/jobs/{job_id}/result", response_class=fastapi.responses.FileResponse
+)
+async def get_job_result(job_id: str):
+    """
+    Returns the result of a finished job: the same file and headers
+    as the endpoint that the job was submitted for.
+    """
+    logging.info(f"Received GET /jobs/{job_id}/result")
+    return job_result(get_job(job_id))
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str) -> JobInfo:
+    """
+    Cancels a job. A job waiting in the queue is cancelled immediately,
+    a running one stops as soon as it reports its progress.
+    """
+    logging.info(f"Received DELETE /jobs/{job_id}")
+    job = get_job(job_id)
+    app.state.jobs.cancel(job)
+    return job_info(job)
+
+
+@app.post("/live")
+async def start_live(
+    source: str,
+    detector: str,
+    tracker: str,
+    latency_ms: float = LIVE_LATENCY_MS,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+) -> LiveStreamInfo:
+    """
+    Starts tracking players on a live stream: an RTSP, HTTP (e.g. MPEG-TS)
+    or other URL that FFmpeg can open, or the path of a video in
+    LIVE_REPLAY_DIR, which is replayed at its native fps.
+    The tracks of each frame are pushed to the clients of the WebSocket
+    /live/{stream_id}/tracks as soon as they are ready.
+
+    Frames are processed as they arrive. A frame that has waited for more
+    than `latency_ms` since it was received is dropped, and only the latest
+    frame waits at all, so the tracks lag behind the stream by a bounded
+    time instead of piling up when tracking is slower than the stream.
+    `stride` and `adaptive_stride` work like in /infer.
+
+    The stream occupies a job worker until it ends or is stopped with
+    DELETE /live/{stream_id}.
+    """
+    logging.info(
+        f"Received POST /live, source: {source}, detector: {detector}, "
+        f"tracker: {tracker}, latency_ms: {latency_ms}"
+    )
+    job = submit_live(
+        source, detector, tracker, latency_ms, stride, adaptive_stride
+    )
+    return live_info(job, app.state.live[job.id])
+
+
+@app.get("/live/{stream_id}")
+async def get_live_info(stream_id: str) -> LiveStreamInfo:
+    """
+    Returns the status of a live stream and its statistics: the numbers of
+    sent and dropped frames, the rate at which tracks are sent and
+    the median, 95th percentile and maximum over the last frames of
+    the end-to-end latency (from receiving a frame to sending its tracks,
+    latency_ms) and the processing latency (until its tracks are ready,
+    processing_ms), in milliseconds.
+    Streams that have ended are forgotten, and a 404 is returned for them.
+    """
+    logging.info(f"Received GET /live/{stream_id}")
+    return live_info(*get_live(stream_id))
+
+
+@app.delete("/live/{stream_id}")
+async def stop_live(stream_id: str) -> LiveStreamInfo:
+    """Stops tracking a live stream."""
+    logging.info(f"Received DELETE /live/{stream_id}")
+    job, broadcast = get_live(stream_id)
+    app.state.jobs.cancel(job)
+    return live_info(job, broadcast)
+
+
+@app.websocket("/live/{stream_id}/tracks")
+async def live_tracks(websocket: fastapi.WebSocket, stream_id: str):
+    """
+    Sends JSON messages with the tracks of a live stream:
+      - {"type": "start", "fps", "width", "height"} on connection,
+      - {"type": "frame", "frame", "captured_at", "processed_at",
+        "latency_ms", "dropped", "track_ids", "boxes"} for each processed
+        frame, where boxes are xyxy in pixels, timestamps are Unix times
+        on the server and `dropped` counts the frames dropped so far,
+      - {"type": "end", "stats"} when the stream ends, with the same
+        statistics as GET /live/{stream_id}.
+    """
+    logging.info(f"Received WebSocket /live/{stream_id}/tracks")
+    broadcast = app.state.live.get(stream_id)
+    await websocket.accept()
+    if broadcast is None or broadcast.done.is_set():
+        await websocket.close(
+            code=fastapi.status.WS_1008_POLICY_VIOLATION,
+            reason=f"live stream {stream_id} not found or has ended",
+        )
+        return
+    await broadcast.subscribe(websocket)
+    try:
+        # Messages from the client are ignored, this only waits until
+        # the client leaves or the broadcast closes the connection
+        while (
+            websocket.application_state
+            == fastapi.websockets.WebSocketState.CONNECTED
+        ):
+            await websocket.receive_text()
+    except fastapi.WebSocketDisconnect:
+        broadcast.unsubscribe(websocket)
+
+
+@app.get("/get_trajectory")
+async def get_trajectory(
+    session_id: str, player_id: int, start: float = 0, end: float | None = None
+) -> GetTrajectoryResponse:
+    """
+    Returns the raw trajectory of a player: the frames where they were
+    detected and their boxes (xyxy) on those frames.
+    Only frames between `start` and `end` seconds are included.
+    """
+    logging.info(
+        f"Received GET /get_trajectory, session_id: {session_id}, "
+        f"player_id: {player_id}, "
+        f"start: {start}, end: {end}"
+    )
+    session = get_session(session_id, "/get_trajectory")
+    check_player_id(session, player_id)
+
+    index = session.index
+    trajectory = index[player_id].frame_range(
+        math.ceil(start * index.fps),
+        index.num_frames if end is None else math.floor(end * index.fps) + 1,
+    )
+
+    logging.info(
+        f"/get_trajectory done, returning {len(trajectory.frames)} boxes"
+    )
+    return GetTrajectoryResponse(
+        player_id=player_id,
+        fps=index.fps,
+        frames=trajectory.frames.tolist(),
+        boxes=trajectory.xyxy.tolist(),
+    )
+
+
+@app.get("/get_overlay")
+async def get_overlay(session_id: str) -> GetOverlayResponse:
+    """
+    Returns the boxes of all players for drawing them on top of the clean
+    video: the boxes (xyxy) of frame `i` and the ids of their players are
+    `boxes[frame_starts[i]:frame_starts[i + 1]]` and
+    `track_ids[frame_starts[i]:frame_starts[i + 1]]`.
+    Labels and visibility are applied by the client, so changing them
+    doesn't need a new video.
+    """
+    logging.info(f"Received GET /get_overlay, session_id: {session_id}")
+    session = get_session(session_id, "/get_overlay")
+    overlay = video.make_overlay(
+        track_store.TrackStore.load(session.tracks_dir)
+    )
+    logging.info(f"/get_overlay done, returning {len(overlay['boxes'])} boxes")
+    return GetOverlayResponse(**overlay)
+
+
+@app.get("/get_clean_video", response_class=fastapi.responses.FileResponse)
+async def get_clean_video(session_id: str):
+    """
+    Returns the clean video of a session tracked with the "overlay" output,
+    for playing it in the browser with the boxes of /get_overlay on top.
+    Range requests are supported, so the video can be seeked while loading.
+    """
+    logging.info(f"Received GET /get_clean_video, session_id: {session_id}")
+    session = get_session(session_id, "/get_clean_video")
+    if not session.clean_path.exists():
+        logging.warning(f"session {session_id} has no clean video")
         raise fastapi.HTTPException(
             fastapi.status.HTTP_404_NOT_FOUND,
-            f"player id {player_id} not found",
+            f"session {session_id} has no clean video, "
+            "call /infer with output=overlay",
         )
-
-    await video.crop_to_player(
-        app.state.original_path,
-        ANNOTATED_PATH,
-        app.state.boxes_list,
-        player_id,
+    return fastapi.responses.FileResponse(
+        session.clean_path, media_type="video/mp4"
     )
-    logging.info(f"/make_focused_video done, returning {ANNOTATED_PATH}")
-    return ANNOTATED_PATH
 
 
 if __name__ == "__main__":
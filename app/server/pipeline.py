@@ -0,0 +1,219 @@
+import collections
+import dataclasses
+import pathlib
+import queue
+import threading
+import time
+import typing as tp
+
+import numpy as np
+
+import video
+
+
+@dataclasses.dataclass
+class QueueStats:
+    """Depth of a queue sampled each time an item is taken from it."""
+
+    capacity: int
+    samples: int = 0
+    total: int = 0
+    max: int = 0
+
+    def sample(self, depth: int) -> None:
+        self.samples += 1
+        self.total += depth
+        self.max = max(self.max, depth)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.samples if self.samples else 0.0
+
+
+class PipelineStats:
+    """
+    Time each stage of a `TrackingPipeline` was busy and depths of the queues
+    between the stages. A stage with utilisation close to 1 bounds the whole
+    pipeline; the queue in front of it stays full and the one after it empty.
+    With an adaptive GMC, `gmc_paths` counts the frames that took each of its
+    paths (see `gmc.AdaptiveGMC`).
+    """
+
+    def __init__(self) -> None:
+        self.timer = video.StageTimer()
+        self.queues = {}
+        self.wall_secs = 0.0
+        self.gmc_paths = collections.Counter()
+
+    def utilisation(self) -> dict[str, float]:
+        """Returns the busy fraction of the wall-clock time of each stage."""
+        return {
+            stage: secs / self.wall_secs if self.wall_secs else 0.0
+            for stage, secs in self.timer.secs.items()
+        }
+
+    def to_header(self) -> str:
+        """
+        Formats the statistics as e.g.
+        `decode=0.31,detect=0.97,associate=0.42,frames=7.8/8,detections=0.1/8`:
+        the utilisation of each stage, then the mean depth and the capacity
+        of each queue.
+        """
+        return ",".join(
+            [
+                f"{stage}={busy:.2f}"
+                for stage, busy in self.utilisation().items()
+            ]
+            + [
+                f"{name}={stats.mean:.1f}/{stats.capacity}"
+                for name, stats in self.queues.items()
+            ]
+        )
+
+    def gmc_paths_header(self) -> str:
+        """
+        Formats `gmc_paths` as e.g. `full=40,static=102,phase=8`, or returns
+        an empty string if the GMC isn't adaptive or its matrices were cached.
+        """
+        return ",".join(
+            f"{path}={count}" for path, count in self.gmc_paths.items()
+        )
+
+
+class TrackingPipeline:
+    """
+    Decodes frames of a video and detects objects on them ahead of the tracker.
+
+    The stages run in separate threads connected by bounded queues:
+      - decode: `video.FrameReader` prefetches frames into the "frames" queue,
+      - detect: collects up to `batch_size` keyframes
+        (`is_keyframe(frame_idx)`) and runs `detect(frame_indices, frames)`
+        on all of them at once, then puts the frames with their detections
+        into the "detections" queue.
+    Iterating over the pipeline yields `(frame, boxes)` in the original order,
+    where `boxes` is None on frames that aren't keyframes, so association,
+    which needs all previous frames, runs in the consuming thread meanwhile.
+    At most `4 * batch_size` frames wait in the detect stage at once.
+    Only frames `[start, stop)` are decoded, and frame indices passed to
+    `is_keyframe` and `detect` count from the start of the video.
+    Busy time of each stage and queue depths are recorded in `stats`.
+    """
+
+    def __init__(
+        self,
+        source: str | pathlib.Path,
+        detect: tp.Callable[[list[int], list[np.ndarray]], list[np.ndarray]],
+        is_keyframe: tp.Callable[[int], bool],
+        batch_size: int = 8,
+        max_queued: int = 8,
+        stats: PipelineStats | None = None,
+        start: int = 0,
+        stop: int | None = None,
+    ) -> None:
+        self.detect_fn = detect
+        self.is_keyframe = is_keyframe
+        self.batch_size = batch_size
+        self.max_pending = 4 * batch_size
+        self.stats = PipelineStats() if stats is None else stats
+        self.stats.queues["frames"] = QueueStats(max_queued)
+        self.stats.queues["detections"] = QueueStats(max_queued)
+
+        self.detect_lock = threading.Lock()
+        self.detections = queue.Queue(maxsize=max_queued)
+        self.stopped = threading.Event()
+        self.error = None
+        self.start_secs = time.perf_counter()
+        self.start = start
+        self.reader = video.FrameReader(
+            source, max_queued, self.stats.timer, start, stop
+        )
+        self.thread = threading.Thread(target=self._detect, daemon=True)
+        self.thread.start()
+
+    def detect(
+        self, frame_indices: list[int], frames: list[np.ndarray]
+    ) -> list[np.ndarray]:
+        """
+        Runs the detector on `frames`. Can also be called by the consumer
+        for frames that weren't scheduled as keyframes.
+        """
+        with self.detect_lock, self.stats.timer.measure("detect"):
+            return self.detect_fn(frame_indices, frames)
+
+    def _put(self, item: tuple[np.ndarray, np.ndarray | None] | None) -> bool:
+        """Queues `item`, returns False if the pipeline has been closed."""
+        while not self.stopped.is_set():
+            try:
+                self.detections.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _flush(self, pending: list[tuple[int, np.ndarray]]) -> bool:
+        """Detects objects on the keyframes of `pending` and queues them."""
+        keyframes = [
+            (frame_idx, frame)
+            for frame_idx, frame in pending
+            if self.is_keyframe(frame_idx)
+        ]
+        boxes = {}
+        if keyframes:
+            frame_indices, frames = zip(*keyframes)
+            boxes = dict(
+                zip(
+                    frame_indices,
+                    self.detect(list(frame_indices), list(frames)),
+                )
+            )
+        return all(
+            self._put((frame, boxes.get(frame_idx)))
+            for frame_idx, frame in pending
+        )
+
+    def _detect(self) -> None:
+        """Batches keyframes from the reader until the video ends."""
+        pending = []
+        num_keyframes = 0
+        frames_stats = self.stats.queues["frames"]
+        try:
+            for frame_idx, frame in enumerate(self.reader, start=self.start):
+                frames_stats.sample(self.reader.frames.qsize())
+                pending.append((frame_idx, frame))
+                num_keyframes += self.is_keyframe(frame_idx)
+                if (
+                    num_keyframes == self.batch_size
+                    or len(pending) == self.max_pending
+                ):
+                    if not self._flush(pending):
+                        return
+                    pending = []
+                    num_keyframes = 0
+            self._flush(pending)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+        finally:
+            self._put(None)
+
+    def __iter__(self) -> tp.Iterator[tuple[np.ndarray, np.ndarray | None]]:
+        detections_stats = self.stats.queues["detections"]
+        while True:
+            detections_stats.sample(self.detections.qsize())
+            if (item := self.detections.get()) is None:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> None:
+        """Stops all stages, even if not all frames have been processed."""
+        self.stats.wall_secs = time.perf_counter() - self.start_secs
+        self.stopped.set()
+        self.reader.close()
+        self.thread.join()
+
+    def __enter__(self) -> "TrackingPipeline":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -0,0 +1,101 @@
+import collections
+import dataclasses
+import logging
+import threading
+import time
+import typing as tp
+
+import torch
+
+
+T = tp.TypeVar("T")
+
+
+@dataclasses.dataclass
+class ModelStats:
+    loads: int = 0
+    hits: int = 0
+    evictions: int = 0
+    load_secs: float = 0.0
+    size_bytes: int = 0
+
+
+def model_size(model: tp.Any) -> int:
+    """
+    Estimates the memory taken by the weights of `model`: either a torch module
+    itself or an object holding torch modules as attributes (e.g. `RaftGMC`).
+    """
+    if isinstance(model, torch.nn.Module):
+        modules = [model]
+    else:
+        modules = [
+            value
+            for value in vars(model).values()
+            if isinstance(value, torch.nn.Module)
+        ]
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for module in modules
+        for tensor in [*module.parameters(), *module.buffers()]
+    )
+
+
+class ModelRegistry:
+    """
+    Keeps loaded models warm across requests.
+
+    Models are loaded lazily on the first `get` and kept in memory afterwards.
+    If `max_bytes` is set and the total size of the loaded models exceeds it,
+    the least recently used models are evicted.
+    """
+
+    def __init__(self, max_bytes: int | None = None) -> None:
+        self.max_bytes = max_bytes
+        self.models = collections.OrderedDict()
+        self.stats = collections.defaultdict(ModelStats)
+        self.lock = threading.Lock()
+
+    def get(self, name: str, loader: tp.Callable[[], T]) -> T:
+        """
+        Returns the model called `name`, loading it with `loader`
+        if it isn't loaded yet.
+        """
+        with self.lock:
+            stats = self.stats[name]
+            if name in self.models:
+                self.models.move_to_end(name)
+                stats.hits += 1
+                return self.models[name]
+
+            start = time.perf_counter()
+            model = loader()
+            stats.load_secs += time.perf_counter() - start
+            stats.loads += 1
+            stats.size_bytes = model_size(model)
+            logging.info(
+                f"Loaded model {name} in {stats.load_secs:.2f} s total, "
+                f"{stats.size_bytes / 2**20:.1f} MiB"
+            )
+
+            self.models[name] = model
+            self._evict(keep=name)
+            return model
+
+    def _evict(self, keep: str) -> None:
+        """Evicts LRU models until they fit in `max_bytes`, except `keep`."""
+        if self.max_bytes is None:
+            return
+        total = sum(self.stats[name].size_bytes for name in self.models)
+        for name in list(self.models.keys()):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            del self.models[name]
+            total -= self.stats[name].size_bytes
+            self.stats[name].evictions += 1
+            logging.info(f"Evicted model {name} from the registry")
+
+    def is_loaded(self, name: str) -> bool:
+        """Checks whether the model called `name` is currently in memory."""
+        return name in self.models
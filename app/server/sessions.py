@@ -0,0 +1,143 @@
+import collections
+import dataclasses
+import logging
+import os
+import pathlib
+import shutil
+import uuid
+
+import track_store
+import video
+
+
+def dir_size(path: pathlib.Path) -> int:
+    """Returns the total size of all files under `path` in bytes."""
+    if not path.exists():
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(path)
+        for file in files
+    )
+
+
+@dataclasses.dataclass
+class Session:
+    """
+    Everything related to one uploaded video: the video itself, its track store
+    and all videos rendered from it, kept in the directory `dir`.
+    """
+
+    id: str
+    dir: pathlib.Path
+    original_path: pathlib.Path | None = None
+    index: track_store.PlayerIndex | None = None
+    # The last /make_video render, whose segments can be reused
+    last_render: video.SegmentedRender | None = None
+    active_jobs: int = 0
+    # Finished jobs whose results haven't been sent to the client yet
+    unfetched_jobs: set[str] = dataclasses.field(default_factory=set)
+
+    @property
+    def tracks_dir(self) -> pathlib.Path:
+        return self.dir / "tracks"
+
+    @property
+    def clean_path(self) -> pathlib.Path:
+        return self.dir / "clean.mp4"
+
+    @property
+    def focused_dir(self) -> pathlib.Path:
+        return self.dir / "focused"
+
+    @property
+    def renders_dir(self) -> pathlib.Path:
+        return self.dir / "renders"
+
+    @property
+    def segments_dir(self) -> pathlib.Path:
+        return self.renders_dir / "segments"
+
+    def player_ids(self) -> set[int]:
+        """Returns the ids of all tracked players."""
+        return self.index.player_ids()
+
+
+class SessionStore:
+    """
+    Keeps each session in its own directory under `root`.
+
+    When the total size of all sessions exceeds `max_bytes`, files of the least
+    recently used sessions are deleted: first rendered and precomputed focused
+    videos, since they can be generated again, then whole sessions.
+    Sessions with running jobs are never evicted, and sessions with results
+    that haven't been fetched yet are evicted after all others.
+    """
+
+    def __init__(self, root: pathlib.Path, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.sessions = collections.OrderedDict()
+
+        # Sessions from previous runs can't be accessed anymore
+        shutil.rmtree(self.root, ignore_errors=True)
+        self.root.mkdir(parents=True)
+
+    def create(self) -> Session:
+        """Creates a new empty session."""
+        session_id = uuid.uuid4().hex
+        session = Session(id=session_id, dir=self.root / session_id)
+        session.renders_dir.mkdir(parents=True)
+        self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id: str) -> Session | None:
+        """
+        Returns the session with id `session_id`, or None if there isn't one.
+        The session is marked as recently used.
+        """
+        session = self.sessions.get(session_id)
+        if session is not None:
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def evict(self, keep: str | None = None) -> list[str]:
+        """
+        Deletes files of the least recently used sessions until all sessions
+        fit in `max_bytes`, except the session with id `keep`.
+        Returns the ids of the deleted sessions.
+        """
+        total = sum(
+            dir_size(session.dir) for session in self.sessions.values()
+        )
+        if total <= self.max_bytes:
+            return []
+
+        idle = [
+            session
+            for session in self.sessions.values()
+            if session.active_jobs == 0 and session.id != keep
+        ]
+        # Stable, so the sessions stay in LRU order within each group
+        idle.sort(key=lambda session: bool(session.unfetched_jobs))
+        for session in idle:
+            if total <= self.max_bytes:
+                return []
+            for path in [session.renders_dir, session.focused_dir]:
+                total -= dir_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+            session.renders_dir.mkdir()
+            # Its segments are gone, so the next render starts from scratch
+            session.last_render = None
+            logging.info(f"Evicted rendered videos of session {session.id}")
+
+        evicted = []
+        for session in idle:
+            if total <= self.max_bytes:
+                break
+            total -= dir_size(session.dir)
+            shutil.rmtree(session.dir)
+            del self.sessions[session.id]
+            evicted.append(session.id)
+            logging.info(f"Evicted session {session.id}")
+        return evicted
@@ -0,0 +1,326 @@
+import concurrent.futures
+import multiprocessing
+import pathlib
+import typing as tp
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+import ultralytics.trackers.utils.matching
+
+import cache
+import jobs
+import track_store
+import tracking
+
+
+# Adjacent shards overlap by this many seconds, where their ids are matched
+OVERLAP_SECS = 2.0
+# Shards are at least this many times longer than the overlap
+MIN_SHARD_OVERLAPS = 10
+# Tracks of adjacent shards are linked only if their boxes have at least
+# this IoU on average over the frames where either of them is present
+MIN_STITCH_IOU = 0.5
+# Weight of the difference of track velocities (in box heights per frame)
+# in the matching cost, next to 1 - mean IoU
+MOTION_WEIGHT = 10.0
+# Cost of pairs of tracks that can't be linked
+GATE_COST = 1e5
+# How often `track_sharded` reports progress while shards are running,
+# which is also when a cancelled job stops
+POLL_SECS = 0.5
+
+
+def shard_bounds(
+    num_frames: int, num_shards: int, overlap: int
+) -> list[tuple[int, int]]:
+    """
+    Splits frames `[0, num_frames)` into at most `num_shards` parts of similar
+    length, each at least `MIN_SHARD_OVERLAPS * overlap` frames long, and
+    extends every part but the first `overlap` frames back into the previous
+    one. Returns the `(start, stop)` of each shard.
+    """
+    min_frames = max(1, MIN_SHARD_OVERLAPS * overlap)
+    num_shards = max(1, min(num_shards, num_frames // min_frames))
+    bounds = np.linspace(0, num_frames, num_shards + 1).round().astype(int)
+    return [
+        (max(0, int(left) - overlap), int(right))
+        for left, right in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def track_shard(
+    source: str | pathlib.Path,
+    detector: str,
+    tracker: str,
+    start: int,
+    stop: int | None,
+    stride: int | None,
+    adaptive_stride: bool | None,
+    num_threads: int,
+    video_digest: str,
+) -> track_store.TrackStore:
+    """
+    Tracks frames `[start, stop)` of `source` (to the end if `stop` is None),
+    whose hash is `video_digest`, with the detector and the tracker with
+    the given slugs (see `tracking.track`).
+    Runs in a worker process of `track_sharded` with `num_threads` threads
+    for torch and OpenCV.
+    """
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+    return tracking.track(
+        source,
+        tracking.DETECTORS[detector],
+        tracking.TRACKERS[tracker],
+        stride=stride,
+        adaptive_stride=adaptive_stride,
+        start=start,
+        stop=stop,
+        video_digest=video_digest,
+    )
+
+
+def velocities(
+    frames: np.ndarray, xyxy: np.ndarray
+) -> tuple[np.ndarray, float]:
+    """
+    Returns the velocity of the center of a track with boxes `xyxy` on
+    `frames`, in pixels per frame, and the mean height of the boxes.
+    """
+    centers = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+    height = float(np.mean(xyxy[:, 3] - xyxy[:, 1]))
+    if len(np.unique(frames)) < 2:
+        return np.zeros(2), height
+    return np.polyfit(frames, centers, 1)[0], height
+
+
+def match_tracks(
+    prev: track_store.TrackStore, next_: track_store.TrackStore
+) -> dict[int, int]:
+    """
+    Matches the tracks of two adjacent shards over their overlap:
+    `prev` and `next_` are the boxes of the earlier and the later shard
+    on the same frames. Two tracks are linked if their boxes agree on
+    average (IoU over the frames where either of them is present) and
+    their centers move with similar velocities, which tells apart players
+    running past each other. Returns the matched ids of `next_` mapped
+    to the ids of `prev`.
+    """
+    prev_ids, prev_counts = np.unique(prev.track_id, return_counts=True)
+    next_ids, next_counts = np.unique(next_.track_id, return_counts=True)
+    if len(prev_ids) == 0 or len(next_ids) == 0:
+        return {}
+
+    iou_sums = np.zeros((len(prev_ids), len(next_ids)))
+    shared = np.zeros((len(prev_ids), len(next_ids)))
+    for frame in range(prev.num_frames):
+        prev_frame_ids, prev_boxes = prev.frame(frame)
+        next_frame_ids, next_boxes = next_.frame(frame)
+        if len(prev_frame_ids) == 0 or len(next_frame_ids) == 0:
+            continue
+        rows = np.searchsorted(prev_ids, prev_frame_ids)[:, None]
+        cols = np.searchsorted(next_ids, next_frame_ids)[None, :]
+        ious = torchvision.ops.box_iou(
+            torch.from_numpy(np.asarray(prev_boxes)),
+            torch.from_numpy(np.asarray(next_boxes)),
+        ).numpy()
+        np.add.at(iou_sums, (rows, cols), ious)
+        np.add.at(shared, (rows, cols), 1)
+    mean_ious = iou_sums / (
+        prev_counts[:, None] + next_counts[None, :] - shared
+    )
+
+    prev_index = track_store.PlayerIndex(prev)
+    next_index = track_store.PlayerIndex(next_)
+    prev_motion = [
+        velocities(prev_index[pid].frames, prev_index[pid].xyxy)
+        for pid in prev_ids.tolist()
+    ]
+    next_motion = [
+        velocities(next_index[pid].frames, next_index[pid].xyxy)
+        for pid in next_ids.tolist()
+    ]
+    motion_costs = np.array(
+        [
+            [
+                np.linalg.norm(prev_v - next_v) / ((prev_h + next_h) / 2)
+                for next_v, next_h in next_motion
+            ]
+            for prev_v, prev_h in prev_motion
+        ]
+    )
+
+    costs = 1 - mean_ious + MOTION_WEIGHT * motion_costs
+    costs[mean_ious < MIN_STITCH_IOU] = GATE_COST
+    matches, _, _ = ultralytics.trackers.utils.matching.linear_assignment(
+        costs, thresh=GATE_COST / 2
+    )
+    return {
+        int(next_ids[col]): int(prev_ids[row]) for row, col in matches.tolist()
+    }
+
+
+def stitch(
+    shards: list[tuple[int, int]],
+    stores: list[track_store.TrackStore],
+    fps: float,
+) -> track_store.TrackStore:
+    """
+    Joins the tracks of `shards` (see `shard_bounds`), tracked into `stores`,
+    into the tracks of the whole video with one set of ids.
+    A track of a shard that matches a track of the previous shard in their
+    overlap (see `match_tracks`) continues its id, others get new ids.
+    The first half of each overlap is taken from the earlier shard and
+    the second from the later one, whose tracks need a few frames after
+    its start to be confirmed.
+    """
+    # The frame count of the video may be off, so the last shard decides
+    num_frames = shards[-1][0] + stores[-1].num_frames
+    columns = {column: [] for column in track_store.COLUMNS}
+    next_id = 1
+    prev_tracks = None
+    for shard_idx, ((start, stop), store) in enumerate(zip(shards, stores)):
+        id_map = {}
+        if prev_tracks is not None:
+            overlap_stop = prev_tracks.num_frames
+            id_map = match_tracks(
+                prev_tracks.frame_range(start, overlap_stop),
+                store.frame_range(0, overlap_stop - start),
+            )
+        for track_id in sorted(store.player_ids() - id_map.keys()):
+            id_map[track_id] = next_id
+            next_id += 1
+        keys = np.array(sorted(id_map), dtype=np.int32)
+        values = np.array(
+            [id_map[key] for key in keys.tolist()], dtype=np.int32
+        )
+        track_ids = values[np.searchsorted(keys, store.track_id)]
+        frame_idx = store.frame_idx + start
+
+        # Tracks of this shard with global ids and frames, for the next one
+        prev_tracks = track_store.TrackStore(
+            num_frames=start + store.num_frames,
+            fps=fps,
+            frame_idx=frame_idx,
+            track_id=track_ids,
+            xyxy=store.xyxy,
+            conf=store.conf,
+        )
+        keep_start = 0
+        if shard_idx > 0:
+            keep_start = (start + shards[shard_idx - 1][1]) // 2
+        keep_stop = prev_tracks.num_frames
+        if shard_idx < len(shards) - 1:
+            keep_stop = min(keep_stop, (shards[shard_idx + 1][0] + stop) // 2)
+        rows = slice(
+            prev_tracks.frame_starts[keep_start],
+            prev_tracks.frame_starts[keep_stop],
+        )
+        for column in track_store.COLUMNS:
+            columns[column].append(getattr(prev_tracks, column)[rows])
+
+    return track_store.TrackStore(
+        num_frames=num_frames,
+        fps=fps,
+        **{
+            column: np.concatenate(chunks)
+            for column, chunks in columns.items()
+        },
+    )
+
+
+def track_sharded(
+    source: str | pathlib.Path,
+    detector: str,
+    tracker: str,
+    num_shards: int,
+    store_dir: str | pathlib.Path | None = None,
+    progress: tp.Callable[[int, int], None] | None = None,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    overlap_secs: float = OVERLAP_SECS,
+) -> track_store.TrackStore:
+    """
+    Same as `tracking.track` with the detector and the tracker with
+    the given slugs, but splits the video into up to `num_shards` shards
+    overlapping by `overlap_secs` (see `shard_bounds`), tracks them in
+    parallel worker processes and stitches their ids (see `stitch`).
+    Short videos are tracked in fewer shards, down to one, which is the same
+    as `tracking.track`. The threads of this process are split between
+    the workers. Detections of the shards aren't cached (cached detections
+    of the whole video are used).
+    `progress` is called every `POLL_SECS` with the number of frames
+    in the finished shards and the total number of frames in the shards.
+    If it raises (e.g. `jobs.JobCancelled`) or a shard fails, the workers
+    of the other shards are killed.
+    """
+    capture = cv2.VideoCapture(str(source))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    shards = shard_bounds(num_frames, num_shards, round(overlap_secs * fps))
+    if len(shards) == 1:
+        return tracking.track(
+            source,
+            tracking.DETECTORS[detector],
+            tracking.TRACKERS[tracker],
+            store_dir,
+            progress,
+            stride,
+            adaptive_stride,
+        )
+
+    num_threads = max(1, torch.get_num_threads() // len(shards))
+    # Hashed once here rather than by each shard
+    video_digest = cache.file_digest(source)
+    total_frames = sum(stop - start for start, stop in shards)
+    num_done = 0
+    stores = [None] * len(shards)
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=len(shards),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    try:
+        futures = {
+            pool.submit(
+                track_shard,
+                source,
+                detector,
+                tracker,
+                start,
+                # The frame count of the video may be too low,
+                # so the last shard is decoded to the end
+                None if shard_idx == len(shards) - 1 else stop,
+                stride,
+                adaptive_stride,
+                num_threads,
+                video_digest,
+            ): shard_idx
+            for shard_idx, (start, stop) in enumerate(shards)
+        }
+        pending = set(futures)
+        while pending:
+            finished, pending = concurrent.futures.wait(
+                pending,
+                timeout=POLL_SECS,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in finished:
+                stores[futures[future]] = future.result()
+                num_done += stores[futures[future]].num_frames
+            if progress is not None:
+                progress(num_done, total_frames)
+    except BaseException:
+        # Doesn't wait for the other shards if one of them has failed
+        # or the job has been cancelled
+        jobs.terminate_workers(pool)
+        raise
+    pool.shutdown()
+
+    tracks = stitch(shards, stores, fps)
+    if store_dir is None:
+        return tracks
+    tracks.save(store_dir)
+    return track_store.TrackStore.load(store_dir)
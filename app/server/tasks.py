@@ -0,0 +1,389 @@
+import dataclasses
+import json
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import time
+import zipfile
+
+import cv2
+import numpy as np
+import torch
+
+import jobs
+import live
+import pipeline
+import sharding
+import track_store
+import tracking
+import video
+
+
+# Dict shared with the server process, used to publish model statistics
+SHARED = None
+
+
+@dataclasses.dataclass
+class TaskResult:
+    path: pathlib.Path
+    headers: dict[str, str] = dataclasses.field(default_factory=dict)
+    # Kept by the session for the next /make_video
+    render: video.SegmentedRender | None = None
+
+
+def init_worker(
+    shared, log_path: pathlib.Path, num_threads: int, preload: bool
+) -> None:
+    """
+    Sets up a worker process: logging, the number of threads used by torch
+    and OpenCV and, if `preload` is set, the model registry.
+    """
+    global SHARED  # pylint: disable=global-statement
+    SHARED = shared
+
+    logging.basicConfig(filename=log_path, level=logging.INFO)
+    torch.set_num_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+
+    if preload:
+        logging.info(f"Preloading models in worker {os.getpid()}")
+        tracking.preload_models()
+    publish_model_stats()
+
+
+def publish_model_stats() -> None:
+    """
+    Copies the model registry and cache statistics of this worker
+    to `SHARED`.
+    """
+    SHARED[f"model_stats:{os.getpid()}"] = {
+        name: (dataclasses.replace(stats), tracking.MODELS.is_loaded(name))
+        for name, stats in tracking.MODELS.stats.items()
+    }
+    SHARED[f"cache_stats:{os.getpid()}"] = {
+        name: dataclasses.replace(disk_cache.stats)
+        for name, disk_cache in tracking.CACHES.items()
+    }
+
+
+def infer(
+    context: jobs.JobContext,
+    out_dir: pathlib.Path,
+    original_path: pathlib.Path,
+    detector: str,
+    tracker: str,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    output: video.OutputMode = video.OutputMode.VIDEO,
+    precompute_focused: int = 0,
+    growing: bool = False,
+    num_shards: int = 1,
+) -> TaskResult:
+    """
+    Tracks players on the video at `original_path` and saves to `out_dir`:
+      - the track store (tracks/),
+      - a video with boxes and labels (annotated.mp4) or, with the overlay
+        `output`, a clean video (clean.mp4) and the boxes to draw on it
+        (overlay.json, see `video.make_overlay`),
+      - an image of each player from their first detection (images/),
+      - a zip archive with the video, the overlay and the images
+        (archive.zip),
+      - videos focused on the `precompute_focused` players with the most
+        screen time (focused/{player_id}.mp4), which aren't archived.
+    `stride` and `adaptive_stride` override those of the detector.
+    If `growing` is set, the video is still being uploaded and tracking starts
+    on the part received so far (see `tracking.track`). Otherwise, with
+    several `num_shards`, parts of the video are tracked in parallel
+    processes and their ids are stitched (see `sharding.track_sharded`).
+    """
+    started_at = time.time()
+    overlay = output == video.OutputMode.OVERLAY
+    tracks_dir = out_dir / "tracks"
+    images_dir = out_dir / "images"
+    annotated_path = out_dir / ("clean.mp4" if overlay else "annotated.mp4")
+    overlay_path = out_dir / "overlay.json"
+    zip_path = out_dir / "archive.zip"
+    images_dir.mkdir(parents=True, exist_ok=True)
+
+    timer = video.StageTimer()
+    pipeline_stats = pipeline.PipelineStats()
+    with timer.measure("tracking"):
+        if num_shards > 1 and not growing:
+            tracks = sharding.track_sharded(
+                original_path,
+                detector,
+                tracker,
+                num_shards,
+                store_dir=tracks_dir,
+                progress=context.progress("tracking"),
+                stride=stride,
+                adaptive_stride=adaptive_stride,
+            )
+        else:
+            tracks = tracking.track(
+                source=original_path,
+                detector=tracking.DETECTORS[detector],
+                tracker=tracking.TRACKERS[tracker],
+                store_dir=tracks_dir,
+                progress=context.progress("tracking"),
+                stride=stride,
+                adaptive_stride=adaptive_stride,
+                stats=pipeline_stats,
+                growing=growing,
+            )
+    publish_model_stats()
+
+    with timer.measure("index"):
+        index = track_store.PlayerIndex(tracks)
+    video.postprocess(
+        original_path,
+        annotated_path,
+        images_dir,
+        tracks,
+        timer,
+        progress=context.progress("rendering"),
+        annotate=not overlay,
+    )
+    if overlay:
+        with timer.measure("overlay"):
+            overlay_path.write_text(json.dumps(video.make_overlay(tracks)))
+
+    focused_ids = sorted(
+        index.player_ids(),
+        key=lambda pid: len(index[pid].frames),
+        reverse=True,
+    )[:precompute_focused]
+    if focused_ids:
+        focused_dir = out_dir / "focused"
+        focused_dir.mkdir(exist_ok=True)
+        with timer.measure("focused"):
+            video.crop_to_players(
+                original_path,
+                {pid: focused_dir / f"{pid}.mp4" for pid in focused_ids},
+                index,
+                progress=context.progress("focused videos"),
+            )
+    logging.info(
+        f"infer job {context.job_id} stage times (s): {timer.to_header()}"
+    )
+
+    start_secs, end_secs = index.player_times()
+    player_ids_sorted = sorted(index.player_ids())
+
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        archive.write(annotated_path, annotated_path.relative_to(out_dir))
+        if overlay:
+            archive.write(overlay_path, overlay_path.relative_to(out_dir))
+        for file in images_dir.iterdir():
+            archive.write(file, file.relative_to(out_dir))
+
+    return TaskResult(
+        path=zip_path,
+        headers={
+            "player_ids": ",".join(str(pid) for pid in player_ids_sorted),
+            "player_times": ",".join(
+                f"{start_secs[pid]}-{end_secs[pid]}"
+                for pid in player_ids_sorted
+            ),
+            "focused_ids": ",".join(str(pid) for pid in focused_ids),
+            "stage_times": timer.to_header(),
+            "pipeline_stats": pipeline_stats.to_header(),
+            "gmc_paths": pipeline_stats.gmc_paths_header(),
+            "started_at": str(started_at),
+        },
+    )
+
+
+def make_video(
+    context: jobs.JobContext,
+    out_path: pathlib.Path,
+    original_path: pathlib.Path,
+    tracks_dir: pathlib.Path,
+    player_params: dict[int, video.PlayerParams],
+    segments_dir: pathlib.Path,
+    previous: video.SegmentedRender | None = None,
+    num_workers: int = 1,
+) -> TaskResult:
+    """
+    Renders a video with boxes and labels according to `player_params`.
+    Only the segments of the `previous` render of this session where players
+    with changed params appear are rendered again, by `num_workers` processes.
+    The new render is returned in `TaskResult.render`.
+    """
+    render = video.draw_bboxes_incremental(
+        original_path,
+        out_path,
+        track_store.TrackStore.load(tracks_dir),
+        player_params,
+        segments_dir,
+        previous,
+        num_workers=num_workers,
+        progress=context.progress("rendering"),
+    )
+    reused = set(render.segment_paths) & set(
+        [] if previous is None else previous.segment_paths
+    )
+    num_segments = len(render.segment_paths)
+    return TaskResult(
+        path=out_path,
+        headers={
+            "rendered_segments": f"{num_segments - len(reused)}/{num_segments}"
+        },
+        render=render,
+    )
+
+
+def make_focused_video(
+    context: jobs.JobContext,
+    out_path: pathlib.Path,
+    original_path: pathlib.Path,
+    tracks_dir: pathlib.Path,
+    player_id: int,
+    focused_dir: pathlib.Path,
+) -> TaskResult:
+    """
+    Renders a video focused on the movements of player `player_id`,
+    unless it has been precomputed in `focused_dir` by `infer`.
+    """
+    precomputed_path = focused_dir / f"{player_id}.mp4"
+    if precomputed_path.exists():
+        return TaskResult(path=precomputed_path)
+
+    video.crop_to_player(
+        original_path,
+        out_path,
+        track_store.PlayerIndex(track_store.TrackStore.load(tracks_dir)),
+        player_id,
+        progress=context.progress("rendering"),
+    )
+    return TaskResult(path=out_path)
+
+
+def make_focused_videos(
+    context: jobs.JobContext,
+    zip_path: pathlib.Path,
+    original_path: pathlib.Path,
+    tracks_dir: pathlib.Path,
+    player_ids: list[int],
+    focused_dir: pathlib.Path,
+) -> TaskResult:
+    """
+    Renders videos focused on each of `player_ids` in one pass over the video
+    and returns a zip archive with them ({player_id}.mp4).
+    Videos precomputed in `focused_dir` by `infer` are reused.
+    """
+    out_dir = zip_path.with_suffix("")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_paths = {
+        pid: (
+            focused_dir / f"{pid}.mp4"
+            if (focused_dir / f"{pid}.mp4").exists()
+            else out_dir / f"{pid}.mp4"
+        )
+        for pid in player_ids
+    }
+    missing = {
+        pid: path for pid, path in out_paths.items() if path.parent == out_dir
+    }
+    if missing:
+        video.crop_to_players(
+            original_path,
+            missing,
+            track_store.PlayerIndex(track_store.TrackStore.load(tracks_dir)),
+            progress=context.progress("rendering"),
+        )
+
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for pid, path in out_paths.items():
+            archive.write(path, f"{pid}.mp4")
+    shutil.rmtree(out_dir)
+    return TaskResult(path=zip_path)
+
+
+def track_live(
+    context: jobs.JobContext,
+    out_path: pathlib.Path,
+    messages,
+    source: str,
+    replay: bool,
+    detector: str,
+    tracker: str,
+    latency_ms: float,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+) -> TaskResult:
+    """
+    Tracks players on a live stream (see `tracking.track_live`) until it ends
+    or the job is cancelled. A message for each processed frame is put into
+    `messages`, a queue read by `live.LiveBroadcast` in the server process:
+      - {"type": "start", "fps", "width", "height"} first,
+      - {"type": "frame", "frame", "captured_at", "processed_at", "dropped",
+        "track_ids", "boxes"} for each frame, where `dropped` is the number
+        of frames dropped so far and boxes are xyxy,
+      - {"type": "end"} last, even if the job fails or is cancelled.
+    If the server falls behind and the queue is full, frames are dropped too.
+    The numbers of processed and dropped frames are saved to `out_path`.
+    """
+    counts = {"processed": 0, "source": 0, "late": 0, "queue": 0}
+
+    def emit(frame: live.LiveFrame, tracks: np.ndarray) -> None:
+        counts["processed"] += 1
+        # Frames received up to this one, minus those sent so far
+        dropped = frame.idx + 1 - (counts["processed"] - counts["queue"])
+        if len(tracks) == 0:
+            # No confirmed tracks yet, e.g. on the first frames of the stream
+            track_ids, boxes = [], []
+        else:
+            track_ids = tracks[:, 4].astype(int).tolist()
+            boxes = tracks[:, :4].round(1).tolist()
+        try:
+            messages.put_nowait(
+                {
+                    "type": "frame",
+                    "frame": frame.idx,
+                    "captured_at": frame.captured_at,
+                    "processed_at": time.time(),
+                    "dropped": dropped,
+                    "track_ids": track_ids,
+                    "boxes": boxes,
+                }
+            )
+        except queue.Full:
+            counts["queue"] += 1
+
+    try:
+        with live.LatestFrameSource(source, replay) as frames:
+            messages.put(
+                {
+                    "type": "start",
+                    "fps": frames.fps,
+                    "width": frames.width,
+                    "height": frames.height,
+                }
+            )
+            counts["late"] = tracking.track_live(
+                frames,
+                tracking.DETECTORS[detector],
+                tracking.TRACKERS[tracker],
+                emit,
+                latency_ms / 1000,
+                stride,
+                adaptive_stride,
+                progress=lambda done: context.report("live", done, 0),
+            )
+            counts["source"] = frames.dropped
+    finally:
+        messages.put({"type": "end"})
+    publish_model_stats()
+
+    logging.info(f"live job {context.job_id} frames: {counts}")
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out_path.write_text(json.dumps(counts))
+    return TaskResult(
+        path=out_path,
+        headers={
+            "live_frames": ",".join(f"{k}={v}" for k, v in counts.items())
+        },
+    )
@@ -0,0 +1,234 @@
+import dataclasses
+import json
+import os
+import pathlib
+import typing as tp
+
+import numpy as np
+
+
+COLUMNS = ["frame_idx", "track_id", "xyxy", "conf"]
+
+
+@dataclasses.dataclass
+class TrackStore:
+    """
+    Tracked boxes of a whole video stored as flat NumPy arrays.
+
+    Row `i` describes one box: the frame it belongs to (`frame_idx[i]`),
+    the id of the tracked player (`track_id[i]`), its coordinates
+    (`xyxy[i]`) and the detector confidence (`conf[i]`).
+    Rows are sorted by frame, so the boxes of one frame are a contiguous slice.
+    """
+
+    num_frames: int
+    fps: float
+    frame_idx: np.ndarray  # [N], int32
+    track_id: np.ndarray  # [N], int32
+    xyxy: np.ndarray  # [N, 4], float32
+    conf: np.ndarray  # [N], float32
+
+    def __post_init__(self) -> None:
+        # Rows of frame `i` are `frame_starts[i]:frame_starts[i + 1]`
+        self.frame_starts = np.searchsorted(
+            self.frame_idx, np.arange(self.num_frames + 1)
+        )
+
+    def frame(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the track ids [n] and boxes [n, 4] of frame `idx`."""
+        rows = slice(self.frame_starts[idx], self.frame_starts[idx + 1])
+        return self.track_id[rows], self.xyxy[rows]
+
+    def iter_frames(self) -> tp.Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Yields the track ids and boxes of each frame in order."""
+        for idx in range(self.num_frames):
+            yield self.frame(idx)
+
+    def player_ids(self) -> set[int]:
+        """Returns the ids of all tracked players."""
+        return set(np.unique(self.track_id).tolist())
+
+    def frame_range(self, start: int, stop: int) -> tp.Self:
+        """
+        Returns a store with only frames `[start, stop)`, renumbered
+        from 0. The columns are copied into memory.
+        """
+        rows = slice(self.frame_starts[start], self.frame_starts[stop])
+        return TrackStore(
+            num_frames=stop - start,
+            fps=self.fps,
+            frame_idx=self.frame_idx[rows] - start,
+            track_id=np.array(self.track_id[rows]),
+            xyxy=np.array(self.xyxy[rows]),
+            conf=np.array(self.conf[rows]),
+        )
+
+    def save(self, out_dir: str | pathlib.Path) -> None:
+        """
+        Saves the store to `out_dir` as one .npy file per column.
+        Files are replaced atomically, so a store that is still memory-mapped
+        from the same directory keeps working.
+        """
+        out_dir = pathlib.Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for column in COLUMNS:
+            tmp_path = out_dir / f"{column}.tmp.npy"
+            np.save(tmp_path, getattr(self, column))
+            os.replace(tmp_path, out_dir / f"{column}.npy")
+        meta = {"num_frames": self.num_frames, "fps": self.fps}
+        (out_dir / "meta.json").write_text(json.dumps(meta))
+
+    def save_mot(self, path: str | pathlib.Path) -> None:
+        """
+        Saves the boxes to a text file in the MOTChallenge format: one line
+        `frame,id,x,y,w,h,conf,-1,-1,-1` per box, with frames counted from 1
+        and the top left corner, width and height of the box in pixels.
+        """
+        xywh = np.array(self.xyxy, dtype=np.float64)
+        xywh[:, 2:] -= xywh[:, :2]
+        rows = np.column_stack(
+            [
+                self.frame_idx + 1,
+                self.track_id,
+                xywh,
+                self.conf,
+                np.full((len(xywh), 3), -1),
+            ]
+        )
+        np.savetxt(
+            path,
+            rows,
+            fmt=["%d", "%d"] + ["%.2f"] * 4 + ["%.4f"] + ["%d"] * 3,
+            delimiter=",",
+        )
+
+    @classmethod
+    def load(cls, in_dir: str | pathlib.Path, mmap: bool = True) -> tp.Self:
+        """
+        Loads a store saved with `save`.
+        If `mmap` is set, the columns are memory-mapped instead of being read
+        into memory.
+        """
+        in_dir = pathlib.Path(in_dir)
+        meta = json.loads((in_dir / "meta.json").read_text())
+        columns = {
+            column: np.load(
+                in_dir / f"{column}.npy", mmap_mode="r" if mmap else None
+            )
+            for column in COLUMNS
+        }
+        return cls(**meta, **columns)
+
+
+class TrackStoreBuilder:
+    """Collects tracked boxes frame by frame and builds a `TrackStore`."""
+
+    def __init__(self, fps: float) -> None:
+        self.fps = fps
+        self.num_frames = 0
+        self.chunks = {
+            "frame_idx": [np.empty(0, dtype=np.int32)],
+            "track_id": [np.empty(0, dtype=np.int32)],
+            "xyxy": [np.empty((0, 4), dtype=np.float32)],
+            "conf": [np.empty(0, dtype=np.float32)],
+        }
+
+    def add_frame(
+        self, track_id: np.ndarray, xyxy: np.ndarray, conf: np.ndarray
+    ) -> None:
+        """Adds the boxes of the next frame (possibly none)."""
+        self.chunks["frame_idx"].append(
+            np.full(len(track_id), self.num_frames, dtype=np.int32)
+        )
+        self.chunks["track_id"].append(track_id.astype(np.int32))
+        self.chunks["xyxy"].append(xyxy.astype(np.float32).reshape(-1, 4))
+        self.chunks["conf"].append(conf.astype(np.float32))
+        self.num_frames += 1
+
+    def build(self, out_dir: str | pathlib.Path | None = None) -> TrackStore:
+        """
+        Concatenates the collected boxes into a `TrackStore`.
+        If `out_dir` is given, the store is saved there and returned
+        memory-mapped from disk.
+        """
+        columns = {
+            column: np.concatenate(chunks)
+            for column, chunks in self.chunks.items()
+        }
+        store = TrackStore(num_frames=self.num_frames, fps=self.fps, **columns)
+        if out_dir is None:
+            return store
+        store.save(out_dir)
+        return TrackStore.load(out_dir)
+
+
+@dataclasses.dataclass
+class Trajectory:
+    """Boxes of a single player sorted by frame."""
+
+    frames: np.ndarray  # [n], int32, sorted
+    xyxy: np.ndarray  # [n, 4], float32
+
+    def first_frame(self) -> int:
+        """Returns the first frame where the player appears."""
+        return int(self.frames[0])
+
+    def last_frame(self) -> int:
+        """Returns the last frame where the player appears."""
+        return int(self.frames[-1])
+
+    def box_at(self, frame: int) -> np.ndarray | None:
+        """Returns the player's box on `frame`, or None if they are absent."""
+        pos = np.searchsorted(self.frames, frame)
+        if pos < len(self.frames) and self.frames[pos] == frame:
+            return self.xyxy[pos]
+        return None
+
+    def frame_range(self, start: int, stop: int) -> tp.Self:
+        """Returns the part of the trajectory on frames `[start, stop)`."""
+        left, right = np.searchsorted(self.frames, [start, stop])
+        return Trajectory(self.frames[left:right], self.xyxy[left:right])
+
+
+class PlayerIndex:
+    """
+    Maps each player id to their `Trajectory`.
+    Built once from a `TrackStore` so that per-player queries don't need
+    to scan every frame of the video.
+    """
+
+    def __init__(self, tracks: TrackStore) -> None:
+        self.fps = tracks.fps
+        self.num_frames = tracks.num_frames
+        order = np.lexsort((tracks.frame_idx, tracks.track_id))
+        track_ids = tracks.track_id[order]
+        frames = tracks.frame_idx[order]
+        xyxy = tracks.xyxy[order]
+
+        player_ids, starts = np.unique(track_ids, return_index=True)
+        ends = np.append(starts[1:], len(track_ids))
+        self.trajectories = {
+            pid: Trajectory(frames[start:end], xyxy[start:end])
+            for pid, start, end in zip(player_ids.tolist(), starts, ends)
+        }
+
+    def __contains__(self, player_id: int) -> bool:
+        return player_id in self.trajectories
+
+    def __getitem__(self, player_id: int) -> Trajectory:
+        return self.trajectories[player_id]
+
+    def player_ids(self) -> set[int]:
+        """Returns the ids of all tracked players."""
+        return set(self.trajectories.keys())
+
+    def player_times(self) -> tuple[dict[int, int], dict[int, int]]:
+        """
+        Returns the seconds of the first and last appearance of each player.
+        """
+        start_secs = {}
+        end_secs = {}
+        for pid, trajectory in self.trajectories.items():
+            start_secs[pid] = round(trajectory.first_frame() / self.fps)
+            end_secs[pid] = round(trajectory.last_frame() / self.fps)
+        return start_secs, end_secs
@@ -1,16 +1,80 @@
+import contextlib
 import dataclasses
+import logging
+import os
+import pathlib
+import time
 import typing as tp
 
+import cv2
 import numpy as np
 import torch
 import torchvision
-import torchvision.transforms.functional as F
 import ultralytics.engine.model
 import ultralytics.engine.results
+import ultralytics.trackers.bot_sort
+import ultralytics.trackers.byte_tracker
 import ultralytics.trackers.utils.gmc
+import ultralytics.utils
 
+import cache
+import gmc
+import live
+import pipeline
+import registry
+import track_store
+import upload
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Total size of the models kept warm in memory, unlimited if not set
+MODEL_CACHE_MB = os.environ.get("MODEL_CACHE_MB")
+MODELS = registry.ModelRegistry(
+    max_bytes=None if MODEL_CACHE_MB is None else int(MODEL_CACHE_MB) * 2**20
+)
+
+# Arguments of the detector, the same as `ultralytics` uses for tracking
+DETECTION_ARGS = {"conf": 0.1, "batch": 1}
+# Number of keyframes the tracking pipeline passes to the detector at once
+DETECTION_BATCH_SIZE = int(os.environ.get("DETECTION_BATCH_SIZE", 8))
+
+# Raw detections of each video, reused when only the tracker changes
+DETECTIONS = cache.DiskCache(
+    pathlib.Path(os.environ.get("DETECTION_CACHE_DIR", "cache/detections")),
+    max_bytes=int(os.environ.get("DETECTION_CACHE_MB", 2048)) * 2**20,
+)
+
+# Frame-to-frame GMC matrices of each video, reused when the detector changes
+GMC_MATRICES = cache.DiskCache(
+    pathlib.Path(os.environ.get("GMC_CACHE_DIR", "cache/gmc")),
+    max_bytes=int(os.environ.get("GMC_CACHE_MB", 256)) * 2**20,
+)
+
+CACHES = {"detections": DETECTIONS, "gmc": GMC_MATRICES}
+
+# Time the GMC wrapped by the adaptive trackers may spend per frame on average
+# before they fall back to phase correlation, unlimited if not set
+ADAPTIVE_GMC_BUDGET_MS = os.environ.get("ADAPTIVE_GMC_BUDGET_MS")
+
+# CPU inference backends of the models exported by `export.py`
+BACKENDS = {"onnx": "ONNX Runtime", "openvino": "OpenVINO"}
+# Exported RAFT-small, there are no .pt weights since torchvision loads them
+RAFT_EXPORT_STEM = "models/raft-small"
+
+# With an adaptive stride, the detector also runs on the next frame
+# if the mean confidence of the tracks drops below this
+ADAPTIVE_MIN_SCORE = 0.5
+
+
+def exported_path(weights_path: str, backend: str, int8: bool) -> str:
+    """
+    Returns where `export.py` saves the model `weights_path` exported for
+    `backend`: an .onnx file or, for OpenVINO, a directory in the format
+    used by `ultralytics`.
+    """
+    stem = str(pathlib.Path(weights_path).with_suffix(""))
+    if int8:
+        stem += "-int8"
+    return f"{stem}.onnx" if backend == "onnx" else f"{stem}_openvino_model"
 
 
 @dataclasses.dataclass
@@ -18,127 +82,491 @@ class Detector:
     weights_path: str
     ui_name: str
     model_class: type[ultralytics.engine.model.Model]
+    # The detector runs on every `stride`-th frame, tracks are propagated
+    # by the Kalman filter and GMC in between
+    stride: int = 1
+    # Whether to run the detector earlier when the tracks become uncertain
+    adaptive_stride: bool = False
 
+    def registry_name(self) -> str:
+        """Returns the name of the model in the `MODELS` registry."""
+        return f"detector:{self.weights_path}"
 
-class GMC(tp.Protocol):
-    """
-    The minimal interface required to replace
-    the stock `ultralytics.trackers.utils.gmc.GMC` class
-    to implement a new GMC method within BoT-SORT.
-    """
+    def is_available(self) -> bool:
+        """Returns False if the weights (e.g. exported models) are missing."""
+        return pathlib.Path(self.weights_path).exists()
 
-    def apply(self, raw_frame: np.ndarray, detections: list) -> np.ndarray:
+    def load(self) -> ultralytics.engine.model.Model:
+        """Returns a warm model from the `MODELS` registry."""
+        return MODELS.get(
+            self.registry_name(), lambda: self.model_class(self.weights_path)
+        )
+
+
+@dataclasses.dataclass
+class Tracker:
+    cfg_path: str
+    ui_name: str
+    gmc_class: type[gmc.GMC]
+    gmc_args: dict[str, tp.Any]
+    # Whether the GMC matrices can be cached, i.e. don't depend on detections
+    cache_gmc: bool = True
+
+    def registry_name(self) -> str:
+        """Returns the name of the GMC in the `MODELS` registry."""
+        return f"gmc:{self.gmc_class.__name__}{self.gmc_args}"
+
+    def is_available(self) -> bool:
+        """Returns False if the GMC uses an exported model that is missing."""
+        model_path = self.gmc_args.get("model_path")
+        return model_path is None or pathlib.Path(model_path).exists()
+
+    def load_gmc(self) -> gmc.GMC:
         """
-        `raw_frame`: frame with shape [H, W, C].
-        `detections`: list of detections for this frame.
-        Returns a 2x3 homography matrix.
+        Returns a warm GMC from the `MODELS` registry.
+        Its parameters are reset, so it's ready for a new clip.
         """
+        model = MODELS.get(
+            self.registry_name(), lambda: self.gmc_class(**self.gmc_args)
+        )
+        model.reset_params()
+        return model
 
-    def reset_params(self) -> None:
-        """Resets all internal parameters (e.g. last seen frame)."""
-
-
-class RaftGMC:
-    def __init__(
-        self,
-        model_size: str = "small",
-        image_size: int = 128,
-        num_flow_updates: int = 1,
-    ) -> None:
-        if model_size == "small":
-            wgts = torchvision.models.optical_flow.Raft_Small_Weights.DEFAULT
-            self.model = torchvision.models.optical_flow.raft_small(
-                weights=wgts
-            )
-        elif model_size == "large":
-            wgts = torchvision.models.optical_flow.Raft_Large_Weights.DEFAULT
-            self.model = torchvision.models.optical_flow.raft_large(
-                weights=wgts
-            )
-        else:
-            raise ValueError
-
-        self.model = self.model.to(DEVICE).eval()
-        self.transforms = wgts.transforms()
-        self.image_size = image_size
-        self.num_flow_updates = num_flow_updates
-        self.last_frame = None
-
-    def apply(
-        self,
-        raw_frame: np.ndarray,
-        detections: list = None,  # pylint: disable=unused-argument
-    ) -> np.ndarray:
+
+def detect(
+    source: str | pathlib.Path,
+    detector: Detector,
+    progress: tp.Callable[[int], None] | None = None,
+) -> list[np.ndarray]:
+    """
+    Runs `detector` on each frame of `source`.
+    Returns a list with a [N, 6] array (xyxy, conf, cls) for each frame.
+    `progress` is called with the number of processed frames.
+    """
+    model = detector.load()
+    detections = []
+    for result in model.predict(source=source, stream=True, **DETECTION_ARGS):
+        detections.append(result.boxes.data.cpu().numpy())
+        if progress is not None:
+            progress(len(detections))
+    return detections
+
+
+def detect_frames(
+    detector: Detector, frames: list[np.ndarray]
+) -> list[np.ndarray]:
+    """
+    Runs `detector` on BGR `frames` in one batch.
+    Returns a [N, 6] array for each frame, like `detect`.
+    """
+    model = detector.load()
+    results = model.predict(source=frames, verbose=False, **DETECTION_ARGS)
+    return [result.boxes.data.cpu().numpy() for result in results]
+
+
+def detections_key(video_digest: str, detector: Detector) -> str:
+    """Returns the key of the detections of a video in `DETECTIONS`."""
+    return cache.make_key(video_digest, detector.weights_path, DETECTION_ARGS)
+
+
+def load_detections(
+    video_digest: str, detector: Detector
+) -> list[np.ndarray] | None:
+    """Returns the cached detections of a video or None if there are none."""
+    cached = DETECTIONS.load(detections_key(video_digest, detector))
+    if cached is None:
+        return None
+    return np.split(cached["boxes"], np.cumsum(cached["counts"])[:-1])
+
+
+def save_detections(
+    video_digest: str, detector: Detector, detections: list[np.ndarray]
+) -> None:
+    """Caches the detections of all frames of a video."""
+    DETECTIONS.save(
+        detections_key(video_digest, detector),
+        {
+            "counts": np.array([len(boxes) for boxes in detections]),
+            "boxes": np.concatenate([np.empty((0, 6)), *detections]),
+        },
+    )
+
+
+def cached_detect(
+    source: str | pathlib.Path,
+    video_digest: str,
+    detector: Detector,
+    progress: tp.Callable[[int], None] | None = None,
+) -> list[np.ndarray]:
+    """
+    Same as `detect`, but the detections are cached in `DETECTIONS`
+    by the contents of `source` (`video_digest`), the detector
+    and `DETECTION_ARGS`.
+    """
+    detections = load_detections(video_digest, detector)
+    if detections is not None:
+        return detections
+
+    detections = detect(source, detector, progress)
+    save_detections(video_digest, detector, detections)
+    return detections
+
+
+def coast(
+    bot_sort: ultralytics.trackers.bot_sort.BOTSORT, frame: np.ndarray
+) -> np.ndarray:
+    """
+    Moves the tracks of `bot_sort` to the next frame without detections:
+    predicts their boxes with the Kalman filter and compensates camera motion
+    with the GMC, like the first steps of `bot_sort.update`.
+    Returns the tracks in the same [M, 8] format as `update`.
+    """
+    bot_sort.frame_id += 1
+    tracked = [t for t in bot_sort.tracked_stracks if t.is_activated]
+    unconfirmed = [t for t in bot_sort.tracked_stracks if not t.is_activated]
+    strack_pool = bot_sort.joint_stracks(tracked, bot_sort.lost_stracks)
+    bot_sort.multi_predict(strack_pool)
+    warp = bot_sort.gmc.apply(frame, np.empty((0, 5)))
+    ultralytics.trackers.byte_tracker.STrack.multi_gmc(strack_pool, warp)
+    ultralytics.trackers.byte_tracker.STrack.multi_gmc(unconfirmed, warp)
+    return np.asarray([t.result for t in tracked], dtype=np.float32).reshape(
+        -1, 8
+    )
+
+
+def tracks_uncertain(
+    bot_sort: ultralytics.trackers.bot_sort.BOTSORT, prev_ids: set[int]
+) -> bool:
+    """
+    Returns True if the tracks of `bot_sort` can't be propagated safely
+    without detections: there are none, tracks have appeared or been lost
+    since the last keyframe (`prev_ids`) or their mean score is low.
+    """
+    tracked = [t for t in bot_sort.tracked_stracks if t.is_activated]
+    if not tracked or {t.track_id for t in tracked} != prev_ids:
+        return True
+    return np.mean([t.score for t in tracked]) < ADAPTIVE_MIN_SCORE
+
+
+def make_bot_sort(
+    tracker: Tracker, gmc_model: gmc.GMC
+) -> ultralytics.trackers.bot_sort.BOTSORT:
+    """
+    Creates BoT-SORT with the config of `tracker` that uses `gmc_model`
+    for camera motion compensation.
+    """
+
+    def gmc_patch(method: str) -> gmc.GMC:  # pylint: disable=unused-argument
         """
-        `raw_frame`: frame with shape [H, W, C].
-        `detections`: unused for RAFT.
-        Returns a 2x3 homography matrix.
+        Deliberately ignores `method` in favor of our GMC class.
+        BoT-SORT is recreated for each clip, but the GMC is kept warm
+        and only its state is reset.
         """
-        raw_frame = torch.tensor(raw_frame)
-        raw_frame = raw_frame.permute(2, 0, 1)[None, :]  # [1, C, H, W]
-        raw_frame = raw_frame[:, :, :, 10:-10]
-
-        scale_factor = raw_frame.shape[2] / self.image_size
-        raw_frame = F.resize(
-            raw_frame, size=self.image_size, antialias=False
-        )  # [1, C, h, w]
-
-        if self.last_frame is None:
-            self.last_frame = raw_frame
-            return np.eye(2, 3)
-
-        frame1, frame2 = self.transforms(self.last_frame, raw_frame)
-        flows = self.model(  # list[num_flow_updates] of [1, 2, h/8, w/8]
-            frame1.to(DEVICE),
-            frame2.to(DEVICE),
-            num_flow_updates=self.num_flow_updates,
-        )
+        gmc_model.reset_params()
+        return gmc_model
 
-        medians = flows[-1].reshape(2, -1).median(dim=1).values  # [2]
-        medians = medians.cpu().numpy()
-        hom = np.eye(2, 3)
-        hom[:, 2] = medians * scale_factor
+    ultralytics.trackers.bot_sort.GMC = gmc_patch
+    torchvision.models.optical_flow.raft.upsample_flow = gmc.scale_raft_flow
 
-        self.last_frame = raw_frame
-        return hom
+    bot_sort = ultralytics.trackers.bot_sort.BOTSORT(
+        args=ultralytics.utils.IterableSimpleNamespace(
+            **ultralytics.utils.yaml_load(tracker.cfg_path)
+        ),
+        frame_rate=30,
+    )
+    bot_sort.reset_id()
+    return bot_sort
 
-    def reset_params(self) -> None:
-        """Forgets the last seen frame before tracking a new clip."""
-        self.last_frame = None
+
+def advance(
+    bot_sort: ultralytics.trackers.bot_sort.BOTSORT,
+    frame: np.ndarray,
+    boxes: np.ndarray | None,
+) -> np.ndarray:
+    """
+    Moves the tracks of `bot_sort` to the next frame: matches them with
+    the [N, 6] detections `boxes` or, if there are none (None), propagates
+    them with `coast`.
+    Returns the tracks in the [M, 8] format of `bot_sort.update`:
+    xyxy, id, conf, cls, index of the detection.
+    """
+    if boxes is None:
+        return coast(bot_sort, frame)
+    if len(boxes) == 0:
+        return np.empty((0, 8))
+    # Without activated tracks, `update` returns an empty array of shape (0,)
+    return np.asarray(
+        bot_sort.update(
+            ultralytics.engine.results.Boxes(boxes, frame.shape[:2]), frame
+        )
+    ).reshape(-1, 8)
 
 
-def scale_raft_flow(flow: torch.Tensor, **_) -> torch.Tensor:
+def associate(
+    source: str | pathlib.Path,
+    detections: tp.Callable[[list[int], list[np.ndarray]], list[np.ndarray]],
+    tracker: Tracker,
+    fps: float,
+    video_digest: str | None = None,
+    store_dir: str | pathlib.Path | None = None,
+    progress: tp.Callable[[int], None] | None = None,
+    stride: int = 1,
+    adaptive_stride: bool = False,
+    stats: pipeline.PipelineStats | None = None,
+    start: int = 0,
+    stop: int | None = None,
+) -> track_store.TrackStore:
     """
-    Scales a tensor by a factor of 8.
-    Used to replace the upscaling function in the torchvision RAFT model
-    (`torchvision.models.optical_flow.raft.upsample_flow`),
-    since we don't need upscaling for this task.
+    Links detections of each frame of `source` into tracks with BoT-SORT,
+    the same way `ultralytics` does it in `model.track`.
+    `detections(frame_indices, frames)` returns the [N, 6] detections of each
+    of `frames`. It is called only on keyframes: every `stride`-th frame and,
+    if `adaptive_stride` is set, frames after which the tracks are uncertain.
+    On other frames the tracks are propagated with `coast`.
+    Frames are decoded and scheduled keyframes are detected in batches
+    by a `pipeline.TrackingPipeline` ahead of association, which records
+    its statistics in `stats`.
+    If `video_digest` is given and the tracker's GMC doesn't use detections,
+    the GMC matrices are cached in `GMC_MATRICES`, so tracking the same video
+    with another detector doesn't compute them again.
+    Only frames `[start, stop)` are tracked, and the frame indices of
+    the result count from `start`. Then cached GMC matrices are used
+    if there are any, but new ones aren't computed or cached.
+    If `store_dir` is given, the result is saved there and memory-mapped.
+    `progress` is called with the number of processed frames.
     """
-    return flow * 8
+    partial = start > 0 or stop is not None
+    tracker_gmc = tracker.load_gmc()
+    gmc_model = tracker_gmc
+    gmc_key = None
+    if video_digest is not None and tracker.cache_gmc:
+        gmc_key = cache.make_key(video_digest, tracker.registry_name())
+        cached = GMC_MATRICES.load(gmc_key)
+        matrices = None if cached is None else cached["matrices"][start:stop]
+        if partial:
+            gmc_key = None  # Matrices of a part of the video aren't cached
+        elif matrices is None and isinstance(
+            tracker_gmc, gmc.BatchedRaftGMC
+        ):
+            # Progress is reported only to let the job be cancelled meanwhile
+            matrices = tracker_gmc.compute_all(
+                source,
+                progress=None if progress is None else lambda _: progress(0),
+            )
+            GMC_MATRICES.save(gmc_key, {"matrices": matrices})
+        if not partial or matrices is not None:
+            gmc_model = gmc.CachedGMC(tracker_gmc, matrices)
 
+    bot_sort = make_bot_sort(tracker, gmc_model)
+    builder = track_store.TrackStoreBuilder(fps)
+    uncertain = True
+    keyframe_ids = set()
+    frames = pipeline.TrackingPipeline(
+        source,
+        detections,
+        lambda frame_idx: frame_idx % stride == 0,
+        DETECTION_BATCH_SIZE,
+        stats=stats,
+        start=start,
+        stop=stop,
+    )
+    # `ultralytics` runs the tracker in inference mode too, and GMCs rely on it
+    with frames, torch.inference_mode():
+        for frame_idx, (frame, boxes) in enumerate(frames, start=start):
+            if boxes is None and adaptive_stride and uncertain:
+                boxes = frames.detect([frame_idx], [frame])[0]
 
-@dataclasses.dataclass
-class Tracker:
-    cfg_path: str
-    ui_name: str
-    gmc_class: type[GMC]
-    gmc_args: dict[str, tp.Any]
+            with frames.stats.timer.measure("associate"):
+                if isinstance(gmc_model, gmc.CachedGMC):
+                    gmc_model.observe(frame)
+
+                tracks = advance(bot_sort, frame, boxes)
+                if boxes is not None:
+                    uncertain = tracks_uncertain(bot_sort, keyframe_ids)
+                    keyframe_ids = {
+                        t.track_id
+                        for t in bot_sort.tracked_stracks
+                        if t.is_activated
+                    }
+                builder.add_frame(
+                    tracks[:, 4].astype(int), tracks[:, :4], tracks[:, 5]
+                )
+            if progress is not None:
+                progress(builder.num_frames)
+
+    if isinstance(tracker_gmc, gmc.AdaptiveGMC) and tracker_gmc.path_counts:
+        frames.stats.gmc_paths.update(tracker_gmc.path_counts)
+        logging.info(
+            f"Adaptive GMC paths for {source}: {dict(tracker_gmc.path_counts)}"
+        )
+    if gmc_key is not None and gmc_model.cached is None:
+        GMC_MATRICES.save(gmc_key, {"matrices": gmc_model.matrices()})
+    return builder.build(store_dir)
 
 
 def track(
-    source: str, detector: Detector, tracker: Tracker
-) -> list[ultralytics.engine.results.Results]:
-    """Performs tracking on `source` using `detector` and `tracker`."""
-    model = detector.model_class(detector.weights_path)
+    source: str | pathlib.Path,
+    detector: Detector,
+    tracker: Tracker,
+    store_dir: str | pathlib.Path | None = None,
+    progress: tp.Callable[[int, int], None] | None = None,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    stats: pipeline.PipelineStats | None = None,
+    growing: bool = False,
+    start: int = 0,
+    stop: int | None = None,
+    video_digest: str | None = None,
+) -> track_store.TrackStore:
+    """
+    Performs tracking on `source` using `detector` and `tracker`.
+    Decoding, detection and association run at the same time in a pipeline
+    (see `associate`), whose statistics are recorded in `stats`.
+    Only the boxes of processed frames are kept, so memory use doesn't depend
+    on the video length.
+    If `store_dir` is given, the result is saved there and memory-mapped.
+    The detector and the GMC are taken from the `MODELS` registry.
+    The detections and the GMC matrices are cached in `DETECTIONS` and
+    `GMC_MATRICES`, so tracking the same video with another tracker doesn't
+    run the detector again and vice versa.
+    `stride` and `adaptive_stride` override those of `detector`. With a stride,
+    the detections of skipped frames are missing, so they aren't cached,
+    but cached detections of all frames are used if there are any.
+    `progress` is called with the number of processed and total frames.
+    If `growing` is set, `source` is still being uploaded (see
+    `upload.UploadTail`) and tracking runs on the frames received so far.
+    Then the total number of frames is unknown (0) and the cached detections
+    and GMC matrices can't be used, but the detections are still cached.
+    If `start` or `stop` is given, only frames `[start, stop)` of a complete
+    video are tracked (see `associate`) and reuse the cached detections
+    of all frames, but new ones aren't cached.
+    `video_digest` is the hash of a complete `source` (`cache.file_digest`)
+    if it's already known, otherwise it's computed here.
+    """
+    stride = detector.stride if stride is None else stride
+    if adaptive_stride is None:
+        adaptive_stride = detector.adaptive_stride
+    stats = pipeline.PipelineStats() if stats is None else stats
+    source = pathlib.Path(source)
+    tail = upload.UploadTail(source) if growing else None
+    capture = cv2.VideoCapture(
+        str(upload.partial_path(source) if growing else source)
+    )
+    if growing and not capture.isOpened():  # The upload is already complete
+        capture = cv2.VideoCapture(str(source))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    num_frames = 0 if growing else int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    partial = start > 0 or stop is not None
+    if not growing:
+        num_frames = (num_frames if stop is None else stop) - start
 
-    def gmc_patch(method: str) -> GMC:  # pylint: disable=unused-argument
-        """Deliberately ignores `method` in favor of our GMC class."""
-        return tracker.gmc_class(**tracker.gmc_args)
+    if growing:
+        video_digest = None
+    elif video_digest is None:
+        video_digest = cache.file_digest(source)
+    cached = None if growing else load_detections(video_digest, detector)
+    detected = {}
 
-    ultralytics.trackers.bot_sort.GMC = gmc_patch
-    torchvision.models.optical_flow.raft.upsample_flow = scale_raft_flow
+    def detections(
+        frame_indices: list[int], frames: list[np.ndarray]
+    ) -> list[np.ndarray]:
+        if cached is None:
+            boxes = detect_frames(detector, frames)
+            detected.update(zip(frame_indices, boxes))
+            return boxes
+        return [
+            cached[idx] if idx < len(cached) else np.empty((0, 6))
+            for idx in frame_indices
+        ]
 
-    return model.track(source=source, tracker=tracker.cfg_path)
+    def association_progress(done: int) -> None:
+        if progress is not None:
+            progress(done, num_frames)
+
+    with tail if growing else contextlib.nullcontext():
+        tracks = associate(
+            source if tail is None else tail.fifo_path,
+            detections,
+            tracker,
+            fps,
+            video_digest,
+            store_dir,
+            association_progress,
+            stride,
+            adaptive_stride,
+            stats,
+            start,
+            stop,
+        )
+    if growing:
+        video_digest = tail.digest()
+    logging.info(f"Tracking pipeline stats for {source}: {stats.to_header()}")
+
+    if (
+        video_digest is not None
+        and cached is None
+        and not partial
+        and len(detected) == tracks.num_frames
+    ):
+        save_detections(
+            video_digest, detector, [detected[i] for i in sorted(detected)]
+        )
+    return tracks
+
+
+def track_live(
+    source: live.LatestFrameSource,
+    detector: Detector,
+    tracker: Tracker,
+    emit: tp.Callable[[live.LiveFrame, np.ndarray], None],
+    latency_budget: float,
+    stride: int | None = None,
+    adaptive_stride: bool | None = None,
+    progress: tp.Callable[[int], None] | None = None,
+) -> int:
+    """
+    Tracks players on a live stream frame by frame, as soon as each frame
+    arrives. `emit(frame, tracks)` is called with the [M, 8] tracks
+    (see `advance`) of each processed frame.
+    Frames that have waited longer than `latency_budget` seconds since they
+    were received are dropped without processing, and `source` keeps only
+    the latest frame, so tracking falls behind the stream by a bounded time.
+    BoT-SORT just sees larger motion between the processed frames.
+    `stride` and `adaptive_stride` override those of `detector` and count
+    processed frames. `progress` is called with their number.
+    Returns the number of frames dropped over the budget.
+    """
+    stride = detector.stride if stride is None else stride
+    if adaptive_stride is None:
+        adaptive_stride = detector.adaptive_stride
+    bot_sort = make_bot_sort(tracker, tracker.load_gmc())
+    uncertain = True
+    keyframe_ids = set()
+    num_processed = 0
+    num_late = 0
+    with torch.inference_mode():
+        for frame in source:
+            if time.time() - frame.captured_at > latency_budget:
+                num_late += 1
+                continue
+
+            boxes = None
+            if num_processed % stride == 0 or (adaptive_stride and uncertain):
+                boxes = detect_frames(detector, [frame.image])[0]
+            tracks = advance(bot_sort, frame.image, boxes)
+            if boxes is not None:
+                uncertain = tracks_uncertain(bot_sort, keyframe_ids)
+                keyframe_ids = {
+                    t.track_id
+                    for t in bot_sort.tracked_stracks
+                    if t.is_activated
+                }
+            emit(frame, tracks)
+            num_processed += 1
+            if progress is not None:
+                progress(num_processed)
+    return num_late
 
 
 DETECTORS = {
@@ -164,11 +592,33 @@ DETECTORS = {
     ),
 }
 
+DETECTORS |= {
+    f"{slug}-{backend}{'-int8' if int8 else ''}": Detector(
+        weights_path=exported_path(
+            DETECTORS[slug].weights_path, backend, int8
+        ),
+        ui_name=(
+            f"{DETECTORS[slug].ui_name} "
+            f"({backend_name}{', INT8' if int8 else ''})"
+        ),
+        model_class=ultralytics.YOLO,
+    )
+    for slug in ["march-best", "march-best-s"]
+    for backend, backend_name in BACKENDS.items()
+    for int8 in [False, True]
+}
+
 TRACKERS = {
     "raft": Tracker(
         cfg_path="config/botsort.yaml",
         ui_name="BoT-SORT + RAFT",
-        gmc_class=RaftGMC,
+        gmc_class=gmc.RaftGMC,
+        gmc_args={},
+    ),
+    "raft-batched": Tracker(
+        cfg_path="config/botsort.yaml",
+        ui_name="BoT-SORT + RAFT (batched)",
+        gmc_class=gmc.BatchedRaftGMC,
         gmc_args={},
     ),
 }
@@ -181,3 +631,52 @@ TRACKERS |= {
     )
     for downscale in [2, 8, 10, 16, 20]
 }
+TRACKERS |= {
+    f"{slug}-adaptive": Tracker(
+        cfg_path="config/botsort.yaml",
+        ui_name=f"{TRACKERS[slug].ui_name} (adaptive)",
+        gmc_class=gmc.AdaptiveGMC,
+        gmc_args={
+            "inner_class": TRACKERS[slug].gmc_class,
+            "inner_args": TRACKERS[slug].gmc_args,
+            "budget_ms": (
+                None
+                if ADAPTIVE_GMC_BUDGET_MS is None
+                else float(ADAPTIVE_GMC_BUDGET_MS)
+            ),
+        },
+    )
+    for slug in ["raft", "spofl-2x"]
+}
+TRACKERS |= {
+    f"raft-{backend}{'-int8' if int8 else ''}": Tracker(
+        cfg_path="config/botsort.yaml",
+        ui_name=f"BoT-SORT + RAFT ({backend_name}{', INT8' if int8 else ''})",
+        gmc_class=gmc.ExportedRaftGMC,
+        gmc_args={
+            "model_path": exported_path(RAFT_EXPORT_STEM, backend, int8)
+        },
+    )
+    for backend, backend_name in BACKENDS.items()
+    for int8 in [False, True]
+}
+TRACKERS["pspofl-2x"] = Tracker(
+    cfg_path="config/botsort.yaml",
+    ui_name="BoT-SORT + Persistent Sparse OF (2x downscale)",
+    gmc_class=gmc.PersistentSparseFlowGMC,
+    gmc_args={"downscale": 2},
+    cache_gmc=False,
+)
+
+
+def preload_models() -> None:
+    """
+    Loads all available detectors and GMCs into the `MODELS` registry.
+    Models that haven't been exported are skipped.
+    """
+    for detector in DETECTORS.values():
+        if detector.is_available():
+            detector.load()
+    for tracker in TRACKERS.values():
+        if tracker.is_available():
+            tracker.load_gmc()
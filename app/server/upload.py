@@ -0,0 +1,147 @@
+import dataclasses
+import hashlib
+import os
+import pathlib
+import struct
+import tempfile
+import threading
+import time
+
+# Size of the chunks in which uploads are written to disk
+CHUNK_SIZE = 2**20
+# Bytes of an upload inspected by `is_streamable` before giving up
+MAX_HEAD_SIZE = 8 * 2**20
+# Containers that can always be decoded while they are being written
+STREAMABLE_SUFFIXES = {".flv", ".mkv", ".mpeg", ".mpg", ".ts", ".webm"}
+# Containers that can be, if their index (moov atom) comes first
+MP4_SUFFIXES = {".m4v", ".mov", ".mp4", ".mpeg4"}
+
+
+@dataclasses.dataclass
+class UploadTimes:
+    """Wall-clock times (time.time()) of the start and end of an upload."""
+
+    start: float
+    end: float | None = None
+
+
+def partial_path(path: pathlib.Path) -> pathlib.Path:
+    """
+    Returns where the upload of `path` is written until it's complete:
+    then it's renamed to `path`.
+    """
+    return path.with_name(f"{path.name}.part")
+
+
+def is_streamable(suffix: str, head: bytes) -> bool | None:
+    """
+    Returns whether a video with `suffix` starting with `head` can be decoded
+    before the whole file is available, or None if more bytes are needed
+    to decide. MP4 files are streamable only if the moov atom comes before
+    the media data (e.g. encoded with `-movflags faststart`).
+    """
+    suffix = suffix.lower()
+    if suffix in STREAMABLE_SUFFIXES:
+        return True
+    if suffix not in MP4_SUFFIXES:
+        return False
+
+    offset = 0
+    while offset + 8 <= len(head):
+        size, atom = struct.unpack(">I4s", head[offset : offset + 8])
+        if atom == b"moov":
+            return True
+        if atom == b"mdat" or size == 0:
+            return False
+        if size == 1:  # 64-bit size after the type
+            if offset + 16 > len(head):
+                break
+            (size,) = struct.unpack(">Q", head[offset + 8 : offset + 16])
+        if size < 8:
+            return False
+        offset += size
+    return None if len(head) < MAX_HEAD_SIZE else False
+
+
+class UploadTail:
+    """
+    Follows a video that is still being uploaded and passes its bytes
+    to a named pipe (`fifo_path`), from which it can be decoded like a file.
+
+    The upload of `path` is read from `partial_path(path)` as it grows,
+    until it's renamed to `path` (the upload is complete) and all its bytes
+    are read. If both files disappear, the upload has failed and the pipe
+    is closed early. The SHA-256 hash of the video is computed along the way
+    (`digest`), so it doesn't need to be read again.
+    """
+
+    def __init__(self, path: pathlib.Path, poll_secs: float = 0.05) -> None:
+        self.path = path
+        self.poll_secs = poll_secs
+        self.hash = hashlib.sha256()
+        self.complete = False
+        self.error = None
+        self.stopped = threading.Event()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.fifo_path = pathlib.Path(self.tmp_dir.name) / path.name
+        os.mkfifo(self.fifo_path)
+        # Opened here, so that the rename to `path` can't be missed
+        try:
+            # pylint: disable-next=consider-using-with
+            self.fin = open(partial_path(path), "rb")
+        except FileNotFoundError:  # Already complete
+            self.fin = open(path, "rb")  # pylint: disable=consider-using-with
+        self.thread = threading.Thread(target=self._copy, daemon=True)
+        self.thread.start()
+
+    def _copy(self) -> None:
+        """Copies the upload to the pipe until it's complete."""
+        try:
+            with open(self.fifo_path, "wb") as fout:
+                while not self.stopped.is_set():
+                    # Checked before reading, so that no bytes are missed
+                    done = self.path.exists()
+                    chunk = self.fin.read(CHUNK_SIZE)
+                    if chunk:
+                        self.hash.update(chunk)
+                        fout.write(chunk)
+                    elif done:
+                        self.complete = True
+                        break
+                    elif not (
+                        partial_path(self.path).exists() or self.path.exists()
+                    ):
+                        raise FileNotFoundError(
+                            f"upload of {self.path} has been aborted"
+                        )
+                    else:
+                        time.sleep(self.poll_secs)
+        except BrokenPipeError:
+            pass  # The decoder has stopped reading
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+
+    def digest(self) -> str | None:
+        """
+        Returns the SHA-256 hash of the video, like `cache.file_digest`,
+        or None if it hasn't been read completely.
+        """
+        return self.hash.hexdigest() if self.complete else None
+
+    def close(self) -> None:
+        """Stops following the upload and removes the pipe."""
+        self.stopped.set()
+        if self.thread.is_alive():
+            # Unblocks the thread if nobody has opened the pipe for reading
+            os.close(os.open(self.fifo_path, os.O_RDONLY | os.O_NONBLOCK))
+        self.thread.join()
+        self.fin.close()
+        self.tmp_dir.cleanup()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "UploadTail":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -1,11 +1,29 @@
+import collections
+import concurrent.futures
+import contextlib
 import dataclasses
+import enum
+import logging
+import multiprocessing
 import pathlib
+import queue
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import typing as tp
+import uuid
 
-import bbox_visualizer as bbox
 import cv2
-import moviepy.video.io.ImageSequenceClip
+import moviepy
+import moviepy.config
+import moviepy.video.io.ffmpeg_writer
+import numpy as np
 import pydantic
-import ultralytics.engine.results
+
+import jobs
+import track_store
 
 
 class PlayerParams(pydantic.BaseModel):
@@ -13,6 +31,13 @@ class PlayerParams(pydantic.BaseModel):
     draw: bool = True
 
 
+class OutputMode(str, enum.Enum):
+    # A video with boxes and labels drawn on it
+    VIDEO = "video"
+    # A clean video and an overlay with the boxes, drawn by the client
+    OVERLAY = "overlay"
+
+
 @dataclasses.dataclass
 class Rect:
     x1: int
@@ -21,6 +46,193 @@ class Rect:
     y2: int
 
 
+class StageTimer:
+    """Accumulates wall-clock time spent in named processing stages."""
+
+    def __init__(self) -> None:
+        self.secs = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def measure(self, stage: str):
+        """Adds the time spent inside the `with` block to `stage`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.secs[stage] += time.perf_counter() - start
+
+    def to_header(self) -> str:
+        """Formats the timings as e.g. `decode=1.23,encode=4.56`."""
+        return ",".join(
+            f"{stage}={secs:.2f}" for stage, secs in self.secs.items()
+        )
+
+
+class VideoWriter:
+    """
+    Encodes frames into a video file with ffmpeg while they are being produced.
+
+    Frames are passed to a background encoder thread through a queue holding
+    at most `max_queued` frames. `write` blocks while the queue is full,
+    so memory use is bounded and doesn't depend on the video length.
+    """
+
+    def __init__(
+        self,
+        out_path: str | pathlib.Path,
+        fps: float,
+        max_queued: int = 8,
+    ) -> None:
+        self.out_path = str(out_path)
+        self.fps = fps
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.error = None
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self) -> None:
+        """Feeds frames from the queue to ffmpeg until `None` is received."""
+        writer = None
+        try:
+            while (frame := self.frames.get()) is not None:
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    writer = moviepy.video.io.ffmpeg_writer.FFMPEG_VideoWriter(
+                        self.out_path, (width, height), self.fps
+                    )
+                writer.write_frame(frame)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+            # Keep draining so that producers blocked on `put` can finish
+            while self.frames.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def write(self, frame: np.ndarray) -> None:
+        """Queues `frame` for encoding, waiting if the queue is full."""
+        if self.error is not None:
+            raise self.error
+        self.frames.put(frame)
+
+    def close(self) -> None:
+        """Waits until all queued frames are encoded and closes the file."""
+        self.frames.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self) -> "VideoWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+class FrameReader:
+    """
+    Decodes frames of a video with OpenCV (in BGR) ahead of their consumer.
+
+    Frames are decoded in a background thread and passed through a queue
+    holding at most `max_queued` frames, so decoding overlaps with processing
+    while memory use stays bounded. Iterating over the reader yields frames.
+    Only frames `[start, stop)` are decoded (by default, all of them);
+    decoding seeks straight to `start`.
+    If `timer` is given, time spent decoding is added to its "decode" stage.
+    """
+
+    def __init__(
+        self,
+        in_path: str | pathlib.Path,
+        max_queued: int = 8,
+        timer: StageTimer | None = None,
+        start: int = 0,
+        stop: int | None = None,
+    ):
+        self.in_path = str(in_path)
+        self.start = start
+        self.stop = stop
+        self.timer = StageTimer() if timer is None else timer
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._decode, daemon=True)
+        self.thread.start()
+
+    def _put(self, frame: np.ndarray | None) -> bool:
+        """Queues `frame`, returns False if the reader has been closed."""
+        while not self.stopped.is_set():
+            try:
+                self.frames.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode(self) -> None:
+        """Puts decoded frames into the queue, followed by `None`."""
+        capture = cv2.VideoCapture(self.in_path)
+        try:
+            if self.start > 0:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, self.start)
+            frame_idx = self.start
+            while self.stop is None or frame_idx < self.stop:
+                with self.timer.measure("decode"):
+                    ok, frame = capture.read()
+                if not ok or not self._put(frame):
+                    break
+                frame_idx += 1
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.error = e
+        finally:
+            capture.release()
+            self._put(None)
+
+    def __iter__(self) -> tp.Iterator[np.ndarray]:
+        # Stops without waiting for `None` if closed from another thread
+        while not self.stopped.is_set():
+            try:
+                frame = self.frames.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if frame is None:
+                break
+            yield frame
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> None:
+        """Stops decoding, even if not all frames have been read."""
+        self.stopped.set()
+        self.thread.join()
+
+    def __enter__(self) -> "FrameReader":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def write_video(
+    out_path: str | pathlib.Path,
+    frames: tp.Iterable[np.ndarray],
+    fps: float,
+    progress: tp.Callable[[int, int], None] | None = None,
+    num_frames: int = 0,
+) -> None:
+    """
+    Encodes `frames` into a video file at `out_path`.
+    `frames` can be a generator: only a few frames are held in memory at once.
+    `progress` is called with the number of written frames and `num_frames`.
+    """
+    with VideoWriter(out_path, fps) as writer:
+        for frame_idx, frame in enumerate(frames, start=1):
+            writer.write(frame)
+            if progress is not None:
+                progress(frame_idx, num_frames)
+
+
 def fit_interval(
     left: int, right: int, min_lim: int, max_lim: int
 ) -> tuple[int, int]:
@@ -37,126 +249,716 @@ def fit_interval(
     return left + add, right + add
 
 
-async def get_player_times(
-    in_path: str | pathlib.Path,
-    boxes_list: list[ultralytics.engine.results.Boxes],
-) -> tuple[dict[int, int], dict[int, int]]:
+# Boxes and labels look like those of `bbox_visualizer`, used before
+BOX_COLOR = (255, 255, 255)
+BOX_THICKNESS = 3
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_BG_COLOR = (255, 255, 255)
+LABEL_TEXT_COLOR = (0, 0, 0)
+LABEL_HEIGHT = 30
+
+
+class LabelSprites:
     """
-    Gets time ranges of each player being present in the video at `in_path`
-    using `boxes_list` - a list of ultralytics `Boxes` objects for each frame.
+    Renders the label of each player once according to `params_dict`
+    and draws it on frames by copying the pixels (`blit`).
+    A sprite is the label background above the top left corner of the box
+    along with the parts of the text that stick out below it.
     """
-    with moviepy.VideoFileClip(in_path, audio=False) as clip:
-        fps = clip.fps
 
-    start_secs = {}
-    end_secs = {}
-    for frame_idx, boxes in enumerate(boxes_list):
-        if boxes.is_track:
-            upd = dict.fromkeys(
-                boxes.id.int().tolist(), round(frame_idx / fps)
+    def __init__(self, params_dict: dict[int, PlayerParams]) -> None:
+        self.params_dict = params_dict
+        # Player id -> (pixels [h, w, C], mask [h, w]) or None if not drawn
+        self.sprites = {}
+
+    def render(self, label: str) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the pixels and the mask of the sprite of `label`."""
+        (text_width, _), baseline = cv2.getTextSize(label, LABEL_FONT, 1, 2)
+        height = LABEL_HEIGHT + 1 + baseline + 2
+        text = np.zeros((height, text_width + 21), dtype=np.uint8)
+        cv2.putText(
+            text, label, (10, LABEL_HEIGHT - 5), LABEL_FONT, 1, 255, 2
+        )
+        mask = text > 0
+        mask[: LABEL_HEIGHT + 1] = True
+        pixels = np.empty((*text.shape, 3), dtype=np.uint8)
+        pixels[:] = LABEL_BG_COLOR
+        pixels[text > 0] = LABEL_TEXT_COLOR
+        return pixels, mask
+
+    def get(self, player_id: int) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        Returns the sprite of player `player_id`, or None if they aren't drawn.
+        """
+        if player_id not in self.sprites:
+            params = self.params_dict[player_id]
+            self.sprites[player_id] = (
+                self.render(params.label if params.label else f"id{player_id}")
+                if params.draw
+                else None
             )
-            start_secs = upd | start_secs
-            end_secs = end_secs | upd
-    return start_secs, end_secs
+        return self.sprites[player_id]
+
+    def blit(self, frame: np.ndarray, player_id: int, x: int, y: int) -> None:
+        """
+        Draws the label of player `player_id` on `frame` in place for a box
+        with the top left corner `(x, y)`, cropping it at the frame borders.
+        """
+        pixels, mask = self.get(player_id)
+        top = y - LABEL_HEIGHT
+        y1, y2 = max(top, 0), min(top + len(pixels), frame.shape[0])
+        x1, x2 = max(x, 0), min(x + pixels.shape[1], frame.shape[1])
+        if y1 >= y2 or x1 >= x2:
+            return
+        rows = slice(y1 - top, y2 - top)
+        cols = slice(x1 - x, x2 - x)
+        np.copyto(
+            frame[y1:y2, x1:x2],
+            pixels[rows, cols],
+            where=mask[rows, cols, None],
+        )
+
 
+def draw_frame(
+    frame: np.ndarray,
+    track_ids: np.ndarray,
+    boxes: np.ndarray,
+    sprites: LabelSprites,
+) -> np.ndarray:
+    """
+    Draws bounding boxes and labels on a single frame
+    using `track_ids` and `boxes` (xyxy) and the labels from `sprites`.
+    The frame is drawn on in place, unless it's read-only: then it's copied
+    once. All boxes are drawn with a single OpenCV call.
+    """
+    visible = [sprites.get(pid) is not None for pid in track_ids.tolist()]
+    if not any(visible):
+        return frame
+    if not frame.flags.writeable:
+        frame = frame.copy()
+
+    boxes = boxes[visible].round().astype(np.int32)
+    corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+    cv2.polylines(frame, list(corners), True, BOX_COLOR, BOX_THICKNESS)
+    for (x1, y1, _, _), pid in zip(
+        boxes.tolist(), track_ids[visible].tolist()
+    ):
+        sprites.blit(frame, pid, x1, y1)
+    return frame
 
-async def draw_bboxes(
+
+def draw_bboxes(
     in_path: str | pathlib.Path,
     out_path: str | pathlib.Path,
-    boxes_list: list[ultralytics.engine.results.Boxes],
+    tracks: track_store.TrackStore,
     params_dict: dict[int, PlayerParams],
+    progress: tp.Callable[[int, int], None] | None = None,
+    num_workers: int = 1,
 ) -> None:
     """
     Reads a video from `in_path` and draws bounding boxes and labels on it
-    using `boxes_list` according to `params_dict`.
+    using `tracks` according to `params_dict`.
     The new video is saved to `out_path`.
+    With several `num_workers`, segments of the video are rendered
+    in parallel by `draw_bboxes_parallel`.
+    All render paths decode with `FrameReader`, like tracking does, so that
+    the boxes of frame `i` are drawn on the same frame `i` (the frames after
+    a seek are checked by `benchmark.py render`).
     """
-    clip = moviepy.VideoFileClip(in_path, audio=False)
+    if num_workers > 1:
+        draw_bboxes_parallel(
+            in_path, out_path, tracks, params_dict, num_workers, progress
+        )
+        return
+    render_segment(in_path, out_path, tracks, params_dict, 0, progress)
+
 
-    out_frames = []
-    for frame, boxes in zip(clip.iter_frames(), boxes_list):
-        if boxes.is_track:
-            for xyxy, pid in zip(
-                boxes.xyxy.round().int().tolist(), boxes.id.int().tolist()
-            ):
-                params = params_dict[pid]
-                if not params.draw:
-                    continue
-                label = params.label if params.label else f"id{pid}"
+def keyframe_indices(in_path: str | pathlib.Path, fps: float) -> list[int]:
+    """
+    Returns the indices of the keyframes of the video at `in_path`.
+    Only the keyframes are decoded (by ffmpeg), so this is fast.
+    """
+    result = subprocess.run(
+        [
+            moviepy.config.FFMPEG_BINARY,
+            "-hide_banner",
+            "-nostats",
+            "-skip_frame",
+            "nokey",
+            "-i",
+            str(in_path),
+            "-map",
+            "0:v:0",
+            "-vf",
+            "showinfo",
+            "-f",
+            "null",
+            "-",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    pts_times = [
+        float(match)
+        for match in re.findall(r"pts_time:\s*(-?[\d.]+)", result.stderr)
+    ]
+    if not pts_times:
+        return [0]
+    return sorted({round((pts - pts_times[0]) * fps) for pts in pts_times})
 
-                frame = bbox.draw_rectangle(frame, xyxy)
-                frame = bbox.add_label(frame, label, xyxy)
-        out_frames.append(frame)
 
-    moviepy.video.io.ImageSequenceClip.ImageSequenceClip(
-        out_frames, fps=clip.fps
-    ).write_videofile(out_path)
-    clip.close()
+def segment_bounds(
+    keyframes: list[int],
+    num_frames: int,
+    num_segments: int,
+    min_frames: int = 50,
+) -> list[tuple[int, int]]:
+    """
+    Splits frames `[0, num_frames)` into at most `num_segments` segments
+    of similar length starting at `keyframes`, so that decoding each segment
+    doesn't need any frames before it. Segments are at least `min_frames` long.
+    Returns the `(start, stop)` of each segment.
+    """
+    keyframes = np.array(keyframes)
+    starts = [0]
+    for segment_idx in range(1, num_segments):
+        target = segment_idx * num_frames / num_segments
+        start = int(keyframes[np.abs(keyframes - target).argmin()])
+        if start - starts[-1] >= min_frames and (
+            num_frames - start >= min_frames
+        ):
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [num_frames]))
 
 
-async def crop_to_player(
+def render_segment(
     in_path: str | pathlib.Path,
     out_path: str | pathlib.Path,
-    boxes_list: list[ultralytics.engine.results.Boxes],
-    player_id: int,
+    tracks: track_store.TrackStore,
+    params_dict: dict[int, PlayerParams],
+    start: int,
+    progress: tp.Callable[[int, int], None] | None = None,
+) -> int:
+    """
+    Draws boxes and labels on the frames of the video at `in_path` starting
+    at `start`, using `tracks` of these frames only (see `draw_bboxes`).
+    The segment is saved to `out_path`. Returns the number of frames.
+    `progress` is called with the number of written and total frames.
+    """
+    sprites = LabelSprites(params_dict)
+    with FrameReader(
+        in_path, start=start, stop=start + tracks.num_frames
+    ) as reader:
+        write_video(
+            out_path,
+            (
+                # `VideoWriter` takes RGB frames
+                draw_frame(
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB),
+                    track_ids,
+                    boxes,
+                    sprites,
+                )
+                for frame, (track_ids, boxes) in zip(
+                    reader, tracks.iter_frames()
+                )
+            ),
+            tracks.fps,
+            progress,
+            tracks.num_frames,
+        )
+    return tracks.num_frames
+
+
+# How often `render_segments` reports the progress of its workers,
+# which is also when a cancelled job stops
+SEGMENT_POLL_SECS = 0.5
+# Frames rendered so far of each segment, shared by the workers
+# of `render_segments` with the process that waits for them
+_segment_frames = None
+
+
+def init_segment_worker(segment_frames) -> None:
+    """Keeps the shared frame counters in a worker of `render_segments`."""
+    global _segment_frames  # pylint: disable=global-statement
+    _segment_frames = segment_frames
+
+
+def render_pooled_segment(segment_idx: int, *args) -> int:
+    """
+    Same as `render_segment` with `args`, but runs in a worker process
+    of `render_segments` and counts the frames of segment `segment_idx`
+    in the shared counters.
+    """
+
+    def progress(done: int, _: int) -> None:
+        _segment_frames[segment_idx] = done
+
+    return render_segment(*args, progress=progress)
+
+
+def concat_videos(
+    in_paths: list[pathlib.Path], out_path: str | pathlib.Path
 ) -> None:
     """
-    Reads a video from `in_path` and crops it to the movements of a single
-    player with id `player_id` using `boxes_list`.
-    The new video is saved to `out_path`.
+    Concatenates videos encoded with the same settings into `out_path`
+    with ffmpeg, copying the streams without re-encoding.
+    """
+    out_path = pathlib.Path(out_path)
+    list_path = out_path.with_suffix(".concat.txt")
+    list_path.write_text(
+        "".join(f"file '{path.resolve()}'\n" for path in in_paths)
+    )
+    subprocess.run(
+        [
+            moviepy.config.FFMPEG_BINARY,
+            "-y",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            str(list_path),
+            "-c",
+            "copy",
+            str(out_path),
+        ],
+        check=True,
+    )
+    list_path.unlink()
+
+
+def render_segments(
+    in_path: str | pathlib.Path,
+    tracks: track_store.TrackStore,
+    params_dict: dict[int, PlayerParams],
+    segments: list[tuple[int, int, pathlib.Path]],
+    num_workers: int,
+    progress: tp.Callable[[int, int], None] | None = None,
+) -> None:
+    """
+    Renders each `(start, stop, out_path)` segment of the video at `in_path`
+    with `render_segment`, in a pool of `num_workers` processes if there are
+    several. `progress` is called with the number of rendered frames and
+    the total number of frames in `segments`: after each frame or, with
+    a pool, every `SEGMENT_POLL_SECS`. If it raises (e.g. `jobs.JobCancelled`)
+    or a segment fails, the workers rendering the other segments are killed.
     """
-    rects = []
-    for boxes in boxes_list:
-        if boxes.is_track:
-            xyxy = boxes.xyxy[boxes.id == player_id]
-            if len(xyxy) > 0:
-                rects.append(Rect(*xyxy.round().int().flatten().tolist()))
+    num_frames = sum(stop - start for start, stop, _ in segments)
+    num_done = 0
+    if num_workers == 1:
+        for start, stop, out_path in segments:
+            num_done += render_segment(
+                in_path,
+                out_path,
+                tracks.frame_range(start, stop),
+                params_dict,
+                start,
+                (
+                    None
+                    if progress is None
+                    else lambda done, _, before=num_done: progress(
+                        before + done, num_frames
+                    )
+                ),
+            )
+        return
+
+    context = multiprocessing.get_context("spawn")
+    segment_frames = context.Array("q", len(segments), lock=False)
+    pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(num_workers, len(segments)),
+        mp_context=context,
+        initializer=init_segment_worker,
+        initargs=(segment_frames,),
+    )
+    try:
+        pending = {
+            pool.submit(
+                render_pooled_segment,
+                segment_idx,
+                in_path,
+                out_path,
+                tracks.frame_range(start, stop),
+                params_dict,
+                start,
+            )
+            for segment_idx, (start, stop, out_path) in enumerate(segments)
+        }
+        while pending:
+            finished, pending = concurrent.futures.wait(
+                pending,
+                timeout=SEGMENT_POLL_SECS,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in finished:
+                future.result()
+            if progress is not None:
+                progress(sum(segment_frames), num_frames)
+    except BaseException:
+        # Doesn't wait for the other segments if one of them has failed
+        # or the job has been cancelled
+        jobs.terminate_workers(pool)
+        raise
+    pool.shutdown()
+
+
+def draw_bboxes_parallel(
+    in_path: str | pathlib.Path,
+    out_path: str | pathlib.Path,
+    tracks: track_store.TrackStore,
+    params_dict: dict[int, PlayerParams],
+    num_workers: int,
+    progress: tp.Callable[[int, int], None] | None = None,
+) -> None:
+    """
+    Same as `draw_bboxes`, but the video is split into keyframe-aligned
+    segments, which are decoded, drawn and encoded in a pool of
+    `num_workers` processes and then concatenated without re-encoding.
+    `progress` is called as the frames are rendered (see `render_segments`).
+    """
+    bounds = segment_bounds(
+        keyframe_indices(in_path, tracks.fps), tracks.num_frames, num_workers
+    )
+    out_path = pathlib.Path(out_path)
+    with tempfile.TemporaryDirectory(
+        dir=out_path.parent, ignore_cleanup_errors=True
+    ) as tmp_dir:
+        segment_paths = [
+            pathlib.Path(tmp_dir) / f"segment-{segment_idx}.mp4"
+            for segment_idx in range(len(bounds))
+        ]
+        render_segments(
+            in_path,
+            tracks,
+            params_dict,
+            [
+                (start, stop, segment_path)
+                for (start, stop), segment_path in zip(bounds, segment_paths)
+            ],
+            num_workers,
+            progress,
+        )
+        concat_videos(segment_paths, out_path)
+
+
+@dataclasses.dataclass
+class SegmentedRender:
+    """
+    A video rendered by `draw_bboxes_incremental` with `params_dict`:
+    frames `bounds[i]` are encoded in the file `segment_paths[i]`.
+    """
+
+    params_dict: dict[int, PlayerParams]
+    bounds: list[tuple[int, int]]
+    segment_paths: list[pathlib.Path]
+
+
+def draw_bboxes_incremental(
+    in_path: str | pathlib.Path,
+    out_path: str | pathlib.Path,
+    tracks: track_store.TrackStore,
+    params_dict: dict[int, PlayerParams],
+    segments_dir: pathlib.Path,
+    previous: SegmentedRender | None = None,
+    num_workers: int = 1,
+    segment_secs: float = 2,
+    progress: tp.Callable[[int, int], None] | None = None,
+) -> SegmentedRender:
+    """
+    Same as `draw_bboxes`, but the video is rendered in keyframe-aligned
+    segments of about `segment_secs` seconds, which are kept in `segments_dir`
+    and concatenated into `out_path` without re-encoding.
+    If a `previous` render of the same video is given, only the segments
+    where players with changed params appear are rendered again
+    (by `render_segments`), the others are reused.
+    Returns the new render, to be passed as `previous` next time.
+    """
+    if previous is None or not all(
+        path.exists() for path in previous.segment_paths
+    ):
+        num_segments = max(
+            1, round(tracks.num_frames / (segment_secs * tracks.fps))
+        )
+        bounds = segment_bounds(
+            keyframe_indices(in_path, tracks.fps),
+            tracks.num_frames,
+            num_segments,
+        )
+        dirty = [True] * len(bounds)
+        segment_paths = [None] * len(bounds)
+    else:
+        changed = [
+            pid
+            for pid, params in params_dict.items()
+            if previous.params_dict.get(pid) != params
+        ]
+        bounds = previous.bounds
+        dirty = [
+            np.isin(
+                tracks.track_id[
+                    tracks.frame_starts[start] : tracks.frame_starts[stop]
+                ],
+                changed,
+            ).any()
+            for start, stop in bounds
+        ]
+        segment_paths = list(previous.segment_paths)
+
+    # New files, since the previous segments may still be used by other jobs
+    segments_dir.mkdir(parents=True, exist_ok=True)
+    segments = []
+    for segment_idx, (start, stop) in enumerate(bounds):
+        if dirty[segment_idx]:
+            segment_paths[segment_idx] = (
+                segments_dir / f"segment-{uuid.uuid4().hex}.mp4"
+            )
+            segments.append((start, stop, segment_paths[segment_idx]))
+    logging.info(f"Rendering {len(segments)}/{len(bounds)} segments")
+
+    if segments:
+        render_segments(
+            in_path, tracks, params_dict, segments, num_workers, progress
+        )
+    concat_videos(segment_paths, out_path)
+    return SegmentedRender(dict(params_dict), bounds, segment_paths)
+
+
+def delete_unused_segments(
+    segments_dir: pathlib.Path, render: SegmentedRender
+) -> None:
+    """
+    Deletes the segments in `segments_dir` that `render` doesn't use:
+    those of previous renders that have been rendered again and those left
+    by failed or cancelled renders. No other render may be running.
+    """
+    used = set(render.segment_paths)
+    unused = [path for path in segments_dir.glob("*.mp4") if path not in used]
+    for path in unused:
+        path.unlink(missing_ok=True)
+    logging.info(f"Deleted {len(unused)} unused segments in {segments_dir}")
+
+
+def fill_gaps(
+    trajectory: track_store.Trajectory, max_gap: int
+) -> np.ndarray:
+    """
+    Returns the boxes [n, 4] of a player on every frame from their first
+    to their last appearance. On frames where they are missing, the box is
+    interpolated between the neighbouring boxes if the gap is at most
+    `max_gap` frames long, otherwise the last box is held.
+    """
+    frames = np.arange(trajectory.first_frame(), trajectory.last_frame() + 1)
+    interpolated = np.stack(
+        [
+            np.interp(frames, trajectory.frames, trajectory.xyxy[:, coord])
+            for coord in range(4)
+        ],
+        axis=1,
+    )
+    # Index of the last known box on each frame
+    last = np.searchsorted(trajectory.frames, frames, side="right") - 1
+    gaps = np.diff(trajectory.frames) - 1
+    held = np.append(gaps > max_gap, False)[last]
+    interpolated[held] = trajectory.xyxy[last[held]]
+    return interpolated
+
+
+def crop_rects(player_boxes: np.ndarray) -> list[Rect]:
+    """
+    Returns the crops of a focused video for the boxes [n, 4] of a player:
+    every crop has the maximum width and height among the boxes and keeps
+    the box in its center. They are fitted inside the frame by `crop`.
+    """
+    rects = [Rect(*xyxy) for xyxy in player_boxes.round().astype(int).tolist()]
 
     max_x = max(rect.x2 - rect.x1 for rect in rects)
     max_y = max(rect.y2 - rect.y1 for rect in rects)
-
-    clip = moviepy.VideoFileClip(in_path, audio=False)
-    out_frames = []
-    for frame, rect in zip(clip.iter_frames(), rects):
+    for rect in rects:
         extra_x = max_x - (rect.x2 - rect.x1)
         extra_y = max_y - (rect.y2 - rect.y1)
-
         rect.x1 -= extra_x // 2
         rect.x2 += extra_x // 2 + extra_x % 2
-        rect.x1, rect.x2 = fit_interval(rect.x1, rect.x2, 0, frame.shape[1])
-
         rect.y1 -= extra_y // 2
         rect.y2 += extra_y // 2 + extra_y % 2
-        rect.y1, rect.y2 = fit_interval(rect.y1, rect.y2, 0, frame.shape[0])
+    return rects
+
+
+def crop(frame: np.ndarray, rect: Rect) -> np.ndarray:
+    """
+    Crops a BGR `frame` to `rect`, shifted to fit inside the frame,
+    and returns the crop in RGB.
+    """
+    x1, x2 = fit_interval(rect.x1, rect.x2, 0, frame.shape[1])
+    y1, y2 = fit_interval(rect.y1, rect.y2, 0, frame.shape[0])
+    return cv2.cvtColor(frame[y1:y2, x1:x2], cv2.COLOR_BGR2RGB)
 
-        out_frames.append(frame[rect.y1 : rect.y2, rect.x1 : rect.x2])
 
-    moviepy.video.io.ImageSequenceClip.ImageSequenceClip(
-        out_frames, fps=clip.fps
-    ).write_videofile(out_path)
-    clip.close()
+def merge_spans(spans: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    Merges overlapping or adjacent frame ranges `[start, stop)` into
+    disjoint ones, sorted by their start.
+    """
+    merged = []
+    for start, stop in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
 
 
-async def save_player_images(
+def crop_to_players(
     in_path: str | pathlib.Path,
-    out_dir: str | pathlib.Path,
-    boxes_list: list[ultralytics.engine.results.Boxes],
+    out_paths: dict[int, str | pathlib.Path],
+    index: track_store.PlayerIndex,
+    progress: tp.Callable[[int, int], None] | None = None,
+    max_gap: int = 10,
 ) -> None:
     """
-    Reads a video from `in_path` and saves an image of each player from their
-    first detection using `boxes_list`. The images are saved to `out_dir`.
+    Reads a video from `in_path` and crops it to the movements of each player
+    in `out_paths` using their trajectory from `index` (see `crop_rects`).
+    The video of player `pid` is saved to `out_paths[pid]`.
+
+    The spans of the players are merged into disjoint frame ranges
+    (see `merge_spans`), and only those are decoded, seeking straight to
+    the start of each range, so frames where none of the players are present
+    are skipped. Each frame is cropped for all players present on it, and
+    the crops are encoded concurrently by a `VideoWriter` per player.
+    Over gaps in a trajectory, the crop is interpolated or held
+    (see `fill_gaps`).
+    `progress` is called with the number of written and total crops.
     """
+    trajectories = {pid: index[pid] for pid in out_paths}
+    rects = {
+        pid: crop_rects(fill_gaps(trajectory, max_gap))
+        for pid, trajectory in trajectories.items()
+    }
+    spans = merge_spans(
+        [
+            (traj.first_frame(), traj.first_frame() + len(rects[pid]))
+            for pid, traj in trajectories.items()
+        ]
+    )
+    num_crops = sum(len(player_rects) for player_rects in rects.values())
+    num_done = 0
+
+    writers = {
+        pid: VideoWriter(out_path, index.fps)
+        for pid, out_path in out_paths.items()
+    }
+    try:
+        for start, stop in spans:
+            with FrameReader(in_path, start=start, stop=stop) as reader:
+                for frame_idx, frame in enumerate(reader, start=start):
+                    for pid, trajectory in trajectories.items():
+                        offset = frame_idx - trajectory.first_frame()
+                        if 0 <= offset < len(rects[pid]):
+                            writers[pid].write(
+                                crop(frame, rects[pid][offset])
+                            )
+                            num_done += 1
+                    if progress is not None:
+                        progress(num_done, num_crops)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+
+def crop_to_player(
+    in_path: str | pathlib.Path,
+    out_path: str | pathlib.Path,
+    index: track_store.PlayerIndex,
+    player_id: int,
+    progress: tp.Callable[[int, int], None] | None = None,
+    max_gap: int = 10,
+) -> None:
+    """
+    Reads a video from `in_path` and crops it to the movements of a single
+    player with id `player_id` using their trajectory from `index`.
+    Decoding seeks straight to the player's first appearance and stops after
+    their last one (see `crop_to_players`).
+    The new video is saved to `out_path`.
+    """
+    crop_to_players(in_path, {player_id: out_path}, index, progress, max_gap)
+
+
+def make_overlay(tracks: track_store.TrackStore) -> dict[str, tp.Any]:
+    """
+    Returns the boxes of `tracks` in a compact form for drawing them
+    on top of the clean video on the client side: the boxes of frame `i`
+    are `boxes[frame_starts[i]:frame_starts[i + 1]]` (xyxy, rounded to
+    pixels) with ids `track_ids[frame_starts[i]:frame_starts[i + 1]]`.
+    """
+    return {
+        "fps": tracks.fps,
+        "num_frames": tracks.num_frames,
+        "frame_starts": tracks.frame_starts.tolist(),
+        "track_ids": tracks.track_id.tolist(),
+        "boxes": tracks.xyxy.round().astype(int).tolist(),
+    }
+
+
+def postprocess(
+    in_path: str | pathlib.Path,
+    annotated_path: str | pathlib.Path,
+    images_dir: str | pathlib.Path,
+    tracks: track_store.TrackStore,
+    timer: StageTimer,
+    progress: tp.Callable[[int, int], None] | None = None,
+    annotate: bool = True,
+) -> None:
+    """
+    Decodes the video at `in_path` once and passes every frame to all
+    post-processing stages at the same time:
+      - the image extractor, which saves an image of each player from
+        their first detection to `images_dir`,
+      - the annotator, which draws bounding boxes and labels with default
+        `PlayerParams` and saves the new video to `annotated_path`.
+        If `annotate` is False, the frames are saved as they are.
+    Time spent in each stage is added to `timer`. Encoding runs in the
+    background, so the "encode" stage only counts time spent waiting for it.
+    `progress` is called with the number of processed and total frames.
+    """
+    sprites = LabelSprites(collections.defaultdict(PlayerParams))
     saved = set()
-    clip = moviepy.VideoFileClip(in_path, audio=False)
-    for frame, boxes in zip(clip.iter_frames(), boxes_list):
-        if boxes.is_track:
-            for xyxy, pid in zip(
-                boxes.xyxy.round().int().tolist(), boxes.id.int().tolist()
-            ):
-                if pid not in saved:
-                    x1, y1, x2, y2 = xyxy
-                    cv2.imwrite(
-                        f"{out_dir}/{pid}.jpg", frame[y1:y2, x1:x2, ::-1]
-                    )
-                    saved.add(pid)
-    clip.close()
+
+    with timer.measure("decode"):
+        clip = moviepy.VideoFileClip(in_path, audio=False)
+        frames = clip.iter_frames()
+    writer = VideoWriter(annotated_path, clip.fps)
+
+    try:
+        for frame_idx, (track_ids, boxes) in enumerate(tracks.iter_frames()):
+            with timer.measure("decode"):
+                frame = next(frames, None)
+            if frame is None:
+                break
+
+            with timer.measure("images"):
+                for xyxy, pid in zip(
+                    boxes.round().astype(int).tolist(), track_ids.tolist()
+                ):
+                    if pid not in saved:
+                        x1, y1, x2, y2 = xyxy
+                        cv2.imwrite(
+                            f"{images_dir}/{pid}.jpg",
+                            frame[y1:y2, x1:x2, ::-1],
+                        )
+                        saved.add(pid)
+
+            if annotate:
+                with timer.measure("annotate"):
+                    frame = draw_frame(frame, track_ids, boxes, sprites)
+            with timer.measure("encode"):
+                writer.write(frame)
+            if progress is not None:
+                progress(frame_idx + 1, tracks.num_frames)
+    finally:
+        with timer.measure("encode"):
+            writer.close()
+            clip.close()